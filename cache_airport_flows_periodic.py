@@ -1,6 +1,7 @@
 import os
 import pymongo
 import datetime
+import bson
 from simulator import tasks
 import celery
 import pandas as pd
@@ -35,23 +36,131 @@ def main():
     parser.add_argument(
         "--freq", default='M'
     )
+    parser.add_argument(
+        "--batch", action='store_true',
+        help="Calculate each period's flows with a chord of tasks that each calculate the flows "
+             "for a chunk of the airports, so the workers load each period's flights once per chunk."
+    )
+    parser.add_argument(
+        "--origins_per_task", default='50',
+        help="The number of airports each task calculates the flows for in batch mode."
+    )
+    parser.add_argument(
+        "--local", action='store_true',
+        help="Calculate each period's flows in this process and processes forked from it "
+             "rather than on the workers."
+    )
+    parser.add_argument(
+        "--processes", default=None,
+        help="The number of processes to split the airports between with --local. Defaults to one per core."
+    )
+    parser.add_argument(
+        "--concurrent_periods", default='1',
+        help="The number of periods to cache at once. The tasks for each period are routed "
+             "to one of CACHING_QUEUES queues so that each period is only loaded by some of the workers."
+    )
+    parser.add_argument(
+        "--versioned", action='store_true',
+        help="Write each period's flows to a new version of its simGroup that is published once they "
+             "are all written. Only use this once every reader of the passengerFlows collection "
+             "looks up the published version of the simGroups it reads."
+    )
+    parser.add_argument(
+        "--status", action='store_true',
+        help="Print the queue depth and direct flow cache hit ratio of the periods being cached and exit."
+    )
     args = parser.parse_args()
+    if args.status:
+        print_status()
+        return
+    processes = None if args.processes is None else int(args.processes)
     periods = list(pd.date_range(args.start_date, periods=int(args.periods) + 1, freq=args.freq))
+    running_periods = []
     for current_period, next_period in zip(periods, periods[1:]):
-        start_date = current_period.to_period().start_time
-        end_date = next_period.to_period().start_time
-        res = celery.group(*[
-            tasks.calculate_flows_for_airport.s(
-                i['_id'],
-                start_date.strftime('%Y-%m-%d'),
-                end_date.strftime('%Y-%m-%d'),
-                start_date.strftime(args.sim_group)).set(queue='caching')
-            for i in db.airports.find()
-        ])()
-        print "Waiting for sims to complete for:", str(start_date)
-        # Simulating too many months at once can be slow because aggregated direct flights is only cached
-        # for a limited number of months.
-        res.get(timeout=None, interval=2.0)
+        start_date = current_period.to_period().start_time.strftime('%Y-%m-%d')
+        end_date = next_period.to_period().start_time.strftime('%Y-%m-%d')
+        sim_group = current_period.to_period().start_time.strftime(args.sim_group)
+        queue = tasks.get_caching_queue(start_date, end_date)
+        if args.local:
+            stats = tasks.calculate_flows_for_period(
+                start_date, end_date, sim_group, processes,
+                sim_version=str(bson.ObjectId()) if args.versioned else None)
+            print "Calculated flows for", stats['origins'], "origins at", stats['originsPerSecond'], "origins per second"
+            continue
+        # Versioned flows are written to a new version of the simGroup that is published once they are all
+        # written, so the previous version remains available until then. Otherwise each airport's
+        # flows are replaced as it is calculated.
+        sim_version = str(bson.ObjectId()) if args.versioned else None
+        if args.batch:
+            res = tasks.queue_flows_for_period(
+                start_date, end_date, sim_group, int(args.origins_per_task), sim_version)
+        else:
+            airports = [i['_id'] for i in db.airports.find()]
+            tasks.start_period_caching(db, sim_group, start_date, end_date, len(airports), sim_version)
+            airport_tasks = [
+                tasks.calculate_flows_for_airport.s(
+                    airport,
+                    start_date,
+                    end_date,
+                    sim_group,
+                    sim_version).set(queue=queue)
+                for airport in airports]
+            if args.versioned:
+                res = celery.chord(airport_tasks)(
+                    tasks.publish_flow_version.s(sim_group, sim_version).set(queue=queue))
+            else:
+                res = celery.group(*airport_tasks)()
+        print "Queued sims for", start_date, "on", queue
+        running_periods.append((start_date, res))
+        # Only a limited number of periods are simulated at once because aggregated direct flights
+        # are only kept in memory for a few periods. Routing each period's tasks to its own queue
+        # means a worker only needs the periods for the queues it consumes.
+        while len(running_periods) >= int(args.concurrent_periods):
+            wait_for_period(*running_periods.pop(0))
+    for running_period in running_periods:
+        wait_for_period(*running_period)
+
+
+def wait_for_period(start_date, res):
+    print "Waiting for sims to complete for:", start_date
+    result = res.get(timeout=None, interval=2.0)
+    if isinstance(result, dict):
+        print "Calculated flows for", result['origins'], "origins at", result['originsPerSecond'], "origins per second"
+
+
+def get_queue_depth(queue):
+    """
+    The number of messages waiting in a broker queue, or None if the broker cannot report it.
+    """
+    try:
+        with tasks.celery_tasks.connection() as connection:
+            return connection.default_channel.queue_declare(queue=queue, passive=True).message_count
+    except Exception:
+        return None
+
+
+def print_status():
+    """
+    Print each period's queue, the depth of the queue, the period's outstanding tasks
+    and the fraction of its tasks that found the period's direct flows cached in memory or on disk.
+    """
+    queue_depths = {}
+    for stats in db.cachingStats.find().sort('startDate'):
+        # Periods calculated locally have no queue, and ones recorded before the statistics
+        # were reset for each period may only have the task counts.
+        queue = stats.get('queue')
+        if queue is not None and queue not in queue_depths:
+            queue_depths[queue] = get_queue_depth(queue)
+        completed = stats.get('completedTasks', 0)
+        print stats['_id'], stats.get('startDate'), stats.get('endDate'), \
+            queue or ("local" if 'queue' in stats else "unknown queue")
+        if queue is not None:
+            print "    queue depth:", queue_depths[queue]
+        if stats.get('queuedTasks') is not None:
+            print "    outstanding tasks:", stats['queuedTasks'] - completed, "of", stats['queuedTasks']
+        if completed > 0:
+            print "    memory cache hit ratio:", float(stats.get('windowCacheHits', 0)) / completed
+            print "    disk cache hit ratio:", float(stats.get('diskCacheHits', 0)) / completed
 
 
 if __name__ == '__main__':
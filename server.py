@@ -6,14 +6,19 @@ import json
 import collections
 import motor
 import pymongo
+import pymongo.errors
+import pylru
 import tornado.web
 import tornado.ioloop
 import tornado.httpserver
+import tornado.concurrent
+import tornado.iostream
 from tornado.options import define, options
 from tornado import gen
 from bson import json_util
 from cerberus import Validator
 import datetime
+import time
 from simulator import tasks
 import celery
 
@@ -45,6 +50,20 @@ define('mongo_host', default=_mongo_host, help='mongo server hostname', type=str
 define('mongo_port', default=_mongo_port, help='mongo server port number', type=int)
 define('mongo_database', default=_mongo_db, help='mongo database name', type=str)
 define('node_collection', default='airports', help='mongo node collection name', type=str)
+define('node_refresh_interval', default=3600, help='seconds between reloads of the node collection', type=float)
+define('warmup_retry_interval', default=60, help='seconds to wait before retrying a failed warm up', type=float)
+define('progress_interval', default=1.0, help='seconds between checks for simulation progress when streaming it', type=float)
+define('progress_timeout', default=3600, help='seconds after which a simulation progress stream is ended '
+       'even if the simulation has not finished', type=float)
+define('claim_timeout', default=600, help='seconds after which a simulation that was claimed but never queued '
+       'may be claimed again', type=float)
+define('seat_count_cache_size', default=10000, help='number of airport outgoing seat counts to keep in memory', type=int)
+define('seat_count_cache_ttl', default=3600, help='seconds to keep airport outgoing seat counts in memory', type=float)
+define('results_cache_size', default=1000, help='number of simulation results to keep in memory', type=int)
+define('chunk_size', default=2000, help='the most passengers simulated by a single task', type=int)
+define('output_mode', default='itineraries', help='how simulation results are stored, either a '
+       'simulated_itineraries document per passenger (itineraries) or an aggregated_itineraries '
+       'document per origin and destination (aggregated)', type=str)
 
 class BaseHandler(tornado.web.RequestHandler):
     @property
@@ -59,8 +78,33 @@ class HomeHandler(BaseHandler):
     def get(self):
         self.write({'version':self.application.settings['version']})
 
+class SimulationValidator(Validator):
+    """ cerberus validator with a knownnodes rule that checks lists of nodes
+    against a set of node ids which can be replaced when the nodes are reloaded """
+    def __init__(self, *args, **kwargs):
+        self.nodes = kwargs.pop('nodes', frozenset())
+        super(SimulationValidator, self).__init__(*args, **kwargs)
+
+    def _validate_knownnodes(self, knownnodes, field, value):
+        if knownnodes and isinstance(value, list):
+            unknown_nodes = [node for node in value if node not in self.nodes]
+            if unknown_nodes:
+                self._error(field, 'unallowed values {0}'.format(unknown_nodes))
+
 class SimulationRecord():
     """ class that represents the mondoDB simulation document """
+    # the cerberus schema definition used for validation
+    SCHEMA = {
+        # _id will be assigned by mongo
+        'simId': { 'type': 'string', 'required': True},
+        'departureNodes': { 'type': 'list', 'required': True, 'minlength': 1, 'knownnodes': True, 'schema': {'type': 'string'}},
+        'numberPassengers': { 'type': 'integer', 'required': True},
+        'startDate': { 'type': 'datetime', 'required': True},
+        'endDate': { 'type': 'datetime', 'required': True},
+        'submittedBy': {'type': 'string', 'regex': '^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$', 'required': True},
+        'submittedTime': { 'type': 'datetime', 'required': True},
+        'notificationEmail': { 'type': 'string', 'regex': '^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$', 'required': False}}
+
     @property
     def post_parameters(self):
         """ list of items that are expected via post"""
@@ -69,27 +113,19 @@ class SimulationRecord():
     @property
     def schema(self):
         """ the cerberus schema definition used for validation """
-        return {
-            # _id will be assigned by mongo
-            'simId': { 'type': 'string', 'required': True},
-            'departureNodes': { 'type': 'list', 'required': True, 'minlength': 1, 'allowed': self.nodes, 'schema': {'type': 'string'}},
-            'numberPassengers': { 'type': 'integer', 'required': True},
-            'startDate': { 'type': 'datetime', 'required': True},
-            'endDate': { 'type': 'datetime', 'required': True},
-            'submittedBy': {'type': 'string', 'regex': '^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$', 'required': True},
-            'submittedTime': { 'type': 'datetime', 'required': True},
-            'notificationEmail': { 'type': 'string', 'regex': '^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$', 'required': False}}
-
-    def __init__(self, nodes):
-        self.nodes = nodes
+        return self.SCHEMA
+
+    def __init__(self, validator):
+        """ the validator is a SimulationValidator for the SCHEMA that is shared between records """
         self.fields = {} #collections.OrderedDict()
-        self.validator = Validator(self.schema)
+        self.validator = validator
 
     def gen_key(self):
         """ generate a unique key for this record """
         h = hashlib.md5()
         try:
-            h.update(str(self.fields['departureNodes']))
+            # the departure nodes are sorted so requests listing them in different orders share a key
+            h.update(str(sorted(self.fields['departureNodes'])))
             h.update(str(self.fields['numberPassengers']))
             h.update(str(self.fields['startDate']))
             h.update(str(self.fields['endDate']))
@@ -236,96 +272,187 @@ class SimulationRecord():
         else:
             return False
 
+@gen.coroutine
+def aggregate_outgoing_seat_counts(db, airports, start_date, end_date):
+    """ estimate the total seats on the legs departing from each of the airports
+    between the start and end dates """
+    cursor = db.legs.aggregate([
+        {
+            '$match' : {
+                'departureAirport._id' : {
+                    '$in' : airports
+                },
+                'effectiveDate': {
+                    "$lte" : end_date
+                },
+                'discontinuedDate': {
+                    "$gte" : start_date
+                }
+            }
+        }, {
+            '$project' : {
+                'departureAirport._id' : 1,
+                'totalSeats' : 1,
+                'weeklyFrequency' : {
+                    '$sum': [
+                        { '$cond': [ '$day1', 1, 0 ] },
+                        { '$cond': [ '$day2', 1, 0 ] },
+                        { '$cond': [ '$day3', 1, 0 ] },
+                        { '$cond': [ '$day4', 1, 0 ] },
+                        { '$cond': [ '$day5', 1, 0 ] },
+                        { '$cond': [ '$day6', 1, 0 ] },
+                        { '$cond': [ '$day7', 1, 0 ] },
+                    ]
+                },
+                'weeklyRepeats' : {
+                    '$let' : {
+                        'vars' : {
+                            'millisStartToEnd' : {
+                                '$subtract': [
+                                    { '$min' : [
+                                        end_date,
+                                        '$discontinuedDate'
+                                        ] },
+                                    { '$max' : [
+                                        start_date,
+                                        '$effectiveDate'
+                                        ] }
+                                ]
+                            }
+                        },
+                        'in' : {
+                            '$divide' : [
+                                {
+                                    '$add' : [
+                                        '$$millisStartToEnd',
+                                        # one day in milliseconds to
+                                        # account for the end day.
+                                        24 * 60 * 60 * 1000
+                                    ]
+                                },
+                                # one week in milliseconds
+                                7 * 24 * 60 * 60 * 1000
+                            ]
+                        }
+                    }
+                }
+            }
+        }, {
+            '$group' : {
+                '_id' : '$departureAirport._id',
+                # This is an aproximation because only the fraction of
+                # days the flight runs on in the start/end weeks is
+                # computed rather than counting how many days the flight
+                # is schedule on that occur before/afer the day of the
+                # week that the flight starts/ends on.
+                'totalSeats' : {
+                    '$sum' : { '$multiply' : ['$totalSeats', '$weeklyFrequency', '$weeklyRepeats'] }
+                }
+            }
+        }
+    ])
+    docs = yield cursor.to_list(None)
+    raise gen.Return({doc['_id']: doc['totalSeats'] for doc in docs})
+
+class SeatCountCache(object):
+    """ caches the outgoing seat counts of airports for date ranges for ttl seconds.
+    Airports are looked up individually so requests for different sets of airports
+    can share cached counts, and concurrent requests for the same airport and dates
+    wait for the same aggregation rather than starting another one. """
+    def __init__(self, size, ttl):
+        self.seat_counts = pylru.lrucache(size)
+        self.ttl = ttl
+        self.pending = {}
+
+    @gen.coroutine
+    def get(self, db, airports, start_date, end_date):
+        seat_counts = {}
+        pending = {}
+        missing = []
+        now = time.time()
+        for airport in set(airports):
+            key = (airport, start_date, end_date)
+            cached = self.seat_counts.get(key)
+            if cached is not None and cached[0] > now:
+                seat_counts[airport] = cached[1]
+            elif key in self.pending:
+                pending[airport] = self.pending[key]
+            else:
+                missing.append(airport)
+        if missing:
+            future = tornado.concurrent.Future()
+            for airport in missing:
+                self.pending[(airport, start_date, end_date)] = future
+            try:
+                counts = yield aggregate_outgoing_seat_counts(db, missing, start_date, end_date)
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            finally:
+                for airport in missing:
+                    del self.pending[(airport, start_date, end_date)]
+            expiration_time = time.time() + self.ttl
+            for airport in missing:
+                seat_counts[airport] = counts.get(airport, 0)
+                self.seat_counts[(airport, start_date, end_date)] = (expiration_time, seat_counts[airport])
+            future.set_result(counts)
+        for airport, future in pending.items():
+            counts = yield future
+            seat_counts[airport] = counts.get(airport, 0)
+        raise gen.Return(seat_counts)
+
+@gen.coroutine
+def get_destination_counts(db, simulation):
+    """ count the passengers that have ended up at each destination in a simulation so far """
+    if simulation.get('outputMode') == 'aggregated':
+        collection = db.aggregated_itineraries
+        count = '$count'
+    else:
+        collection = db.simulated_itineraries
+        count = 1
+    docs = yield collection.aggregate([
+        {
+            '$match': {
+                'simulationId': simulation['simId']
+            }
+        }, {
+            '$group': {
+                '_id': '$destination',
+                'count': {
+                    '$sum': count
+                }
+            }
+        }
+    ]).to_list(None)
+    raise gen.Return({doc['_id']: doc['count'] for doc in docs})
+
+def tasks_finished(simulation, progress):
+    """ whether all of a queued simulation's tasks have finished according to its
+    simulation_progress document. Simulations queued before progress was recorded,
+    which is when the chunk size started being recorded as well, never get one. """
+    if progress is None:
+        return 'chunkSize' not in simulation or not simulation.get('taskIds')
+    finished_tasks = progress.get('completedTasks', 0) + progress.get('failedTasks', 0)
+    return finished_tasks >= len(simulation.get('taskIds') or [])
+
 class SimulationHandler(BaseHandler):
     @tornado.web.asynchronous
     def post(self):
         logging.info("Simulation request received")
         outgoing_seat_counts = {}
         def get_outgoing_seat_counts(callback):
-            cursor = self.db.legs.aggregate([
-                {
-                    '$match' : {
-                        'departureAirport._id' : {
-                            '$in' : self.simulationRecord.fields['departureNodes']
-                        },
-                        'effectiveDate': {
-                            "$lte" : self.simulationRecord.fields['endDate']
-                        },
-                        'discontinuedDate': {
-                            "$gte" : self.simulationRecord.fields['startDate']
-                        }
-                    }
-                }, {
-                    '$project' : {
-                        'departureAirport._id' : 1,
-                        'totalSeats' : 1,
-                        'weeklyFrequency' : {
-                            '$sum': [
-                                { '$cond': [ '$day1', 1, 0 ] },
-                                { '$cond': [ '$day2', 1, 0 ] },
-                                { '$cond': [ '$day3', 1, 0 ] },
-                                { '$cond': [ '$day4', 1, 0 ] },
-                                { '$cond': [ '$day5', 1, 0 ] },
-                                { '$cond': [ '$day6', 1, 0 ] },
-                                { '$cond': [ '$day7', 1, 0 ] },
-                            ]
-                        },
-                        'weeklyRepeats' : {
-                            '$let' : {
-                                'vars' : {
-                                    'millisStartToEnd' : {
-                                        '$subtract': [
-                                            { '$min' : [
-                                                self.simulationRecord.fields['endDate'],
-                                                '$discontinuedDate'
-                                                ] },
-                                            { '$max' : [
-                                                self.simulationRecord.fields['startDate'],
-                                                '$effectiveDate'
-                                                ] }
-                                        ]
-                                    }
-                                },
-                                'in' : {
-                                    '$divide' : [
-                                        {
-                                            '$add' : [
-                                                '$$millisStartToEnd',
-                                                # one day in milliseconds to
-                                                # account for the end day.
-                                                24 * 60 * 60 * 1000
-                                            ]
-                                        },
-                                        # one week in milliseconds
-                                        7 * 24 * 60 * 60 * 1000
-                                    ]
-                                }
-                            }
-                        }
-                    }
-                }, {
-                    '$group' : {
-                        '_id' : '$departureAirport._id',
-                        # This is an aproximation because only the fraction of
-                        # days the flight runs on in the start/end weeks is
-                        # computed rather than counting how many days the flight
-                        # is schedule on that occur before/afer the day of the
-                        # week that the flight starts/ends on.
-                        'totalSeats' : {
-                            '$sum' : { '$multiply' : ['$totalSeats', '$weeklyFrequency', '$weeklyRepeats'] }
-                        }
-                    }
-                }
-            ])
-            def _aggregation_complete(docs, err):
-                if err:
-                    logging.info("Error:")
-                    logging.info(err)
-                    raise err
-                for doc in docs:
-                    outgoing_seat_counts[doc['_id']] = doc['totalSeats']
+            def _seat_counts_complete(future):
+                try:
+                    outgoing_seat_counts.update(future.result())
+                except Exception as e:
+                    _release_claim(e)
+                    return
                 callback()
-            cursor.to_list(None, callback=_aggregation_complete)
+            tornado.ioloop.IOLoop.current().add_future(self.application.seat_count_cache.get(
+                self.db,
+                self.simulationRecord.fields['departureNodes'],
+                self.simulationRecord.fields['startDate'],
+                self.simulationRecord.fields['endDate']), _seat_counts_complete)
 
         def _queue_simulation():
             # get parameters for the job(s)
@@ -346,50 +473,140 @@ class SimulationHandler(BaseHandler):
             start = str(self.simulationRecord.fields['startDate'])
             end = str(self.simulationRecord.fields['endDate'])
             email = self.simulationRecord.fields.get('notificationEmail', None)
+            # The simId is an md5 hex digest, so part of it can seed the simulation reproducibly.
+            sim_seed = int(sim_id[:8], 16)
             arg_list = []
-            for node in self.simulationRecord.fields['departureNodes']:
+            for node_idx, node in enumerate(self.simulationRecord.fields['departureNodes']):
                 node_passengers = int(round(float(num_passengers * outgoing_seat_counts.get(node, 0)) / total_seat_count))
-                arg_list.append({'origin_airport_id': node, 'number_of_passengers': node_passengers})
+                # Split each node's passengers into chunks so the work for busy airports
+                # is spread across the workers. Each chunk gets its own random number stream.
+                for chunk_idx, chunk_start in enumerate(range(0, node_passengers, options.chunk_size)):
+                    arg_list.append({
+                        'origin_airport_id': node,
+                        'number_of_passengers': min(options.chunk_size, node_passengers - chunk_start),
+                        'seed': [sim_seed, node_idx, chunk_idx]
+                    })
+            if len(arg_list) == 0:
+                logging.info("No passengers for the given airports:")
+                logging.info(self.simulationRecord.fields['departureNodes'])
+                return
             #take all of the args from art_list and use them to create a chord of tasks for calls to simulate_passengers
             res = celery.chord(
-                tasks.simulate_passengers.s(sim_id,i['origin_airport_id'],i['number_of_passengers'],start,end)
+                tasks.simulate_passengers.s(sim_id,i['origin_airport_id'],i['number_of_passengers'],start,end,
+                                            output_mode=options.output_mode, seed=i['seed'],
+                                            chunk_size=options.chunk_size)
                 for i in arg_list
-                )(tasks.callback.s(email, sim_id))
+                )(tasks.callback.s(email, sim_id, output_mode=options.output_mode, chunk_size=options.chunk_size))
             task_ids = [task.id for task in res.parent.results]
             logging.info('simId: %s, task_ids: %r', sim_id, task_ids)
             return task_ids
 
-        def _on_insert(message, error):
+        def _write_error(error):
+            logging.error('error: %r', error)
+            self.write({
+                'error': True,
+                'message': 'database error'
+            })
+            self.finish()
+
+        def _release_claim(error):
+            # Remove the claimed record so the simulation can be requested again
+            # and fail the requests waiting for it.
+            sim_id = self.simulationRecord.fields['simId']
+            self.db.simulations.delete_one({
+                'simId': sim_id,
+                'status': 'pending',
+                'claimedTime': self.simulationRecord.fields['claimedTime']
+            })
+            self.application.pending_simulations.pop(sim_id).set_exception(error)
+            _write_error(error)
+
+        def _on_update(message, error):
+            sim_id = self.simulationRecord.fields['simId']
             if error:
-                logging.error('error: %r', error)
-                self.write({
-                    'error': True,
-                    'message': 'database error'
-                })
-                self.finish()
+                _release_claim(error)
                 return
+            self.application.pending_simulations.pop(sim_id).set_result(sim_id)
+            self.write({'simId': sim_id})
+            self.finish()
 
-            self.write({'simId': self.simulationRecord.fields['simId']})
+        def _seat_counts_gotten():
+            try:
+                task_ids = _queue_simulation()
+            except Exception as e:
+                _release_claim(e)
+                return
+            update = {
+                'taskIds': task_ids,
+                'chunkSize': options.chunk_size,
+                'status': 'queued'
+            }
+            if not task_ids:
+                # Nothing was queued, so there is nothing to wait for.
+                update['status'] = 'complete'
+                update['completedTime'] = datetime.datetime.utcnow()
+            self.db.simulations.update_one({'simId': self.simulationRecord.fields['simId']}, {
+                '$set': update
+            }, callback=_on_update)
+
+        def _on_claimed_by_another_process():
+            # Respond to the identical requests waiting on this one's claim as well.
+            sim_id = self.simulationRecord.fields['simId']
+            self.application.pending_simulations.pop(sim_id).set_result(sim_id)
+            self.write({'simId': sim_id})
             self.finish()
 
-        def _on_find(message, error):
+        def _on_retake(message, error):
+            if not error and message.modified_count == 0:
+                # The other process's claim has not expired or it was retaken by yet another process.
+                _on_claimed_by_another_process()
+                return
+            _on_claim(message, error)
+
+        def _on_claim(message, error):
+            sim_id = self.simulationRecord.fields['simId']
+            if isinstance(error, pymongo.errors.DuplicateKeyError):
+                # The simulation has already been requested by another process.
+                # If that process claimed it too long ago to still be queuing it,
+                # it probably died before doing so and the claim is taken over.
+                expired_time = self.simulationRecord.fields['claimedTime'] - datetime.timedelta(seconds=options.claim_timeout)
+                self.db.simulations.update_one({
+                    'simId': sim_id,
+                    'status': 'pending',
+                    '$or': [
+                        {'claimedTime': {'$lt': expired_time}},
+                        # records claimed before claim times were stored
+                        {'claimedTime': {'$exists': False}, 'submittedTime': {'$lt': expired_time}}
+                    ]
+                }, {
+                    '$set': {key: value for key, value in self.simulationRecord.fields.items() if key != '_id'}
+                }, callback=_on_retake)
+                return
             if error:
-                logging.error('error: %r', error)
-                self.write({
-                    'error': True,
-                    'message': 'database error'
-                })
-                self.finish()
+                self.application.pending_simulations.pop(sim_id).set_exception(error)
+                _write_error(error)
                 return
-            if message:
-                self.write({'simId': message['simId']})
-                self.finish()
-            else:
-                def _seat_counts_gotten():
-                    self.simulationRecord.fields['taskIds'] = _queue_simulation()
-                    self.db.simulations.insert(self.simulationRecord.fields, callback=_on_insert)
-                get_outgoing_seat_counts(callback=_seat_counts_gotten)
-        self.simulationRecord = SimulationRecord(self.nodes)
+            get_outgoing_seat_counts(callback=_seat_counts_gotten)
+
+        def _on_pending_simulation_queued(future):
+            try:
+                self.write({'simId': future.result()})
+            except Exception as e:
+                _write_error(e)
+                return
+            self.finish()
+
+        if not self.application.ready:
+            # Simulations are not accepted until the nodes are loaded and the workers have warmed up.
+            self.set_status(503)
+            self.write({
+                'error': True,
+                'message': 'the server is starting up',
+                'warmup': self.application.warmup_state
+            })
+            self.finish()
+            return
+        self.simulationRecord = SimulationRecord(self.application.validator)
         self.simulationRecord.create(self)
         if not self.simulationRecord.is_valid():
             self.write({
@@ -400,14 +617,197 @@ class SimulationHandler(BaseHandler):
             self.finish()
             return
 
-        self.db.simulations.find_one({'simId': self.simulationRecord.fields['simId']}, callback=_on_find)
+        sim_id = self.simulationRecord.fields['simId']
+        pending_simulation = self.application.pending_simulations.get(sim_id)
+        if pending_simulation is not None:
+            # An identical request is being queued by this process, so respond once it has been.
+            tornado.ioloop.IOLoop.current().add_future(pending_simulation, _on_pending_simulation_queued)
+            return
+        # Claim the simulation by inserting its record before queuing it. The unique index
+        # on simId makes identical requests handled by other processes fail to insert it.
+        self.application.pending_simulations[sim_id] = tornado.concurrent.Future()
+        self.simulationRecord.fields['status'] = 'pending'
+        self.simulationRecord.fields['claimedTime'] = datetime.datetime.utcnow()
+        self.simulationRecord.fields['outputMode'] = options.output_mode
+        self.db.simulations.insert_one(self.simulationRecord.fields, callback=_on_claim)
         return
 
+class ReadyHandler(BaseHandler):
+    """ reports whether the nodes are loaded and the simulator has warmed up,
+    responding with 503 until it is ready """
+    def get(self):
+        refreshed_time = self.application.nodes_refreshed_time
+        if not self.application.ready:
+            self.set_status(503)
+        self.write({
+            'ready': self.application.ready,
+            'warmup': self.application.warmup_state,
+            'warmupError': self.application.warmup_error,
+            'nodes': len(self.application.nodes),
+            'nodesRefreshedTime': refreshed_time.isoformat() if refreshed_time else None
+        })
+
+class SimulationResultsHandler(BaseHandler):
+    """
+    Returns the number and fraction of a finished simulation's passengers
+    that ended up at each destination. The results are computed when the
+    simulation's tasks finish and they do not change afterwards, so they are kept
+    in an in-process LRU cache along with their ETag for conditional requests.
+    The results of finished simulations that do not have them, such as those
+    queued before results were stored, are computed from their itineraries
+    and stored when they are first requested.
+    """
+    def initialize(self):
+        self.etag = None
+
+    def compute_etag(self):
+        return self.etag
+
+    @gen.coroutine
+    def store_results(self, simulation):
+        """ count a finished simulation's passengers for each destination from its itineraries
+        and store the results like the simulation's callback does """
+        counts = yield get_destination_counts(self.db, simulation)
+        total_passengers = sum(counts.values())
+        results = {
+            'simId': simulation['simId'],
+            'totalPassengers': total_passengers,
+            'destinations': {
+                destination: {
+                    'count': count,
+                    'fraction': float(count) / total_passengers
+                } for destination, count in counts.items()},
+            'chunks': len(simulation.get('taskIds') or []),
+            'chunkSize': simulation.get('chunkSize')
+        }
+        yield self.db.simulation_results.replace_one({'_id': simulation['simId']}, dict(results, **{
+            'completedTime': datetime.datetime.utcnow()
+        }), upsert=True)
+        raise gen.Return(results)
+
+    @gen.coroutine
+    def get(self, sim_id):
+        cached = self.application.results_cache.get(sim_id)
+        if cached is None:
+            results = yield self.db.simulation_results.find_one({'_id': sim_id}, {'_id': 0, 'completedTime': 0})
+            if results is None:
+                simulation = yield self.db.simulations.find_one({'simId': sim_id})
+                if simulation is None:
+                    self.set_status(404)
+                    self.write({
+                        'error': True,
+                        'message': 'simulation not found'
+                    })
+                    return
+                progress = yield self.db.simulation_progress.find_one({'_id': sim_id})
+                if simulation.get('status') == 'pending' or not tasks_finished(simulation, progress):
+                    self.set_status(202)
+                    self.write({
+                        'simId': sim_id,
+                        'complete': False
+                    })
+                    return
+                results = yield self.store_results(simulation)
+            results['complete'] = True
+            body = json.dumps(results)
+            cached = ('"' + hashlib.md5(body).hexdigest() + '"', body)
+            self.application.results_cache[sim_id] = cached
+        self.etag, body = cached
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        # The ETag header is set and checked against If-None-Match by finish,
+        # which responds with 304 Not Modified when they match.
+        self.write(body)
+
+class SimulationProgressHandler(BaseHandler):
+    """
+    Streams a simulation's progress as server-sent events. A progress event is sent
+    whenever more passengers have been simulated with the numbers of finished tasks
+    and simulated passengers, and the passenger counts and fractions for each destination
+    so far. The stream ends with a complete event once every task has finished or the
+    simulation's results have been stored, or with a timeout event after progress_timeout seconds.
+    """
+    def initialize(self):
+        self.connection_closed = False
+
+    def on_connection_close(self):
+        self.connection_closed = True
+
+    @gen.coroutine
+    def get(self, sim_id):
+        simulation = yield self.db.simulations.find_one({'simId': sim_id})
+        if simulation is None:
+            self.set_status(404)
+            self.write({
+                'error': True,
+                'message': 'simulation not found'
+            })
+            return
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        while simulation.get('status') == 'pending' and not self.connection_closed:
+            # The simulation's tasks are still being queued.
+            claimed_time = simulation.get('claimedTime', simulation.get('submittedTime'))
+            if claimed_time < datetime.datetime.utcnow() - datetime.timedelta(seconds=options.claim_timeout):
+                # The process that claimed the simulation did not queue it in time,
+                # so it will only be run if it is requested again.
+                self.write('event: error\ndata: {0}\n\n'.format(json.dumps({
+                    'simId': sim_id,
+                    'message': 'the simulation was not queued'
+                })))
+                return
+            yield gen.sleep(options.progress_interval)
+            simulation = yield self.db.simulations.find_one({'simId': sim_id})
+            if simulation is None:
+                return
+        total_tasks = len(simulation.get('taskIds') or [])
+        last_simulated_passengers = None
+        end_time = time.time() + options.progress_timeout
+        while not self.connection_closed:
+            progress = yield self.db.simulation_progress.find_one({'_id': sim_id})
+            complete = tasks_finished(simulation, progress)
+            if not complete:
+                # The callback stores the results once the simulation has finished,
+                # even if some of its tasks did not record their progress.
+                results = yield self.db.simulation_results.find_one({'_id': sim_id}, {'_id': 1})
+                complete = results is not None
+            progress = progress or {}
+            simulated_passengers = progress.get('simulatedPassengers', 0)
+            if simulated_passengers != last_simulated_passengers or complete:
+                last_simulated_passengers = simulated_passengers
+                counts = yield get_destination_counts(self.db, simulation)
+                total_count = sum(counts.values())
+                self.write('event: {0}\ndata: {1}\n\n'.format('complete' if complete else 'progress', json.dumps({
+                    'simId': sim_id,
+                    'totalTasks': total_tasks,
+                    'completedTasks': progress.get('completedTasks', 0),
+                    'failedTasks': progress.get('failedTasks', 0),
+                    'numberPassengers': simulation['numberPassengers'],
+                    'simulatedPassengers': simulated_passengers,
+                    'destinations': {
+                        destination: {
+                            'count': count,
+                            'fraction': float(count) / total_count
+                        } for destination, count in counts.items()}
+                })))
+                try:
+                    yield self.flush()
+                except tornado.iostream.StreamClosedError:
+                    return
+            if complete:
+                return
+            if time.time() > end_time:
+                self.write('event: timeout\ndata: {0}\n\n'.format(json.dumps({'simId': sim_id})))
+                return
+            yield gen.sleep(options.progress_interval)
+
 class Application(tornado.web.Application):
     def __init__(self):
         handlers = [
             (r"/", HomeHandler),
+            (r"/ready", ReadyHandler),
             (r"/simulator", SimulationHandler),
+            (r"/simulator/([^/]+)", SimulationResultsHandler),
+            (r"/simulator/([^/]+)/progress", SimulationProgressHandler),
         ]
         settings = dict(
             version='0.0.1',
@@ -424,38 +824,79 @@ class Application(tornado.web.Application):
         self.db.simulations.create_index([
             ("simId", pymongo.ASCENDING)
         ], unique=True, name="idxSimulations_simId")
+        self.db.simulated_itineraries.create_index([
+            ("simulationId", pymongo.ASCENDING)
+        ], name="idxSimulatedItineraries_simulationId")
+
+        self.results_cache = pylru.lrucache(options.results_cache_size)
+        # Futures for the simulations being queued by this process by simId
+        self.pending_simulations = {}
+        self.seat_count_cache = SeatCountCache(options.seat_count_cache_size, options.seat_count_cache_ttl)
+
+        self.nodes = frozenset()
+        self.nodes_loaded = False
+        self.nodes_refreshed_time = None
+        self.validator = SimulationValidator(SimulationRecord.SCHEMA)
+        self.warmup_state = 'pending'
+        self.warmup_error = None
+        # Start listening right away and load the nodes and warm up the simulator in the background.
+        ioloop = tornado.ioloop.IOLoop.current()
+        ioloop.spawn_callback(self.refresh_nodes)
+        ioloop.spawn_callback(self.warm_up)
+        tornado.ioloop.PeriodicCallback(self.refresh_nodes, options.node_refresh_interval * 1000).start()
+        super(Application, self).__init__(handlers, **settings)
 
-        self.nodes = []
-        @gen.coroutine
-        def get_nodes():
+    @gen.coroutine
+    def refresh_nodes(self):
+        """ reload the set of node ids that simulations may depart from """
+        try:
+            nodes = set()
             cursor = self.db[options.node_collection].find({}, {'_id': 1})
             while (yield cursor.fetch_next):
                 doc = cursor.next_object()
-                self.nodes.append(doc['_id'])
-        # Run a couple sims on start up to warm up the simulator
+                nodes.add(doc['_id'])
+        except Exception as e:
+            logging.error('error loading nodes: %r', e)
+            return
+        self.nodes = self.validator.nodes = frozenset(nodes)
+        self.nodes_loaded = True
+        self.nodes_refreshed_time = datetime.datetime.utcnow()
+        logging.info('Ready to simulate [%s] nodes', len(self.nodes))
+
+    @gen.coroutine
+    def warm_up(self):
+        """ run a couple sims to warm up the simulator, retrying until they succeed """
         start_date = datetime.datetime.now()
         end_date = start_date + datetime.timedelta(7)
-        warmup_result = celery.group(
-            tasks.simulate_passengers.s(
-                'warmup',
-                'LAX',
-                200,
-                start_date.strftime('%Y-%m-%d'),
-                end_date.strftime('%Y-%m-%d')
-            ),
-            tasks.simulate_passengers.s(
-                'warmup',
-                'ATL',
-                200,
-                start_date.strftime('%Y-%m-%d'),
-                end_date.strftime('%Y-%m-%d')
-            )
-        )()
-        # Wait for warmup sims to finish.
-        warmup_result.get(timeout=None, interval=2.0)
-        tornado.ioloop.IOLoop.current().run_sync(get_nodes)
-        logging.info('Ready to simulate [%s] nodes', len(self.nodes))
-        super(Application, self).__init__(handlers, **settings)
+        while True:
+            self.warmup_state = 'running'
+            try:
+                warmup_result = celery.group(
+                    tasks.simulate_passengers.s(
+                        'warmup',
+                        airport,
+                        200,
+                        start_date.strftime('%Y-%m-%d'),
+                        end_date.strftime('%Y-%m-%d')
+                    ) for airport in ['LAX', 'ATL']
+                )()
+                while not warmup_result.ready():
+                    yield gen.sleep(2.0)
+                warmup_result.get()
+            except Exception as e:
+                logging.error('warm up failed: %r', e)
+                self.warmup_state = 'failed'
+                self.warmup_error = str(e)
+                yield gen.sleep(options.warmup_retry_interval)
+            else:
+                logging.info('Warm up complete')
+                self.warmup_state = 'complete'
+                self.warmup_error = None
+                return
+
+    @property
+    def ready(self):
+        return self.nodes_loaded and self.warmup_state == 'complete'
 
 def main():
     tornado.options.parse_command_line()
@@ -10,12 +10,19 @@ given our knowledge of the air traffic network.
 import pymongo
 from dateutil import parser as dateparser
 import datetime
-from geopy.distance import great_circle
+from geopy.distance import EARTH_RADIUS
 import math
+import bisect
 import random
-from pylru import lrudecorator
+from pylru import lrudecorator, lrucache
 from collections import defaultdict
 import numpy
+import time
+import os
+import json
+import multiprocessing
+import shutil
+import tempfile
 
 # Paramters derived from fit_flight_parameters.py
 A_load_ratio = 0.000861
@@ -29,7 +36,8 @@ def compute_direct_seat_flows(db, match_query):
         }, {
             '$group': {
                 '_id': {
-                    '$concat': ['$departureAirport', '-', '$arrivalAirport']
+                    'departureAirport': '$departureAirport',
+                    'arrivalAirport': '$arrivalAirport'
                 },
                 'totalSeats': {
                     '$sum': '$totalSeats'
@@ -38,8 +46,7 @@ def compute_direct_seat_flows(db, match_query):
         }
     ]):
         if pair['totalSeats'] > 0:
-            origin, destination = pair['_id'].split('-')
-            result[origin][destination] = pair['totalSeats']
+            result[pair['_id']['departureAirport']][pair['_id']['arrivalAirport']] = pair['totalSeats']
     return result
 
 
@@ -53,7 +60,8 @@ def compute_direct_passenger_flows(
         }, {
             '$group': {
                 '_id': {
-                    '$concat': ['$departureAirport', '-', '$arrivalAirport']
+                    'departureAirport': '$departureAirport',
+                    'arrivalAirport': '$arrivalAirport'
                 },
                 'totalPassengers': {
                     '$sum': {
@@ -75,25 +83,288 @@ def compute_direct_passenger_flows(
         }
     ]):
         if pair['totalPassengers'] > 0:
-            origin, destination = pair['_id'].split('-')
-            result[origin][destination] = pair['totalPassengers']
+            result[pair['_id']['departureAirport']][pair['_id']['arrivalAirport']] = pair['totalPassengers']
     return result
 
-def compute_airport_distances(airport_to_coords_items):
+class FlowMatrixRow(object):
     """
+    The flows from a single origin in a FlowMatrix. It behaves like a read-only dict
+    mapping destinations to flows that lists them in the order they were stored in.
+    """
+    __slots__ = ['airport_names', 'destination_codes', 'flows']
+
+    def __init__(self, airport_names, destination_codes, flows):
+        self.airport_names = airport_names
+        self.destination_codes = destination_codes
+        self.flows = flows
+
+    def keys(self):
+        return self.airport_names[self.destination_codes].tolist()
+
+    def values(self):
+        return self.flows.tolist()
+
+    def items(self):
+        return zip(self.keys(), self.values())
+
+    def __len__(self):
+        return len(self.destination_codes)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, destination):
+        return destination in self.keys()
+
+    def __getitem__(self, destination):
+        for key, value in self.items():
+            if key == destination:
+                return value
+        raise KeyError(destination)
+
+    def get(self, destination, default=None):
+        try:
+            return self[destination]
+        except KeyError:
+            return default
+
+
+class FlowMatrix(object):
+    """
+    A read-only origin to destination flow matrix stored as compressed sparse row arrays.
+    It can be used in place of the dicts of dicts returned by compute_direct_seat_flows
+    and compute_direct_passenger_flows, and it can be saved to a directory and memory-mapped
+    from it so that several processes can share one copy of it.
+    Origins without any flows have empty rows.
+    """
+    ARRAY_NAMES = ['row_starts', 'destination_codes', 'flows']
+
+    def __init__(self, airports, arrays):
+        """
+        :param airports: The airports the rows and destination codes refer to.
+        :param arrays: A dict with an array for each of the ARRAY_NAMES. The flows from the airport
+          at position i are in the slice row_starts[i]:row_starts[i + 1] of destination_codes and flows.
+        """
+        self.airports = airports
+        self.airport_names = numpy.array(airports, dtype=object)
+        self.airport_positions = {airport: position for position, airport in enumerate(airports)}
+        for name in self.ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def from_dicts(cls, flows):
+        """
+        :param flows: A dict mapping origins to dicts mapping destinations to flows.
+        """
+        airport_positions = {}
+        for origin, destination_flows in flows.items():
+            airport_positions.setdefault(origin, len(airport_positions))
+            for destination in destination_flows:
+                airport_positions.setdefault(destination, len(airport_positions))
+        airports = sorted(airport_positions, key=airport_positions.get)
+        row_starts = [0]
+        destination_codes = []
+        row_flows = []
+        for airport in airports:
+            for destination, flow in flows.get(airport, {}).items():
+                destination_codes.append(airport_positions[destination])
+                row_flows.append(flow)
+            row_starts.append(len(destination_codes))
+        return cls(airports, {
+            'row_starts': numpy.array(row_starts, dtype=numpy.int64),
+            'destination_codes': numpy.array(destination_codes, dtype=numpy.int32),
+            'flows': numpy.array(row_flows, dtype=float)
+        })
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'airports.json')) as f:
+            airports = json.load(f)
+        return cls(airports, {
+            name: numpy.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+            for name in cls.ARRAY_NAMES})
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in self.ARRAY_NAMES:
+            numpy.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'airports.json'), 'w') as f:
+            json.dump(self.airports, f)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.ARRAY_NAMES)
+
+    def __getitem__(self, origin):
+        position = self.airport_positions.get(origin)
+        if position is None:
+            start = end = 0
+        else:
+            start = self.row_starts[position]
+            end = self.row_starts[position + 1]
+        return FlowMatrixRow(self.airport_names, self.destination_codes[start:end], self.flows[start:end])
+
+    def get(self, origin, default=None):
+        if origin in self:
+            return self[origin]
+        return default
+
+    def keys(self):
+        return [airport for position, airport in enumerate(self.airports)
+                if self.row_starts[position + 1] > self.row_starts[position]]
+
+    def items(self):
+        return [(origin, self[origin]) for origin in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, origin):
+        position = self.airport_positions.get(origin)
+        return position is not None and self.row_starts[position + 1] > self.row_starts[position]
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __nonzero__(self):
+        return len(self.destination_codes) > 0
+
+
+def get_directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(directory, filename))
+        for directory, noop, filenames in os.walk(path)
+        for filename in filenames)
+
+
+class FlowMatrixCache(object):
+    """
+    A size-bounded directory of saved FlowMatrices.
+    Cached matrices are memory-mapped rather than read into memory when they are loaded.
+    When the saved matrices take up more than max_bytes the least recently used ones are deleted.
+    The hit and miss counts are for the current process.
+    """
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    @staticmethod
+    def key(start_date, end_date, A_load_ratio_p=A_load_ratio, b_load_ratio_p=b_load_ratio, version=None):
+        """
+        A directory name identifying the direct passenger flows between the given dates
+        that were computed with the given load ratio parameters.
+        The version identifies the flights they were computed from, so flows cached before
+        the flights changed are not used. Entries for earlier versions are evicted as they age.
+        """
+        key = 'flows-{0}-{1}-{2!r}-{3!r}'.format(
+            start_date.strftime('%Y%m%dT%H%M%S'), end_date.strftime('%Y%m%dT%H%M%S'),
+            A_load_ratio_p, b_load_ratio_p)
+        if version is not None:
+            key += '-' + str(version)
+        return key
+
+    def get(self, key, compute_flows):
+        """
+        Load the FlowMatrix cached under the key, or compute, cache and load it
+        when it is missing.
+        :param compute_flows: A function returning the flows as a dict of dicts.
+        """
+        entry_path = os.path.join(self.path, key)
+        if os.path.exists(entry_path):
+            try:
+                result = FlowMatrix.load(entry_path)
+            except (IOError, ValueError):
+                # The entry was deleted while it was being loaded or is incomplete.
+                shutil.rmtree(entry_path, ignore_errors=True)
+            else:
+                self.hits += 1
+                # The modification time is used as the last access time for eviction.
+                os.utime(entry_path, None)
+                return result
+        self.misses += 1
+        temp_path = os.path.join(self.path, '.tmp-{0}-{1}'.format(key, os.getpid()))
+        if os.path.exists(temp_path):
+            shutil.rmtree(temp_path)
+        FlowMatrix.from_dicts(compute_flows()).save(temp_path)
+        try:
+            os.rename(temp_path, entry_path)
+        except OSError:
+            # Another process cached the same flows first.
+            shutil.rmtree(temp_path)
+        self.evict(keep=key)
+        return FlowMatrix.load(entry_path)
+
+    def entries(self):
+        """
+        The cached keys and their sizes in bytes from the least to the most recently used.
+        """
+        keys = [key for key in os.listdir(self.path) if not key.startswith('.')]
+        keys.sort(key=lambda key: os.path.getmtime(os.path.join(self.path, key)))
+        return [(key, get_directory_size(os.path.join(self.path, key))) for key in keys]
+
+    def evict(self, keep=None):
+        """
+        Delete the least recently used entries other than keep until
+        the cache is within its byte budget.
+        """
+        entries = self.entries()
+        total_bytes = sum(size for key, size in entries)
+        for key, size in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total_bytes -= size
+
+    def stats(self):
+        entries = self.entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(entries),
+            'bytes': sum(size for key, size in entries)
+        }
+
+
+def compute_airport_distances(airport_to_coords_items, block_size=512):
+    """
+    Compute the great circle distances between every pair of airports.
+    This uses the same formula and earth radius as geopy's great_circle,
+    vectorized over blocks of rows. The results agree with great_circle
+    to within 1e-6 km.
+
     :param airport_to_coords_items: A array of airports and their coordinates alphabetically sorted by code.
+    :param block_size: The number of rows computed at once. This bounds the memory used for intermediate arrays.
     :return: A distance matrix where the row/column index corresponds to the index of the airport in the array.
     """
+    coords = numpy.radians(numpy.array(
+        [coords for airport, coords in airport_to_coords_items], dtype=float).reshape(-1, 2))
+    lngs = coords[:, 0]
+    lats = coords[:, 1]
+    sin_lats, cos_lats = numpy.sin(lats), numpy.cos(lats)
     dist_mat = numpy.zeros(shape=(len(airport_to_coords_items), len(airport_to_coords_items)))
-    for idx, (airport_a, (airport_a_long, airport_a_lat)) in enumerate(airport_to_coords_items):
-        j = idx
-        for airport_b, (airport_b_long, airport_b_lat) in airport_to_coords_items[idx:]:
-            dist_mat[idx, j] = great_circle(
-                (airport_a_lat, airport_a_long),
-                (airport_b_lat, airport_b_long)).kilometers
-            j += 1
-    # Make distance matrix symmetrical.
-    dist_mat += dist_mat.T
+    for start in range(0, len(airport_to_coords_items), block_size):
+        end = min(start + block_size, len(airport_to_coords_items))
+        # Only the upper triangle is computed, the lower triangle is copied from it
+        # so that the matrix is exactly symmetrical.
+        sin_lat1, cos_lat1 = sin_lats[start:end, None], cos_lats[start:end, None]
+        sin_lat2, cos_lat2 = sin_lats[start:], cos_lats[start:]
+        delta_lngs = lngs[None, start:] - lngs[start:end, None]
+        cos_delta_lngs = numpy.cos(delta_lngs)
+        block = EARTH_RADIUS * numpy.arctan2(
+            numpy.sqrt((cos_lat2 * numpy.sin(delta_lngs)) ** 2 +
+                       (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lngs) ** 2),
+            sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lngs)
+        diagonal_block = numpy.triu(block[:, :end - start], 1)
+        block[:, :end - start] = diagonal_block + diagonal_block.T
+        dist_mat[start:end, start:] = block
+        dist_mat[start:end, :start] = dist_mat[:start, start:end].T
     return dist_mat
 
 def is_logical(airport_distance_matrix, airport_a, airport_b, intermediate_airport):
@@ -105,24 +376,449 @@ def is_logical(airport_distance_matrix, airport_a, airport_b, intermediate_airpo
     return ib_distance < ab_distance or ia_distance < ab_distance
 
 
+def sequential_choice_probabilities(portions, continue_share, terminal_share):
+    """
+    The passenger simulations walk through the candidate destinations in order
+    drawing a random number for each one. The passenger continues their trip
+    from the candidate if the number is at most its ongoing portion, ends their trip
+    at it if the number is above one minus its terminal portion and otherwise
+    moves on to the next candidate. If every candidate is passed over the trip
+    ends at the last one.
+    This computes the overall probability of each of those outcomes so the
+    next step of many passengers can be sampled at once.
+
+    :param portions: The share of the outgoing seats/passengers that goes to each candidate.
+    :param continue_share: The fraction of a candidate's portion that continues on to another leg.
+    :param terminal_share: The fraction of a candidate's portion that ends its trip at the candidate.
+    :return: The probabilities of continuing on from each candidate, of ending the trip at each candidate
+      and of passing over every candidate.
+    """
+    portions = numpy.asarray(portions, dtype=float)
+    portion_so_far = numpy.concatenate(([0.0], numpy.cumsum(portions)[:-1]))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        conditional_portions = portions / (1.0 - portion_so_far)
+    # Once the preceding portions use up all of the flow the remaining
+    # candidates are certain to be chosen if they are reached.
+    conditional_portions[~numpy.isfinite(conditional_portions)] = 1.0
+    # Random numbers are drawn from [0, 1) so the probability of falling in
+    # each range is its length clipped to the unit interval.
+    continue_probs = numpy.clip(conditional_portions * continue_share, 0.0, 1.0)
+    terminal_probs = numpy.clip(
+        numpy.minimum(conditional_portions * terminal_share, 1.0 - continue_probs), 0.0, 1.0)
+    pass_probs = numpy.clip(1.0 - continue_probs - terminal_probs, 0.0, 1.0)
+    reach_probs = numpy.concatenate(([1.0], numpy.cumprod(pass_probs)))
+    return (
+        reach_probs[:-1] * continue_probs,
+        reach_probs[:-1] * terminal_probs,
+        reach_probs[-1])
+
+
+class LayoverWeightTable(object):
+    """
+    Weights flights by the number of whole hours a passenger would wait for them
+    using a precomputed table with a weight for each hour. Layovers longer than
+    the table get the weight of its last entry.
+    Calculators can be given any table, so other layover distributions can be tried
+    without computing them for every candidate flight.
+    """
+    def __init__(self, weights):
+        self.weights = numpy.asarray(weights, dtype=float)
+
+    @classmethod
+    def poisson(cls, mean_hours):
+        """
+        Tabulate the Poisson PMF for every number of hours until it underflows to zero.
+        The implementation is based on:
+        http://stackoverflow.com/questions/280797/calculate-poisson-probability-percentage
+        """
+        p = math.exp(-mean_hours)
+        weights = [p]
+        hours = 0
+        while p > 0:
+            p *= mean_hours
+            p /= hours + 1
+            weights.append(p)
+            hours += 1
+        return cls(weights)
+
+    def __call__(self, layover_hours):
+        # Whole hours are truncated toward zero like int() does.
+        hours = numpy.clip(layover_hours, 0, len(self.weights) - 1).astype(int)
+        return self.weights[hours]
+
+
+def flatten_seed(seed):
+    """
+    Flatten a seed made of integers and nested sequences of them, such as a simulation's
+    seed combined with a batch and shard index, into a list of integers.
+    """
+    if isinstance(seed, (int, long)):
+        return [seed]
+    return [word for part in seed for word in flatten_seed(part)]
+
+
+def create_random_generators(seed=None):
+    """
+    Create the Python and NumPy random number generators passengers are simulated with.
+    Without a seed the global generators are used.
+    The seed can be a sequence of integers, or of nested sequences of them, so that each shard
+    of a simulation gets an independent stream derived from the simulation's seed and the shard's index.
+    NumPy's SeedSequence is not available for Python 2, so the seed words are mixed with
+    the Mersenne Twister's init_by_array as RandomState does for array seeds.
+    """
+    if seed is None:
+        return random, numpy.random
+    random_state = numpy.random.RandomState(flatten_seed(seed))
+    python_seed = sum(long(word) << (31 * idx) for idx, word in enumerate(random_state.randint(0, 2 ** 31, size=4)))
+    return random.Random(python_seed), random_state
+
+
+# The normal distribution quantile for 95% confidence intervals
+CONFIDENCE_Z = 1.959964
+
+
+def terminal_flow_confidence_interval(passengers, simulated_passengers):
+    """
+    The half-width of the normal approximation 95% confidence interval for the fraction
+    of simulated passengers whose trips ended at an airport.
+    """
+    flow = float(passengers) / simulated_passengers
+    return CONFIDENCE_Z * math.sqrt(flow * (1 - flow) / simulated_passengers)
+
+
+def estimate_terminal_flow_error(totals, simulated_passengers, error_measure='confidence_interval'):
+    """
+    Estimate the error of the terminal flows computed from the totals of a simulation.
+
+    :param error_measure: confidence_interval for the largest terminal flow confidence interval half-width
+      or total_variation for a bound on the expected total variation distance between the estimated
+      and true distributions, which is half the sum of the terminal flows' standard errors.
+    """
+    if error_measure == 'confidence_interval':
+        return max([terminal_flow_confidence_interval(passengers, simulated_passengers)
+                    for passengers, legs, distance in totals.values()] or [0.0])
+    elif error_measure == 'total_variation':
+        return 0.5 * sum(
+            math.sqrt(float(passengers) / simulated_passengers * (1 - float(passengers) / simulated_passengers) /
+                      simulated_passengers)
+            for passengers, legs, distance in totals.values())
+    else:
+        raise ValueError("Unknown error measure: " + str(error_measure))
+
+
+# The calculator that shard processes simulate passengers with.
+# It is set before the processes are forked so they inherit it instead of it being pickled.
+_shard_calculator = None
+
+
+def _calculate_shard_totals(args):
+    return _shard_calculator.calculate_totals(*args)
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_epoch_seconds(date):
+    return (date - EPOCH).total_seconds()
+
+
+def from_epoch_seconds(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+
 # Memoization speeds up the simulation but its use is limited by memory consumption.
-# Using slotted objects reduces the size of the flights stored in memory
-# allowing more of them to be cached.
-class LightweightFlight(object):
+# Storing the flights as parallel arrays rather than individual objects reduces
+# the size of the flights stored in memory allowing more of them to be cached.
+class FlightArrays(object):
+    """
+    The flights departing from an airport stored as parallel arrays sorted by departure time.
+    Times are stored as seconds since the epoch.
+    """
     __slots__ = [
+        'departure_times',
+        'arrival_times',
+        'arrival_airports',
+        'arrival_idxs',
+        'passengers']
+
+    def __init__(self, departure_times, arrival_times, arrival_airports, arrival_idxs, passengers):
+        self.departure_times = departure_times
+        self.arrival_times = arrival_times
+        self.arrival_airports = arrival_airports
+        self.arrival_idxs = arrival_idxs
+        self.passengers = passengers
+
+    @classmethod
+    def from_flight_dicts(cls, flight_dicts, airport_to_idx=None):
+        """
+        :param flight_dicts: Flight documents with departureDateTime, arrivalDateTime, arrivalAirport
+          and totalSeats properties.
+        :param airport_to_idx: A dict mapping airports to their distance matrix indices.
+          The index is -1 for airports that are not in it.
+        """
+        # The sort is stable so flights departing at the same time keep the order they were given in.
+        flight_dicts = sorted(flight_dicts, key=lambda flight: flight['departureDateTime'])
+        airport_to_idx = airport_to_idx or {}
+        total_seats = numpy.array([flight['totalSeats'] for flight in flight_dicts], dtype=float)
+        return cls(
+            departure_times=numpy.array([
+                to_epoch_seconds(flight['departureDateTime']) for flight in flight_dicts], dtype=float),
+            arrival_times=numpy.array([
+                to_epoch_seconds(flight['arrivalDateTime']) for flight in flight_dicts], dtype=float),
+            arrival_airports=numpy.array([flight['arrivalAirport'] for flight in flight_dicts], dtype=object),
+            arrival_idxs=numpy.array([
+                airport_to_idx.get(flight['arrivalAirport'], -1) for flight in flight_dicts], dtype=int),
+            passengers=(A_load_ratio * total_seats + b_load_ratio) * total_seats)
+
+    def __len__(self):
+        return len(self.departure_times)
+
+
+class FlightStore(object):
+    """
+    All the flights departing within a time window held as arrays sorted by
+    departure airport and then departure time. Each flight is stored once
+    and the flights departing from an airport on any range of days are a
+    contiguous slice of the arrays.
+    The arrays can be saved to a directory and memory-mapped when they are loaded.
+    """
+    ARRAY_NAMES = [
+        'departure_times',
+        'arrival_times',
+        'arrival_airport_codes',
         'passengers',
-        'total_seats',
-        'departure_datetime',
-        'arrival_datetime',
-        'arrival_airport']
+        'airport_starts',
+        'airport_ends']
+
+    def __init__(self, start_time, end_time, airports, arrays):
+        """
+        :param start_time: The start of the window in seconds since the epoch.
+        :param end_time: The end of the window in seconds since the epoch.
+        :param airports: The airports the codes in arrival_airport_codes refer to.
+          airport_starts and airport_ends give the slice of the flights departing from each of them.
+        :param arrays: A dict with an array for each of the ARRAY_NAMES.
+        """
+        self.start_time = start_time
+        self.end_time = end_time
+        self.airports = airports
+        self.airport_names = numpy.array(airports, dtype=object)
+        self.airport_positions = {airport: position for position, airport in enumerate(airports)}
+        for name in self.ARRAY_NAMES:
+            setattr(self, name, arrays[name])
 
-    def __init__(self, flight_dict):
-        load_ratio = A_load_ratio * flight_dict['totalSeats'] + b_load_ratio
-        self.passengers = load_ratio * flight_dict['totalSeats']
-        self.total_seats = flight_dict['totalSeats']
-        self.departure_datetime = flight_dict['departureDateTime']
-        self.arrival_datetime = flight_dict['arrivalDateTime']
-        self.arrival_airport = flight_dict['arrivalAirport']
+    @classmethod
+    def from_flight_dicts(cls, flight_dicts, start_date, end_date):
+        """
+        Build a store from flight documents that depart within the given window.
+        The documents are consumed one at a time so a database cursor can be streamed into the store.
+        """
+        airport_positions = {}
+        departure_codes = []
+        departure_times = []
+        arrival_times = []
+        arrival_codes = []
+        total_seats = []
+        for flight in flight_dicts:
+            departure_codes.append(airport_positions.setdefault(
+                flight['departureAirport'], len(airport_positions)))
+            arrival_codes.append(airport_positions.setdefault(
+                flight['arrivalAirport'], len(airport_positions)))
+            departure_times.append(to_epoch_seconds(flight['departureDateTime']))
+            arrival_times.append(to_epoch_seconds(flight['arrivalDateTime']))
+            total_seats.append(flight['totalSeats'])
+        airports = sorted(airport_positions, key=airport_positions.get)
+        departure_codes = numpy.array(departure_codes, dtype=numpy.int32)
+        departure_times = numpy.array(departure_times, dtype=float)
+        # lexsort is stable so flights departing at the same time keep the order they were given in.
+        order = numpy.lexsort((departure_times, departure_codes))
+        departure_codes = departure_codes[order]
+        total_seats = numpy.array(total_seats, dtype=float)[order]
+        airport_codes = numpy.arange(len(airports), dtype=numpy.int32)
+        return cls(to_epoch_seconds(start_date), to_epoch_seconds(end_date), airports, {
+            'departure_times': departure_times[order],
+            'arrival_times': numpy.array(arrival_times, dtype=float)[order],
+            'arrival_airport_codes': numpy.array(arrival_codes, dtype=numpy.int32)[order],
+            'passengers': (A_load_ratio * total_seats + b_load_ratio) * total_seats,
+            'airport_starts': numpy.searchsorted(departure_codes, airport_codes, side='left'),
+            'airport_ends': numpy.searchsorted(departure_codes, airport_codes, side='right')
+        })
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+        return cls(metadata['startTime'], metadata['endTime'], metadata['airports'], {
+            name: numpy.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+            for name in cls.ARRAY_NAMES})
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in self.ARRAY_NAMES:
+            numpy.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        # The metadata is written last so partially written stores are not loaded.
+        with open(os.path.join(path, 'metadata.json'), 'w') as f:
+            json.dump({
+                'startTime': self.start_time,
+                'endTime': self.end_time,
+                'airports': self.airports
+            }, f)
+
+    def __len__(self):
+        return len(self.departure_times)
+
+    def covers(self, start_time, end_time):
+        return self.start_time <= start_time and end_time <= self.end_time
+
+    def get_flights(self, airport, start_time, end_time, airport_idxs):
+        """
+        Get the flights departing from the airport between the given times (inclusive).
+        The arrays are copied rather than sliced so flights memoized by calculators
+        do not keep the whole store in memory after it is replaced.
+
+        :param airport_idxs: An array mapping the store's airport codes to distance matrix indices.
+        """
+        position = self.airport_positions.get(airport)
+        if position is None:
+            start = end = 0
+        else:
+            airport_start = self.airport_starts[position]
+            departure_times = self.departure_times[airport_start:self.airport_ends[position]]
+            start = airport_start + numpy.searchsorted(departure_times, start_time, side='left')
+            end = airport_start + numpy.searchsorted(departure_times, end_time, side='right')
+        arrival_codes = self.arrival_airport_codes[start:end]
+        return FlightArrays(
+            departure_times=numpy.array(self.departure_times[start:end]),
+            arrival_times=numpy.array(self.arrival_times[start:end]),
+            arrival_airports=self.airport_names[arrival_codes],
+            arrival_idxs=airport_idxs[arrival_codes],
+            passengers=numpy.array(self.passengers[start:end]))
+
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+class ConnectionGraph(object):
+    """
+    A time-expanded graph of the connections between the flights in a flight store.
+    The passengers on a flight can connect to the flights departing from its arrival airport
+    after it lands and before the end of the day it lands on, which are a contiguous slice
+    of the store's arrays. The graph stores the start of that slice for every flight along
+    with the layover weighted passengers of each of its connections, so simulating a passenger
+    follows indices through the arrays instead of searching and weighting flights for every leg.
+    Flights landing on days the store does not fully cover have no connections in the graph.
+    """
+    def __init__(self, flight_store, connection_starts, connection_offsets, weights, layover_weighting):
+        """
+        :param connection_starts: The index of each flight's first connection in the store, or -1
+          when the store does not cover the day it lands on.
+        :param connection_offsets: The position of each flight's first connection in the weights,
+          with a final entry for the total number of connections.
+        :param weights: The layover weighted passengers of the connections, or None when
+          the flights are not weighted by layover so their passengers are used.
+        """
+        self.flight_store = flight_store
+        self.connection_starts = connection_starts
+        self.connection_offsets = connection_offsets
+        self.weights = weights
+        self.layover_weighting = layover_weighting
+
+    @classmethod
+    def build(cls, flight_store, layover_weighting=None, chunk_size=100000):
+        """
+        Build the graph for a flight store. The connection weights are computed
+        for chunk_size flights at a time to limit the temporary arrays' size.
+
+        :param layover_weighting: A function like LayoverWeightTable that weights connections
+          by their layover hours. Connections are not weighted by layover without it.
+        """
+        arrival_times = numpy.asarray(flight_store.arrival_times)
+        day_ends = arrival_times - arrival_times % DAY_SECONDS + DAY_SECONDS
+        covered = ((day_ends - DAY_SECONDS >= flight_store.start_time) &
+                   (day_ends <= flight_store.end_time))
+        connection_starts = numpy.full(len(flight_store), -1, dtype=numpy.int64)
+        connection_ends = numpy.full(len(flight_store), -1, dtype=numpy.int64)
+        # The flights are grouped by arrival airport so each airport's departures are searched once.
+        covered_flights = numpy.flatnonzero(covered)
+        arrival_codes = flight_store.arrival_airport_codes[covered_flights]
+        order = numpy.argsort(arrival_codes, kind='mergesort')
+        covered_flights = covered_flights[order]
+        arrival_codes = arrival_codes[order]
+        group_ends = list(numpy.flatnonzero(numpy.diff(arrival_codes)) + 1) + [len(covered_flights)]
+        for group_start, group_end in zip([0] + group_ends[:-1], group_ends):
+            if group_start == group_end:
+                # There are no covered flights.
+                continue
+            position = arrival_codes[group_start]
+            flights = covered_flights[group_start:group_end]
+            airport_start = flight_store.airport_starts[position]
+            departure_times = flight_store.departure_times[airport_start:flight_store.airport_ends[position]]
+            connection_starts[flights] = airport_start + numpy.searchsorted(
+                departure_times, arrival_times[flights], side='right')
+            connection_ends[flights] = airport_start + numpy.searchsorted(
+                departure_times, day_ends[flights], side='right')
+        connection_counts = connection_ends - connection_starts
+        connection_offsets = numpy.concatenate(([0], numpy.cumsum(connection_counts))).astype(numpy.int64)
+        if layover_weighting is None:
+            return cls(flight_store, connection_starts, connection_offsets, None, None)
+        weights = numpy.empty(connection_offsets[-1], dtype=float)
+        for chunk_start in range(0, len(flight_store), chunk_size):
+            chunk_end = min(chunk_start + chunk_size, len(flight_store))
+            offset_start = connection_offsets[chunk_start]
+            offset_end = connection_offsets[chunk_end]
+            counts = connection_counts[chunk_start:chunk_end]
+            # The store index of each connection is its position in the weights shifted
+            # by the difference between its flight's offset and first connection.
+            connections = numpy.arange(offset_start, offset_end) - numpy.repeat(
+                connection_offsets[chunk_start:chunk_end] - connection_starts[chunk_start:chunk_end], counts)
+            layover_hours = (flight_store.departure_times[connections] -
+                             numpy.repeat(arrival_times[chunk_start:chunk_end], counts)) / 3600
+            weights[offset_start:offset_end] = (
+                flight_store.passengers[connections] * layover_weighting(layover_hours))
+        return cls(flight_store, connection_starts, connection_offsets, weights, layover_weighting)
+
+    def __len__(self):
+        return int(self.connection_offsets[-1])
+
+    def nbytes(self):
+        return (self.connection_starts.nbytes + self.connection_offsets.nbytes +
+                (0 if self.weights is None else self.weights.nbytes))
+
+    def get_departures(self, airport, time):
+        """
+        Get the flights a passenger arriving at the airport at the given time can depart on,
+        the flights after it that depart on the same day, as a slice of the store and their weights.
+        Returns None when the store does not cover the day.
+        """
+        day_start = time - time % DAY_SECONDS
+        if not self.flight_store.covers(day_start, day_start + DAY_SECONDS):
+            return None
+        position = self.flight_store.airport_positions.get(airport)
+        if position is None:
+            return 0, 0, numpy.zeros(0)
+        airport_start = self.flight_store.airport_starts[position]
+        departure_times = self.flight_store.departure_times[airport_start:self.flight_store.airport_ends[position]]
+        start = airport_start + numpy.searchsorted(departure_times, time, side='right')
+        end = airport_start + numpy.searchsorted(departure_times, day_start + DAY_SECONDS, side='right')
+        weights = self.flight_store.passengers[start:end]
+        if self.layover_weighting is not None:
+            weights = weights * self.layover_weighting((self.flight_store.departure_times[start:end] - time) / 3600)
+        return start, end, weights
+
+    def get_connections(self, flight):
+        """
+        Get the flights the passengers on a flight can connect to as a slice of the store and their weights.
+        Returns None when the store does not cover the day the flight lands on.
+        """
+        start = self.connection_starts[flight]
+        if start < 0:
+            return None
+        offset_start = self.connection_offsets[flight]
+        offset_end = self.connection_offsets[flight + 1]
+        end = start + offset_end - offset_start
+        if self.weights is None:
+            return start, end, self.flight_store.passengers[start:end]
+        return start, end, self.weights[offset_start:offset_end]
 
 
 class AirportFlowCalculator(object):
@@ -144,15 +840,50 @@ class AirportFlowCalculator(object):
         10: 0.0000001
     }
     MEAN_LAYOVER_DELAY_HOURS = 2
+    # The number of days after the end of the simulated period that flights are preloaded for
+    # so that passengers arriving late in it have onward flights.
+    PRELOAD_PADDING_DAYS = 2
+    # The number of itineraries the aggregate flow simulation caches outcome probabilities for.
+    OUTCOME_CDF_CACHE_SIZE = 20000
+    # When layovers are checked, the aggregate flow solver ends trips rather than
+    # continuing them on to states less likely than this.
+    MIN_SOLVER_ITINERARY_PROBABILITY = 1e-7
 
-    def __init__(self, db, weight_by_departure_time=True, aggregated_seats=None, use_schedules=True, use_layover_checking=True):
+    def __init__(self, db, weight_by_departure_time=True, aggregated_seats=None, use_schedules=True,
+                 use_layover_checking=True, use_batch_simulation=False, use_aggregate_solver=False,
+                 layover_weighting=None, airport_to_coords_items=None, airport_distance_matrix=None):
+        """
+        The airport coordinates and distance matrix are computed from the airports collection
+        unless they are given, as they are when the calculator is loaded from a snapshot.
+        """
         self.use_schedules = use_schedules
+        # When simulating on aggregate flows, the batch simulation advances
+        # all the passengers one leg at a time rather than simulating them one by one.
+        self.use_batch_simulation = use_batch_simulation
+        # The aggregate solver computes the expected flows on the aggregate flows
+        # instead of simulating passengers. It is exact and much faster than simulating
+        # without layover checking, but it can be slower with it on large networks.
+        self.use_aggregate_solver = use_aggregate_solver
+        self.flight_store = None
+        self.connection_graph = None
+        self.aggregate_outcome_cdfs = lrucache(self.OUTCOME_CDF_CACHE_SIZE)
+        # The positions of the airports the aggregate solver totals flows for
+        # and its transitions for each number of legs.
+        self.solver_airports = None
+        self.solver_transitions = {}
+        # The number of times flights had to be queried from the database.
+        self.flight_queries = 0
         self.db = db
         self.db.flights.ensure_index('departureAirport')
         self.db.flights.ensure_index(
             [('departureAirport', pymongo.ASCENDING), ('departureDateTime', pymongo.ASCENDING)])
         self.use_layover_checking = use_layover_checking
-        if self.use_layover_checking:
+        if self.use_layover_checking and airport_distance_matrix is not None:
+            self.airport_to_coords_items = airport_to_coords_items
+            self.airport_to_idx = {airport: idx for idx, (airport, noop) in enumerate(airport_to_coords_items)}
+            self.airport_distance_matrix = airport_distance_matrix
+            self.aggregate_destination_idxs = {}
+        elif self.use_layover_checking:
             if aggregated_seats:
                 active_airports = set()
                 for origin, destinations in aggregated_seats.items():
@@ -169,7 +900,13 @@ class AirportFlowCalculator(object):
             self.airport_to_coords_items = airport_to_coords_items
             self.airport_to_idx = {airport: idx for idx, (airport, noop) in enumerate(airport_to_coords_items)}
             self.airport_distance_matrix = compute_airport_distances(airport_to_coords_items)
+            self.aggregate_destination_idxs = {}
         self.weight_by_departure_time = weight_by_departure_time
+        # A function that maps an array of layover durations in hours to the
+        # weights of the flights with them.
+        if layover_weighting is None:
+            layover_weighting = LayoverWeightTable.poisson(self.MEAN_LAYOVER_DELAY_HOURS)
+        self.layover_weighting = layover_weighting
         self.aggregated_seats = aggregated_seats
         # LEG_PROBABILITY_DISTRIBUTION shows the probability of ending a journey
         # at each leg given one is at the start of the journey.
@@ -184,9 +921,61 @@ class AirportFlowCalculator(object):
             for leg_num, leg_prob in self.LEG_PROBABILITY_DISTRIBUTION.items()}
         self.max_legs = len(self.LEG_PROBABILITY_DISTRIBUTION) - 1
 
+    def save_snapshot(self, path):
+        """
+        Save the calculator's immutable state, the airport locations, distance matrix and
+        aggregated flows, to a directory so other processes can memory-map it with from_snapshot.
+        Each snapshot is written to its own directory next to the path, then the path is
+        atomically replaced by a link to it and the directory it previously linked to is deleted.
+        """
+        parent_path = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(parent_path):
+            os.makedirs(parent_path)
+        temp_path = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', dir=parent_path)
+        numpy.save(os.path.join(temp_path, 'airport_distance_matrix.npy'), self.airport_distance_matrix)
+        with open(os.path.join(temp_path, 'airports.json'), 'w') as f:
+            json.dump(self.airport_to_coords_items, f)
+        aggregated_seats = self.aggregated_seats
+        if not isinstance(aggregated_seats, FlowMatrix):
+            aggregated_seats = FlowMatrix.from_dicts(aggregated_seats or {})
+        aggregated_seats.save(os.path.join(temp_path, 'aggregated_seats'))
+        link_path = temp_path + '.link'
+        os.symlink(os.path.basename(temp_path), link_path)
+        if os.path.islink(path):
+            previous_path = os.path.join(parent_path, os.readlink(path))
+        elif os.path.exists(path):
+            # Snapshots saved before they were linked are directories, which a link cannot replace.
+            previous_path = temp_path + '.previous'
+            os.rename(path, previous_path)
+        else:
+            previous_path = None
+        os.rename(link_path, path)
+        if previous_path:
+            # Processes that have already loaded the previous snapshot keep their mapped copy of it.
+            shutil.rmtree(previous_path, ignore_errors=True)
+
+    @classmethod
+    def from_snapshot(cls, db, path, **kwargs):
+        """
+        Create a calculator from a snapshot saved with save_snapshot.
+        The distance matrix and aggregated flows are memory-mapped read-only, so processes
+        loading the same snapshot share a single copy of them.
+        """
+        # The link is resolved once so every file comes from the same snapshot if it is replaced.
+        path = os.path.realpath(path)
+        with open(os.path.join(path, 'airports.json')) as f:
+            airport_to_coords_items = [(airport, coords) for airport, coords in json.load(f)]
+        aggregated_seats = FlowMatrix.load(os.path.join(path, 'aggregated_seats'))
+        return cls(
+            db,
+            aggregated_seats=aggregated_seats if len(aggregated_seats.airports) > 0 else None,
+            airport_to_coords_items=airport_to_coords_items,
+            airport_distance_matrix=numpy.load(os.path.join(path, 'airport_distance_matrix.npy'), mmap_mode='r'),
+            **kwargs)
+
     def get_itinerary_distance(self, itinerary):
         idx_itinerary = [self.airport_to_idx.get(airport) for airport in itinerary]
-        idx_itinerary = filter(lambda x: x, idx_itinerary)
+        idx_itinerary = filter(lambda x: x is not None, idx_itinerary)
         total_distance = 0.0
         for a, b in zip(idx_itinerary, idx_itinerary[1:]):
             total_distance += self.airport_distance_matrix.item(a, b)
@@ -210,7 +999,7 @@ class AirportFlowCalculator(object):
             return True
         if origin == destination:
             return False
-        layovers = filter(lambda x: x, idx_itinerary[1:-1])
+        layovers = filter(lambda x: x is not None, idx_itinerary[1:-1])
         # Check last 3 airports in long itineraries.
         if len(layovers) > 2 and not is_logical(self.airport_distance_matrix, layovers[-2], destination, layovers[-1]):
             return False
@@ -221,17 +1010,415 @@ class AirportFlowCalculator(object):
             for intermediate in layovers])
         return result
 
+    @lrudecorator(2000)
+    def get_logical_destinations(self, airport_a, intermediate_airport):
+        """
+        For the airports at the given distance matrix indices, compute a boolean array over every
+        row of the distance matrix that is true for the destinations the intermediate airport
+        is a logical layover for when travelling from airport_a.
+        These only depend on the origin and layover, so they are memoized to
+        answer the layover checks for many candidate destinations at once.
+        """
+        a_distances = self.airport_distance_matrix[airport_a]
+        # The distance matrix is symmetrical so the intermediate airport's row
+        # gives the distances of every destination from it.
+        return ((self.airport_distance_matrix[intermediate_airport] < a_distances) |
+                (a_distances.item(intermediate_airport) < a_distances))
+
+    def get_logical_destination_mask(self, itinerary, destination_idxs):
+        """
+        Determine which of the candidate destinations can be added to the itinerary
+        without creating an illogical layover.
+        This gives the same result as calling check_logical_layovers on
+        the itinerary extended with each candidate.
+
+        :param destination_idxs: An array of the candidates' distance matrix indices. Candidates with
+          unknown locations have the index -1.
+        :return: A boolean array that is true for the candidates with logical layovers.
+        """
+        destination_idxs = numpy.asarray(destination_idxs, dtype=int)
+        idx_itinerary = [self.airport_to_idx.get(airport) for airport in itinerary]
+        origin = idx_itinerary[0]
+        layovers = [idx for idx in idx_itinerary[1:] if idx is not None]
+        # When the airport location is unknown the layover cannot be checked.
+        known = destination_idxs >= 0
+        known_idxs = destination_idxs[known]
+        known_mask = numpy.ones(len(known_idxs), dtype=bool)
+        if origin is not None:
+            known_mask &= known_idxs != origin
+        # Check last 3 airports in long itineraries.
+        if len(layovers) > 2:
+            known_mask &= self.get_logical_destinations(layovers[-2], layovers[-1])[known_idxs]
+        if origin is not None:
+            for intermediate in layovers:
+                known_mask &= self.get_logical_destinations(origin, intermediate)[known_idxs]
+        mask = numpy.ones(len(destination_idxs), dtype=bool)
+        mask[known] = known_mask
+        return mask
+
+    def get_destination_idxs(self, airport):
+        """
+        Get the distance matrix indices of the airport's aggregate flow destinations
+        in the order they are listed, with -1 for destinations with unknown locations.
+        """
+        if airport not in self.aggregate_destination_idxs:
+            self.aggregate_destination_idxs[airport] = numpy.array([
+                self.airport_to_idx.get(destination, -1)
+                for destination in self.aggregated_seats[airport].keys()], dtype=int)
+        return self.aggregate_destination_idxs[airport]
+
+    def get_aggregate_transitions(self, itinerary):
+        """
+        Compute the probabilities of each next step a passenger on the aggregate flows
+        can take given the airports they have visited so far.
+        These are the same probabilities the steps of simulate_passenger_on_aggregate_flows
+        in calculate_itins have.
+
+        :return: The candidate destinations, the probabilities of continuing on from and of ending
+          the trip at each of them, and the probability of passing over all of them
+          which ends the trip at the last candidate.
+        """
+        departure_airport = itinerary[-1]
+        itinerary = list(itinerary)
+        if self.use_layover_checking:
+            # The outcome probabilities depend on the order the destinations are
+            # iterated over in, so the valid destinations are collected into a dict
+            # the same way the simulation does it.
+            valid_destinations = {}
+            # filter out itineraries that have illogical layovers.
+            logical_mask = self.get_logical_destination_mask(itinerary, self.get_destination_idxs(departure_airport))
+            for (destination, seats), logical in zip(self.aggregated_seats[departure_airport].items(), logical_mask):
+                if logical:
+                    if itinerary[0] == destination:
+                        raise Exception("Circular itinerary")
+                    valid_destinations[destination] = seats
+        else:
+            valid_destinations = self.aggregated_seats[departure_airport]
+        destinations = valid_destinations.keys()
+        seats = valid_destinations.values()
+        if len(destinations) == 0:
+            if len(self.aggregated_seats[departure_airport]) > 0:
+                # When none of the destinations are logical the simulation ends the trip at
+                # the last destination listed for the airport.
+                return self.aggregated_seats[departure_airport].keys()[-1:], numpy.zeros(1), numpy.zeros(1), 1.0
+            return destinations, numpy.zeros(0), numpy.zeros(0), 0.0
+        seats = numpy.array(seats, dtype=float)
+        if len(itinerary) - 1 < self.max_legs:
+            continue_share = 1.0 - self.TERMINAL_LEG_PROBABILITIES[len(itinerary) - 1]
+        else:
+            continue_share = 0.0
+        continue_probs, terminal_probs, fallback_prob = sequential_choice_probabilities(
+            seats / seats.sum(),
+            continue_share,
+            self.TERMINAL_LEG_PROBABILITIES[len(itinerary)])
+        return destinations, continue_probs, terminal_probs, fallback_prob
+
+    def get_aggregate_outcome_cdf(self, itinerary):
+        """
+        Get the cumulative probabilities of continuing on from and then of ending the trip at
+        each of the candidate destinations returned by get_aggregate_transitions.
+        These are memoized in a bounded cache so the many passengers that share the early
+        legs of their itineraries only compute them once.
+        When layovers are checked the candidates depend on every airport in the itinerary,
+        otherwise they only depend on the current airport and the number of legs so far.
+        """
+        if self.use_layover_checking:
+            key = tuple(itinerary)
+        else:
+            key = (itinerary[-1], len(itinerary))
+        try:
+            return self.aggregate_outcome_cdfs[key]
+        except KeyError:
+            pass
+        destinations, continue_probs, terminal_probs, fallback_prob = self.get_aggregate_transitions(itinerary)
+        value = (destinations, numpy.cumsum(numpy.concatenate((continue_probs, terminal_probs))).tolist())
+        self.aggregate_outcome_cdfs[key] = value
+        return value
+
+    def simulate_passengers_in_batch(self, starting_airport, simulated_passengers, random_state=None):
+        """
+        Simulate passengers on the aggregate flows by advancing all of them one leg at a time.
+        Passengers who have followed the same itinerary so far are interchangeable,
+        so rather than drawing a random number for each of them, the number of them that take
+        each possible next step is drawn from a multinomial distribution.
+
+        :return: A dict mapping each completed itinerary tuple to the number of passengers who followed it.
+          Passengers who reach an airport without any outgoing flows end their trip there.
+        """
+        if random_state is None:
+            random_state = numpy.random
+        completed_itineraries = defaultdict(int)
+        active_itineraries = {(starting_airport,): simulated_passengers}
+        while len(active_itineraries) > 0:
+            next_active_itineraries = defaultdict(int)
+            for itinerary, passengers in active_itineraries.items():
+                if len(itinerary) - 1 >= self.max_legs:
+                    completed_itineraries[itinerary] += passengers
+                    continue
+                destinations, continue_probs, terminal_probs, fallback_prob = self.get_aggregate_transitions(itinerary)
+                if len(destinations) == 0:
+                    completed_itineraries[itinerary] += passengers
+                    continue
+                outcome_probs = numpy.concatenate((continue_probs, terminal_probs, [fallback_prob]))
+                outcome_counts = random_state.multinomial(passengers, outcome_probs / outcome_probs.sum())
+                for outcome in numpy.flatnonzero(outcome_counts):
+                    count = int(outcome_counts[outcome])
+                    if outcome < len(destinations):
+                        next_active_itineraries[itinerary + (destinations[outcome],)] += count
+                    elif outcome < 2 * len(destinations):
+                        completed_itineraries[itinerary + (destinations[outcome - len(destinations)],)] += count
+                    else:
+                        completed_itineraries[itinerary + (destinations[-1],)] += count
+            active_itineraries = next_active_itineraries
+        return completed_itineraries
+
+    def get_solver_state_key(self, itinerary, layover_idxs):
+        """
+        The part of an itinerary that its next step's probabilities and distance depend on when
+        layovers are checked. Itineraries with the same key have the same transitions, so the
+        aggregate solver merges them. Besides the current airport, the number of legs and the last
+        airport with a known location, which distances are measured from, these depend on the set of
+        intermediate airports, which are all checked against the origin, and the last two of them,
+        which are checked against each other on long itineraries.
+
+        :param layover_idxs: The distance matrix indices of the intermediate airports with known locations.
+        """
+        return (
+            itinerary[-1],
+            len(itinerary),
+            layover_idxs[-1] if len(layover_idxs) > 0 else self.airport_to_idx.get(itinerary[0]),
+            frozenset(layover_idxs),
+            tuple(layover_idxs[-2:]) if len(layover_idxs) > 2 else None)
+
+    def get_solver_airports(self):
+        """
+        Number every airport in the aggregate flows so the aggregate solver can total
+        their flows in arrays.
+
+        :return: A dict mapping the airports to their positions and an array mapping
+          the positions to distance matrix indices, which are -1 for unknown locations.
+        """
+        if self.solver_airports is None:
+            airports = set()
+            for origin, destinations in self.aggregated_seats.items():
+                airports.add(origin)
+                airports.update(destinations.keys())
+            airports = sorted(airports)
+            airport_to_idx = getattr(self, 'airport_to_idx', {})
+            self.solver_airports = (
+                {airport: position for position, airport in enumerate(airports)},
+                numpy.array([airport_to_idx.get(airport, -1) for airport in airports], dtype=int))
+        return self.solver_airports
+
+    def get_solver_transitions(self, legs):
+        """
+        Get the step probabilities of every airport for passengers who have taken the given number
+        of legs as arrays over the routes of the aggregate flows. Without layover checking these
+        only depend on the airport and the number of legs, so they are computed once and
+        shared by every starting airport.
+
+        :return: The positions of each route's origin and destination, the probabilities of continuing on
+          from and of ending the trip at the destination, including passing over every destination for the
+          last one, the route's distance and whether each airport has any destinations.
+        """
+        if legs in self.solver_transitions:
+            return self.solver_transitions[legs]
+        airport_positions, airport_distance_idxs = self.get_solver_airports()
+        origins = []
+        destinations = []
+        continue_probs = []
+        terminal_probs = []
+        has_destinations = numpy.zeros(len(airport_positions), dtype=bool)
+        for airport, position in airport_positions.items():
+            if airport not in self.aggregated_seats:
+                continue
+            # Without layover checking the transitions only depend on
+            # the last airport and the length of the itinerary.
+            airport_destinations, airport_continue_probs, airport_terminal_probs, fallback_prob = \
+                self.get_aggregate_transitions([airport] * (legs + 1))
+            if len(airport_destinations) == 0:
+                continue
+            has_destinations[position] = True
+            airport_terminal_probs = airport_terminal_probs.copy()
+            airport_terminal_probs[-1] += fallback_prob
+            origins.append(numpy.full(len(airport_destinations), position, dtype=int))
+            destinations.append(numpy.array([airport_positions[destination] for destination in airport_destinations]))
+            continue_probs.append(airport_continue_probs)
+            terminal_probs.append(airport_terminal_probs)
+        if len(origins) > 0:
+            origins = numpy.concatenate(origins)
+            destinations = numpy.concatenate(destinations)
+            continue_probs = numpy.concatenate(continue_probs)
+            terminal_probs = numpy.concatenate(terminal_probs)
+        else:
+            origins = destinations = numpy.zeros(0, dtype=int)
+            continue_probs = terminal_probs = numpy.zeros(0)
+        origin_idxs = airport_distance_idxs[origins]
+        destination_idxs = airport_distance_idxs[destinations]
+        known = (origin_idxs >= 0) & (destination_idxs >= 0)
+        distances = numpy.zeros(len(origins))
+        if known.any():
+            distances[known] = numpy.asarray(self.airport_distance_matrix)[origin_idxs[known], destination_idxs[known]]
+        value = (origins, destinations, continue_probs, terminal_probs, distances, has_destinations)
+        self.solver_transitions[legs] = value
+        return value
+
+    def solve_aggregate_flows(self, starting_airport):
+        """
+        Compute the expected terminal flow, average legs and average distance for each
+        airport reached from the starting airport on the aggregate flows without simulation.
+        The probability of being at each state, along with the probability weighted distance
+        travelled to reach it, is propagated one leg at a time using the same step probabilities
+        the simulations sample from, and the trips ending at each leg are totalled in arrays.
+
+        Without layover checking a state is an airport, so the probabilities are propagated
+        as vectors over the airports with the transitions from get_solver_transitions, which
+        are shared between starting airports, and the result is exact. Legs from or to airports
+        with unknown locations are counted as zero distance.
+        With layover checking, a state also includes the set of intermediate airports visited
+        (see get_solver_state_key), so the number of states can grow quickly on large networks and
+        solving can take longer than simulating passengers. Continuing on to a state less likely than
+        MIN_SOLVER_ITINERARY_PROBABILITY is treated as ending the trip at it, so the result is approximate.
+
+        :return: A dict in the same format calculate returns.
+        """
+        if self.aggregated_seats and len(self.aggregated_seats[starting_airport]) == 0:
+            return {}
+        airport_positions, airport_distance_idxs = self.get_solver_airports()
+        terminal_flows = numpy.zeros(len(airport_positions))
+        leg_totals = numpy.zeros(len(airport_positions))
+        distance_totals = numpy.zeros(len(airport_positions))
+        if self.use_layover_checking:
+            self.solve_itinerary_states(
+                starting_airport, terminal_flows, leg_totals, distance_totals)
+        else:
+            probabilities = numpy.zeros(len(airport_positions))
+            probabilities[airport_positions[starting_airport]] = 1.0
+            distance_totals_so_far = numpy.zeros(len(airport_positions))
+            for legs in range(self.max_legs + 1):
+                if legs == self.max_legs:
+                    terminal_flows += probabilities
+                    leg_totals += probabilities * legs
+                    distance_totals += distance_totals_so_far
+                    break
+                origins, destinations, continue_probs, terminal_probs, distances, has_destinations = \
+                    self.get_solver_transitions(legs)
+                if legs > 0:
+                    # Passengers at airports without destinations end their trip there.
+                    stuck = ~has_destinations
+                    terminal_flows[stuck] += probabilities[stuck]
+                    leg_totals[stuck] += probabilities[stuck] * legs
+                    distance_totals[stuck] += distance_totals_so_far[stuck]
+                route_probabilities = probabilities[origins]
+                route_distance_totals = distance_totals_so_far[origins] + route_probabilities * distances
+                ending_probabilities = numpy.bincount(
+                    destinations, terminal_probs * route_probabilities, len(airport_positions))
+                terminal_flows += ending_probabilities
+                leg_totals += ending_probabilities * (legs + 1)
+                distance_totals += numpy.bincount(
+                    destinations, terminal_probs * route_distance_totals, len(airport_positions))
+                probabilities = numpy.bincount(
+                    destinations, continue_probs * route_probabilities, len(airport_positions))
+                distance_totals_so_far = numpy.bincount(
+                    destinations, continue_probs * route_distance_totals, len(airport_positions))
+                if not probabilities.any():
+                    break
+        airports = sorted(airport_positions, key=airport_positions.get)
+        return {
+            airports[position]: dict(
+                _id=airports[position],
+                terminal_flow=terminal_flows[position],
+                average_legs=leg_totals[position] / terminal_flows[position],
+                average_distance=distance_totals[position] / terminal_flows[position])
+            for position in numpy.flatnonzero(terminal_flows > 0)
+        }
+
+    def solve_itinerary_states(self, starting_airport, terminal_flows, leg_totals, distance_totals):
+        """
+        Propagate the probabilities of the states that layover checking depends on for
+        solve_aggregate_flows, adding the trips that end at each airport to the given arrays.
+        """
+        airport_positions, airport_distance_idxs = self.get_solver_airports()
+        # Each state in the frontier is mapped to an itinerary that reaches it, the
+        # distance matrix indices of that itinerary's intermediate airports with known locations,
+        # the probability of reaching the state and the probability weighted sum of the
+        # distances travelled to reach it.
+        frontier = {None: ((starting_airport,), [], 1.0, 0.0)}
+        while len(frontier) > 0:
+            next_frontier = {}
+            for itinerary, layover_idxs, probability, distance_total in frontier.values():
+                legs = len(itinerary) - 1
+                destinations, continue_probs, terminal_probs, fallback_prob = self.get_aggregate_transitions(itinerary)
+                if len(destinations) == 0:
+                    if legs > 0:
+                        position = airport_positions[itinerary[-1]]
+                        terminal_flows[position] += probability
+                        leg_totals[position] += probability * legs
+                        distance_totals[position] += distance_total
+                    continue
+                destination_positions = numpy.array([airport_positions[destination] for destination in destinations])
+                destination_idxs = airport_distance_idxs[destination_positions]
+                last_idx = layover_idxs[-1] if len(layover_idxs) > 0 else self.airport_to_idx.get(itinerary[0])
+                if last_idx is None:
+                    leg_distances = numpy.zeros(len(destinations))
+                else:
+                    leg_distances = numpy.where(
+                        destination_idxs >= 0, self.airport_distance_matrix[last_idx][destination_idxs], 0.0)
+                # The final candidate's terminal probability includes the passengers
+                # that pass over every candidate.
+                terminal_probs = terminal_probs.copy()
+                terminal_probs[-1] += fallback_prob
+                continue_probabilities = continue_probs * probability
+                continue_distance_totals = continue_probs * (distance_total + probability * leg_distances)
+                # Trips on their last possible leg and unlikely continuations end at the destination.
+                if legs + 1 >= self.max_legs:
+                    ending = continue_probabilities > 0
+                else:
+                    ending = (continue_probabilities > 0) & (
+                        continue_probabilities < self.MIN_SOLVER_ITINERARY_PROBABILITY)
+                ending_probabilities = terminal_probs * probability + numpy.where(ending, continue_probabilities, 0.0)
+                # The destinations are distinct, so their totals can be incremented with fancy indexing.
+                terminal_flows[destination_positions] += ending_probabilities
+                leg_totals[destination_positions] += ending_probabilities * (legs + 1)
+                distance_totals[destination_positions] += (
+                    terminal_probs * (distance_total + probability * leg_distances) +
+                    numpy.where(ending, continue_distance_totals, 0.0))
+                for outcome in numpy.flatnonzero((continue_probabilities > 0) & ~ending):
+                    destination = destinations[outcome]
+                    destination_idx = destination_idxs[outcome]
+                    next_itinerary = itinerary + (destination,)
+                    next_layover_idxs = layover_idxs if destination_idx < 0 else layover_idxs + [destination_idx]
+                    key = self.get_solver_state_key(next_itinerary, next_layover_idxs)
+                    state = next_frontier.get(key)
+                    if state is None:
+                        next_frontier[key] = (next_itinerary, next_layover_idxs,
+                                              continue_probabilities[outcome], continue_distance_totals[outcome])
+                    else:
+                        next_frontier[key] = (state[0], state[1],
+                                              state[2] + continue_probabilities[outcome],
+                                              state[3] + continue_distance_totals[outcome])
+            frontier = next_frontier
+
     @lrudecorator(30000)
     def get_flights_from_airport(self, airport, date):
         """
         Retrieve all the flight that that happened up to 2 days after the given
-        date from the database then return them in an array with a distinct
-        element for each flight.
+        date from the database then return them as FlightArrays sorted by
+        departure time.
 
         Notes:
         * This function is memoized to redues the number of database queries
           needed.
+        * Flights are taken from the preloaded flight store when it covers the date.
         """
+        if self.flight_store and self.flight_store.covers(
+                to_epoch_seconds(date), to_epoch_seconds(date + datetime.timedelta(1))):
+            return self.flight_store.get_flights(
+                airport,
+                to_epoch_seconds(date),
+                to_epoch_seconds(date + datetime.timedelta(1)),
+                self.flight_store_airport_idxs)
+        self.flight_queries += 1
         query_results = self.db.flights.find({
             "departureAirport": airport,
             "totalSeats": {"$gt": 0},
@@ -246,62 +1433,119 @@ class AirportFlowCalculator(object):
             "arrivalAirport": 1,
             "totalSeats": 1,
         })
-        flights = []
-        for result in query_results:
-            flights.append(LightweightFlight(result))
-        # print "Flights:", len(flights)
-        return flights
+        return FlightArrays.from_flight_dicts(query_results, getattr(self, 'airport_to_idx', None))
+
+    def preload_flights(self, start_date, end_date, path=None):
+        """
+        Load all the flights needed to simulate passengers starting between the given dates
+        into a flight store with a single database query so simulations do not need to query
+        the database for each airport and day.
+        If a path is given the store is memory-mapped from it when it has already been saved there,
+        otherwise the store is saved to it once it is loaded from the database.
+
+        :return: Statistics about the preload, including the seconds it took.
+        """
+        start = time.time()
+        end_date = end_date + datetime.timedelta(days=1 + self.PRELOAD_PADDING_DAYS)
+        if path and os.path.exists(os.path.join(path, 'metadata.json')):
+            flight_store = FlightStore.load(path)
+            loaded_from_file = True
+        else:
+            flight_store = FlightStore.from_flight_dicts(self.db.flights.find({
+                "totalSeats": {"$gt": 0},
+                "departureDateTime": {
+                    "$gte": start_date,
+                    "$lte": end_date
+                }
+            }, {
+                "_id": 0,
+                "departureAirport": 1,
+                "departureDateTime": 1,
+                "arrivalDateTime": 1,
+                "arrivalAirport": 1,
+                "totalSeats": 1,
+            }).batch_size(10000), start_date, end_date)
+            if path:
+                flight_store.save(path)
+            loaded_from_file = False
+        airport_to_idx = getattr(self, 'airport_to_idx', {})
+        self.flight_store_airport_idxs = numpy.array([
+            airport_to_idx.get(airport, -1) for airport in flight_store.airports], dtype=int)
+        self.flight_store = flight_store
+        # A connection graph for the previous store no longer applies.
+        # Memoized flights are left alone since they are the same whichever way they were loaded,
+        # and other periods may still use them. They are copies, so the previous store is freed.
+        self.connection_graph = None
+        return {
+            'flights': len(flight_store),
+            'seconds': time.time() - start,
+            'loadedFromFile': loaded_from_file
+        }
+
+    def build_connection_graph(self):
+        """
+        Build a connection graph for the preloaded flights that simulations with schedules
+        use instead of finding and weighting each passenger's onward flights. The graph only
+        depends on the flights, so it pays off when many passengers are simulated for a period,
+        but it can take much more memory than the flights.
+
+        :return: Statistics about the graph, including the seconds it took to build and its size in bytes.
+        """
+        if self.flight_store is None:
+            raise ValueError("Flights must be preloaded to build a connection graph.")
+        start = time.time()
+        self.connection_graph = ConnectionGraph.build(
+            self.flight_store, self.layover_weighting if self.weight_by_departure_time else None)
+        return {
+            'flights': len(self.flight_store),
+            'connections': len(self.connection_graph),
+            'bytes': self.connection_graph.nbytes(),
+            'seconds': time.time() - start
+        }
 
     def calculate_itins(self,
                         starting_airport,
                         simulated_passengers=100,
                         start_date=datetime.datetime.now(),
-                        end_date=datetime.datetime.now()):
+                        end_date=datetime.datetime.now(),
+                        seed=None):
         """
         Calculate the probability of a given passenger reaching each destination
         from the departure airport by simulating several voyages.
+        Simulations with the same seed produce the same itineraries.
         """
-
-        def layover_pmf(hours):
-            # Implementation of Poisson PMF based on:
-            # http://stackoverflow.com/questions/280797/calculate-poisson-probability-percentage
-            p = math.exp(-self.MEAN_LAYOVER_DELAY_HOURS)
-            for i in range(int(hours)):
-                p *= self.MEAN_LAYOVER_DELAY_HOURS
-                p /= i + 1
-            return p
+        rng, random_state = create_random_generators(seed)
 
         def simulate_passenger(itin_sofar, departure_airport_arrival_time):
             """
             This function simulates a passenger then returns
             their the airports they stop at. It is a recusive function that calls 
             itself to simulate transfers on multi-leg flights.
+            The arrival time is given in seconds since the epoch.
             """
             departure_airport = itin_sofar[-1]
+            arrival_datetime = from_epoch_seconds(departure_airport_arrival_time)
             flights = self.get_flights_from_airport(departure_airport,
                                                     datetime.datetime(
-                                                        departure_airport_arrival_time.year,
-                                                        departure_airport_arrival_time.month,
-                                                        departure_airport_arrival_time.day))
+                                                        arrival_datetime.year,
+                                                        arrival_datetime.month,
+                                                        arrival_datetime.day))
 
             if len(itin_sofar) - 1 >= self.max_legs:
                 return itin_sofar
+            # only include flights that the passenger arrived prior to
+            first_flight = numpy.searchsorted(flights.departure_times, departure_airport_arrival_time, side='right')
+            flight_idxs = numpy.arange(first_flight, len(flights))
             if self.use_layover_checking:
                 # only include flights with logical layovers
-                flights = [
-                    flight for flight in flights
-                    if self.check_logical_layovers(itin_sofar + [flight.arrival_airport])]
-            # only include flights that the passenger arrived prior to
-            flights = [
-                flight for flight in flights
-                if departure_airport_arrival_time < flight.departure_datetime]
+                flight_idxs = flight_idxs[
+                    self.get_logical_destination_mask(itin_sofar, flights.arrival_idxs[flight_idxs])]
             # Weight flights from the origin city (A1) based on the summed
             # direct flow between A and all other destinations (B1).
             # However, these situations might cause some error since
             # there is nowhere for the passengers we expect to transfer
             # to go.
-            cumulative_outbound_passengers = sum([
-                flight.passengers for flight in flights])
+            outbound_passengers = flights.passengers[flight_idxs]
             # Assumption: People are likely to take flights that occur shortly
             # after they arrived at an airport. This may differ for, say,
             # flights crossing an administrative boundary, but at first pass,
@@ -314,99 +1558,125 @@ class AirportFlowCalculator(object):
             # So, the airport inflows on multileg journeys are weighted by
             # where the layover time falls on the poisson distribution.
             if self.weight_by_departure_time:
-                layover_probs = [
-                    layover_pmf(
-                        float((flight.departure_datetime -
-                               departure_airport_arrival_time).total_seconds()) / 3600)
-                    for flight in flights]
-                time_weighted_cumulative_outbound_passengers = sum([
-                    flight.passengers * prob
-                    for flight, prob in zip(flights, layover_probs)])
+                layover_hours = (flights.departure_times[flight_idxs] - departure_airport_arrival_time) / 3600
+                layover_probs = self.layover_weighting(layover_hours)
+                outbound_passengers = outbound_passengers * layover_probs
                 # Filter out flights with a zero probability
-                filtered_flights = []
-                filtered_probs = []
-                for flight, prob in zip(flights, layover_probs):
-                    if prob > 0:
-                        filtered_flights.append(flight)
-                        filtered_probs.append(prob)
-                flights = filtered_flights
-                layover_probs = filtered_probs
-            if len(flights) == 0:
+                nonzero = layover_probs > 0
+                flight_idxs = flight_idxs[nonzero]
+                outbound_passengers = outbound_passengers[nonzero]
+            if len(flight_idxs) == 0:
                 # There are no flights, so we assume the passenger leaves
                 # the airport.
                 return itin_sofar
+            # An airport's inflow is the number of passengers from the
+            # starting airport that are likely to end their trip at it.
+            # The flights are considered in departure order, so the outcome
+            # probabilities are computed for all of them and one is sampled.
+            terminal_leg_probability = self.TERMINAL_LEG_PROBABILITIES[len(itin_sofar)]
+            continue_probs, terminal_probs, fallback_prob = sequential_choice_probabilities(
+                outbound_passengers / outbound_passengers.sum(),
+                1.0 - terminal_leg_probability,
+                terminal_leg_probability)
+            outcome = numpy.searchsorted(
+                numpy.cumsum(numpy.concatenate((continue_probs, terminal_probs))),
+                rng.random(),
+                side='right')
+            if outcome < len(flight_idxs):
+                flight_idx = flight_idxs[outcome]
+                # Find airports that could be arrived at through transfers.
+                return simulate_passenger(
+                    itin_sofar + [flights.arrival_airports[flight_idx]],
+                    departure_airport_arrival_time=flights.arrival_times[flight_idx])
+            elif outcome < 2 * len(flight_idxs):
+                return itin_sofar + [flights.arrival_airports[flight_idxs[outcome - len(flight_idxs)]]]
+            # The passenger might not be assigned to any flight above due to floating point error.
+            # In this case we assume the passenger stops at the last arrival airport considered.
+            return itin_sofar + [flights.arrival_airports[flight_idxs[-1]]]
 
-            inflow_sofar = 0.0
-            for idx, flight in enumerate(flights):
-                # An airport's inflow is the number of passengers from the 
-                # starting airport that are likely to end their trip at it.
-                # This value is just for the current flight. There could be more
-                # inflow from other flights which will be combined later.
-                if self.weight_by_departure_time:
-                    inflow = (
-                        float(flight.passengers) * layover_probs[idx] /
-                        time_weighted_cumulative_outbound_passengers)
-                else:
-                    inflow = (
-                        float(flight.passengers) /
-                        cumulative_outbound_passengers)
-                terminal_flow = inflow * self.TERMINAL_LEG_PROBABILITIES[len(itin_sofar)] / (1.0 - inflow_sofar)
-                outflow = inflow * (1.0 - self.TERMINAL_LEG_PROBABILITIES[len(itin_sofar)]) / (1.0 - inflow_sofar)
-                random_number = random.random()
-                if random_number <= outflow:
-                    # Find airports that could be arrived at through transfers.
-                    return simulate_passenger(
-                        itin_sofar + [flight.arrival_airport],
-                        departure_airport_arrival_time=flight.arrival_datetime)
-                elif random_number > (1.0 - terminal_flow):
-                    return itin_sofar + [flight.arrival_airport]
+        def simulate_passenger_on_connection_graph(itin_sofar, departure_airport_arrival_time):
+            """
+            This function simulates a passenger like simulate_passenger, but it takes the flights
+            available at each airport and their weights from the connection graph.
+            Passengers reaching days the graph does not cover are simulated by simulate_passenger.
+            """
+            graph = self.connection_graph
+            flight_store = graph.flight_store
+            connections = graph.get_departures(itin_sofar[-1], departure_airport_arrival_time)
+            if connections is None:
+                return simulate_passenger(itin_sofar, departure_airport_arrival_time)
+            while len(itin_sofar) - 1 < self.max_legs:
+                start, end, outbound_passengers = connections
+                flight_idxs = numpy.arange(start, end)
+                if self.use_layover_checking:
+                    logical = self.get_logical_destination_mask(
+                        itin_sofar, self.flight_store_airport_idxs[flight_store.arrival_airport_codes[start:end]])
+                    flight_idxs = flight_idxs[logical]
+                    outbound_passengers = outbound_passengers[logical]
+                if graph.layover_weighting is not None:
+                    # Filter out flights with a zero probability
+                    nonzero = outbound_passengers > 0
+                    flight_idxs = flight_idxs[nonzero]
+                    outbound_passengers = outbound_passengers[nonzero]
+                if len(flight_idxs) == 0:
+                    return itin_sofar
+                terminal_leg_probability = self.TERMINAL_LEG_PROBABILITIES[len(itin_sofar)]
+                continue_probs, terminal_probs, fallback_prob = sequential_choice_probabilities(
+                    outbound_passengers / outbound_passengers.sum(),
+                    1.0 - terminal_leg_probability,
+                    terminal_leg_probability)
+                outcome = numpy.searchsorted(
+                    numpy.cumsum(numpy.concatenate((continue_probs, terminal_probs))),
+                    rng.random(),
+                    side='right')
+                if outcome < len(flight_idxs):
+                    flight_idx = flight_idxs[outcome]
+                    itin_sofar = itin_sofar + [
+                        flight_store.airport_names[flight_store.arrival_airport_codes[flight_idx]]]
+                    connections = graph.get_connections(flight_idx)
+                    if connections is None:
+                        return simulate_passenger(itin_sofar, flight_store.arrival_times[flight_idx])
+                elif outcome < 2 * len(flight_idxs):
+                    flight_idx = flight_idxs[outcome - len(flight_idxs)]
+                    return itin_sofar + [
+                        flight_store.airport_names[flight_store.arrival_airport_codes[flight_idx]]]
                 else:
-                    inflow_sofar += inflow
-            # The function might not return in the for loop above due to floating point error.
-            # In this case we assume the passenger stops at the last arrival airport iterated over.
-            return itin_sofar + [flight.arrival_airport]
+                    return itin_sofar + [
+                        flight_store.airport_names[flight_store.arrival_airport_codes[flight_idxs[-1]]]]
+            return itin_sofar
 
         def simulate_passenger_on_aggregate_flows(itin_sofar):
             """
             This function simulates a passenger using the aggregate number of direct flight seats.
+            Each leg is sampled with a single random number from the cumulative
+            probabilities of its outcomes.
             """
-            seat_portion_so_far = 0.0
-            departure_airport = itin_sofar[-1]
-            if self.use_layover_checking:
-                initial_origin = itin_sofar[0]
-                layover_set = set(itin_sofar[1:])
-                valid_destinations = {}
-                for destination, seats in self.aggregated_seats[departure_airport].items():
-                    # filter out itineraries that have illogical layovers.
-                    if self.check_logical_layovers(itin_sofar + [destination]):
-                        if initial_origin == destination:
-                            raise Exception("Circular itinerary")
-                        valid_destinations[destination] = seats
-            else:
-                valid_destinations = self.aggregated_seats[departure_airport]
-            outgoing_seat_total = sum(valid_destinations.values())
-            for destination, seats in valid_destinations.items():
-                seat_portion_for_dest = float(seats) / outgoing_seat_total
-                terminal_dest_portion = seat_portion_for_dest * self.TERMINAL_LEG_PROBABILITIES[len(itin_sofar)] / (
-                    1.0 - seat_portion_so_far)
-                ongoing_portion = seat_portion_for_dest * (
-                    1.0 - self.TERMINAL_LEG_PROBABILITIES[len(itin_sofar) - 1]) / (1.0 - seat_portion_so_far)
-                random_number = random.random()
-                if len(itin_sofar) - 1 < self.max_legs and random_number <= ongoing_portion:
+            while len(itin_sofar) - 1 < self.max_legs:
+                destinations, cumulative_probs = self.get_aggregate_outcome_cdf(itin_sofar)
+                if len(destinations) == 0:
+                    break
+                outcome = bisect.bisect_right(cumulative_probs, rng.random())
+                if outcome < len(destinations):
                     # Find airports that could be arrived at through transfers.
-                    return simulate_passenger_on_aggregate_flows(itin_sofar + [destination])
-                elif random_number > (1.0 - terminal_dest_portion):
-                    return itin_sofar + [destination]
+                    itin_sofar = itin_sofar + [destinations[outcome]]
+                elif outcome < 2 * len(destinations):
+                    return itin_sofar + [destinations[outcome - len(destinations)]]
                 else:
-                    seat_portion_so_far += seat_portion_for_dest
-            # The function might not return in the for loop above due to floating point error.
-            # In this case we assume the passenger stops at the last destination iterated over.
-            return itin_sofar + [destination]
+                    # The passenger might not be assigned to any destination due to floating point error.
+                    # In this case we assume the passenger stops at the last destination.
+                    return itin_sofar + [destinations[-1]]
+            return itin_sofar
 
         if self.aggregated_seats:
             if len(self.aggregated_seats[starting_airport]) == 0:
                 # No outgoing flights for airport
                 return
+        if self.use_batch_simulation and not self.use_schedules:
+            for itinerary, passengers in self.calculate_itin_counts(
+                    starting_airport, simulated_passengers, seed=seed):
+                for i in range(passengers):
+                    yield list(itinerary)
+            return
         no_flight_sims = 0
         successful_sims = 0
         while successful_sims < simulated_passengers:
@@ -414,13 +1684,16 @@ class AirportFlowCalculator(object):
                 itinerary = simulate_passenger_on_aggregate_flows([starting_airport])
             else:
                 random_start_time = start_date + datetime.timedelta(
-                    seconds=random.randint(0, round((
+                    seconds=rng.randint(0, round((
                                                         datetime.timedelta(days=1) + end_date - start_date
                                                     ).total_seconds())))
-                itinerary = simulate_passenger(
+                simulate = simulate_passenger
+                if self.connection_graph is not None:
+                    simulate = simulate_passenger_on_connection_graph
+                itinerary = simulate(
                     [starting_airport],
                     # A random datetime within the given range is chosen.
-                    departure_airport_arrival_time=random_start_time)
+                    departure_airport_arrival_time=to_epoch_seconds(random_start_time))
             if len(itinerary) > 1:
                 no_flight_sims = 0
                 successful_sims += 1
@@ -432,26 +1705,203 @@ class AirportFlowCalculator(object):
                 # so the simulation can be stopped.
                 return
 
+    def calculate_itin_counts(self,
+                              starting_airport,
+                              simulated_passengers=100,
+                              start_date=datetime.datetime.now(),
+                              end_date=datetime.datetime.now(),
+                              seed=None):
+        """
+        Yield each simulated itinerary along with the number of passengers that followed it.
+        The batch simulation groups identical itineraries together, the other
+        simulations yield every passenger's itinerary separately.
+        """
+        if self.use_batch_simulation and not self.use_schedules:
+            if self.aggregated_seats and len(self.aggregated_seats[starting_airport]) == 0:
+                return
+            rng, random_state = create_random_generators(seed)
+            for itinerary, passengers in self.simulate_passengers_in_batch(
+                    starting_airport, simulated_passengers, random_state).items():
+                if len(itinerary) > 1:
+                    yield list(itinerary), passengers
+        else:
+            for itinerary in self.calculate_itins(
+                    starting_airport, simulated_passengers, start_date, end_date, seed=seed):
+                yield itinerary, 1
+
+    def calculate_totals(self,
+                         starting_airport,
+                         simulated_passengers=100,
+                         start_date=datetime.datetime.now(),
+                         end_date=datetime.datetime.now(),
+                         seed=None):
+        """
+        Simulate passengers and total up the trips that end at each airport.
+
+        :return: A dict mapping each terminal airport to the number of passengers that ended their trip there,
+          the total number of legs of their trips and the total distance of their trips.
+        """
+        totals = {}
+        for itinerary, passengers in self.calculate_itin_counts(
+                starting_airport, simulated_passengers, start_date, end_date, seed=seed):
+            terminal_airport = itinerary[-1]
+            airport_totals = totals.setdefault(terminal_airport, [0, 0, 0.0])
+            airport_totals[0] += passengers
+            airport_totals[1] += passengers * (len(itinerary) - 1)
+            airport_totals[2] += passengers * self.get_itinerary_distance(itinerary)
+        return totals
+
+    def calculate_sharded_totals(self,
+                                 starting_airport,
+                                 simulated_passengers=100,
+                                 start_date=datetime.datetime.now(),
+                                 end_date=datetime.datetime.now(),
+                                 seed=None,
+                                 shards=1,
+                                 processes=1):
+        """
+        Split the simulated passengers into shards that are simulated with independent random
+        streams derived from the seed and then merge their totals.
+        The shards are simulated in parallel when more than one process is used.
+        The result only depends on the seed and the number of shards, so it is the same
+        for any number of processes.
+        Processes are forked from the current one so the calculator is not copied up front.
+        When simulating with schedules the flights for the period should be preloaded
+        so the shards do not query the database.
+        When no seed is given a random one is drawn so the shards still have independent streams.
+        """
+        global _shard_calculator
+        if seed is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+        shard_args = [(
+            starting_airport,
+            simulated_passengers // shards + (1 if shard < simulated_passengers % shards else 0),
+            start_date,
+            end_date,
+            [seed, shard]) for shard in range(shards)]
+        if processes > 1:
+            _shard_calculator = self
+            pool = multiprocessing.Pool(processes)
+            try:
+                shard_totals = pool.map(_calculate_shard_totals, shard_args)
+            finally:
+                pool.close()
+                pool.join()
+                _shard_calculator = None
+        else:
+            shard_totals = [self.calculate_totals(*args) for args in shard_args]
+        # The totals are merged in shard order so the floating point sums are reproducible.
+        totals = {}
+        for shard_total in shard_totals:
+            for airport, (passengers, legs, distance) in sorted(shard_total.items()):
+                airport_totals = totals.setdefault(airport, [0, 0, 0.0])
+                airport_totals[0] += passengers
+                airport_totals[1] += legs
+                airport_totals[2] += distance
+        return totals
+
+    def calculate_adaptive_totals(self,
+                                  starting_airport,
+                                  start_date=datetime.datetime.now(),
+                                  end_date=datetime.datetime.now(),
+                                  seed=None,
+                                  shards=1,
+                                  processes=1,
+                                  target_error=0.005,
+                                  error_measure='confidence_interval',
+                                  min_passengers=1000,
+                                  max_passengers=100000):
+        """
+        Simulate batches of passengers until the estimated error of the terminal flows is within
+        the target error or max_passengers have been simulated. The first batch has min_passengers
+        and each following batch doubles the number simulated. Each batch has its own random stream
+        derived from the seed.
+
+        :return: The merged totals in the format calculate_totals returns and the number of passengers simulated.
+        """
+        if seed is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+        totals = {}
+        passengers_simulated = 0
+        batch = 0
+        while passengers_simulated < max_passengers:
+            batch_passengers = min(max(min_passengers, passengers_simulated), max_passengers - passengers_simulated)
+            if shards > 1:
+                batch_totals = self.calculate_sharded_totals(
+                    starting_airport, batch_passengers, start_date, end_date, [seed, batch], shards, processes)
+            else:
+                batch_totals = self.calculate_totals(
+                    starting_airport, batch_passengers, start_date, end_date, [seed, batch])
+            for airport, (passengers, legs, distance) in sorted(batch_totals.items()):
+                airport_totals = totals.setdefault(airport, [0, 0, 0.0])
+                airport_totals[0] += passengers
+                airport_totals[1] += legs
+                airport_totals[2] += distance
+            passengers_simulated += batch_passengers
+            batch += 1
+            if len(totals) == 0:
+                # There are no flights from the airport.
+                break
+            if estimate_terminal_flow_error(totals, passengers_simulated, error_measure) <= target_error:
+                break
+        return totals, passengers_simulated
+
     def calculate(self,
                   starting_airport,
                   simulated_passengers=100,
                   start_date=datetime.datetime.now(),
-                  end_date=datetime.datetime.now()):
-        terminal_passengers_by_airport = defaultdict(int)
-        trip_distances_by_airport = defaultdict(float)
-        trip_legs_by_airport = defaultdict(int)
-        for itinerary in self.calculate_itins(starting_airport, simulated_passengers, start_date, end_date):
-            terminal_airport = itinerary[-1]
-            terminal_passengers_by_airport[terminal_airport] += 1
-            trip_distances_by_airport[terminal_airport] += self.get_itinerary_distance(itinerary)
-            trip_legs_by_airport[terminal_airport] += len(itinerary) - 1
+                  end_date=datetime.datetime.now(),
+                  seed=None,
+                  shards=None,
+                  processes=1,
+                  target_error=None,
+                  error_measure='confidence_interval',
+                  min_passengers=1000,
+                  max_passengers=100000):
+        """
+        Calculate the fraction of passengers from the starting airport that end their trip at each airport
+        along with the average number of legs and distance of their trips.
+        Given a seed the results are reproducible. The passengers can be split into shards,
+        which are simulated in parallel when more than one process is used. Each shard has its own
+        random stream, so reproducing a result requires the same seed and number of shards.
+        By default there is a shard for each process.
+
+        When a target_error is given, simulated_passengers is ignored and passengers are simulated
+        in batches until the error_measure of the terminal flows is within it, using
+        at least min_passengers and at most max_passengers. The error measures are:
+        confidence_interval, the largest half-width of the terminal flows' 95% confidence intervals,
+        and total_variation, a bound on the expected total variation distance between the estimated
+        and true terminal flow distributions.
+
+        Every airport's result includes the number of passengers simulated, the half-width of the 95%
+        confidence interval for its terminal flow and the error_measure for the whole distribution.
+        """
+        if self.use_aggregate_solver and not self.use_schedules:
+            return self.solve_aggregate_flows(starting_airport)
+        if shards is None:
+            shards = processes
+        if target_error is not None:
+            totals, simulated_passengers = self.calculate_adaptive_totals(
+                starting_airport, start_date, end_date, seed, shards, processes,
+                target_error, error_measure, min_passengers, max_passengers)
+        elif shards > 1:
+            if seed is None:
+                seed = random.randint(0, 2 ** 31 - 1)
+            totals = self.calculate_sharded_totals(
+                starting_airport, simulated_passengers, start_date, end_date, seed, shards, processes)
+        else:
+            totals = self.calculate_totals(starting_airport, simulated_passengers, start_date, end_date, seed)
+        error = estimate_terminal_flow_error(totals, simulated_passengers, error_measure)
         return {
             airport: dict(
                 _id=airport,
                 terminal_flow=float(passengers_for_airport) / simulated_passengers,
-                average_legs=float(trip_legs_by_airport[airport]) / passengers_for_airport,
-                average_distance=float(trip_distances_by_airport[airport]) / passengers_for_airport)
-            for airport, passengers_for_airport in terminal_passengers_by_airport.items()
+                terminal_flow_error=terminal_flow_confidence_interval(passengers_for_airport, simulated_passengers),
+                average_legs=float(legs) / passengers_for_airport,
+                average_distance=float(distance) / passengers_for_airport,
+                simulated_passengers=simulated_passengers,
+                error=error)
+            for airport, (passengers_for_airport, legs, distance) in totals.items()
         }
 
 
@@ -486,6 +1936,57 @@ if __name__ == '__main__':
         help="""The number of passengers to simulate.
         """
     )
+    parser.add_argument(
+        "--seed", default=None,
+        help="""A seed for the random number generators that makes the results reproducible.
+        """
+    )
+    parser.add_argument(
+        "--processes", default=1,
+        help="""The number of processes to simulate shards of the passengers in.
+        Results are reproducible for a given seed and number of processes.
+        """
+    )
+    parser.add_argument(
+        "--target_error", default=None,
+        help="""Simulate passengers until the error of the terminal flows is within this
+        instead of simulating a fixed number of them.
+        """
+    )
+    parser.add_argument(
+        "--error_measure", default='confidence_interval',
+        choices=['confidence_interval', 'total_variation'],
+        help="""How the error is measured for --target_error.
+        """
+    )
+    parser.add_argument(
+        "--min_passengers", default=1000,
+        help="""The fewest passengers to simulate with --target_error.
+        """
+    )
+    parser.add_argument(
+        "--max_passengers", default=100000,
+        help="""The most passengers to simulate with --target_error.
+        """
+    )
+    parser.add_argument(
+        "--preload_flights", action='store_true',
+        help="""Load all the flights for the simulated period with a single query
+        before simulating.
+        """
+    )
+    parser.add_argument(
+        "--flight_store_path", default=None,
+        help="""A directory to save the preloaded flights to, or to memory-map them
+        from if they have already been saved there.
+        """
+    )
+    parser.add_argument(
+        "--connection_graph", action='store_true',
+        help="""Build a graph of the connections between the preloaded flights
+        and simulate passengers on it.
+        """
+    )
     args = parser.parse_args()
     print ("Calculating probabilities of a single passenger reaching each airport" +
            " from " + args.starting_airport)
@@ -509,13 +2010,30 @@ if __name__ == '__main__':
         pymongo.MongoClient(args.mongo_url)[args.db_name],
         aggregated_seats=aggregated_seats
     )
-    for airport_id, airport in calculator.calculate(
-            args.starting_airport,
-            simulated_passengers=int(args.simulated_passengers),
-            start_date=start_date,
-            end_date=end_date
-    ).items():
+    if args.preload_flights or args.flight_store_path or args.connection_graph:
+        preload_stats = calculator.preload_flights(start_date, end_date, args.flight_store_path)
+        print "Preloaded", preload_stats['flights'], "flights in", preload_stats['seconds'], "seconds"
+    if args.connection_graph:
+        graph_stats = calculator.build_connection_graph()
+        print "Built a graph of", graph_stats['connections'], "connections using", graph_stats['bytes'], \
+            "bytes in", graph_stats['seconds'], "seconds"
+    results = calculator.calculate(
+        args.starting_airport,
+        simulated_passengers=int(args.simulated_passengers),
+        start_date=start_date,
+        end_date=end_date,
+        seed=None if args.seed is None else int(args.seed),
+        processes=int(args.processes),
+        target_error=None if args.target_error is None else float(args.target_error),
+        error_measure=args.error_measure,
+        min_passengers=int(args.min_passengers),
+        max_passengers=int(args.max_passengers))
+    for airport_id, airport in results.items():
         print airport_id, airport['terminal_flow']
         cumulative_probability += airport['terminal_flow']
+    if len(results) > 0:
+        print "Simulated passengers:", results.values()[0].get('simulated_passengers')
+        print "Error:", results.values()[0].get('error')
     # This is a sanity check. cumulative_probability should sum to almost 1.
     print "Cumulative Probability:", cumulative_probability
+    print "Flight database queries:", calculator.flight_queries
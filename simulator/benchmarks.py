@@ -0,0 +1,344 @@
+"""
+Benchmarks for the performance sensitive parts of the simulator.
+
+To time the distance matrix construction for 1k, 5k and 10k airports:
+
+python benchmarks.py --sizes 1000,5000,10000
+
+To time loading flights, simulating itineraries and calculating flows on a synthetic
+hub-and-spoke flight network held in memory, so no database is needed:
+
+python benchmarks.py network --airports 500 --hubs 20 --days 7
+
+Results are printed as JSON.
+"""
+import time
+import random
+import json
+import datetime
+import subprocess
+import os
+from collections import defaultdict
+from geopy.distance import great_circle
+from AirportFlowCalculator import AirportFlowCalculator, compute_airport_distances, \
+    A_load_ratio, b_load_ratio
+
+
+def random_airport_coords(size, seed=1):
+    """
+    Generate airport codes and [longitude, latitude] coordinates
+    alphabetically sorted by code like compute_airport_distances expects.
+    """
+    rng = random.Random(seed)
+    return [
+        ('A%05d' % idx, [rng.uniform(-180, 180), rng.uniform(-60, 70)])
+        for idx in range(size)]
+
+
+def compute_airport_distances_with_geopy(airport_to_coords_items, rows=None):
+    """
+    The original distance matrix construction that calls geopy for every airport pair.
+    Only the first rows of the matrix are computed when rows is given.
+    """
+    rows = len(airport_to_coords_items) if rows is None else rows
+    result = []
+    for airport_a, (airport_a_long, airport_a_lat) in airport_to_coords_items[:rows]:
+        result.append([
+            great_circle(
+                (airport_a_lat, airport_a_long),
+                (airport_b_lat, airport_b_long)).kilometers
+            for airport_b, (airport_b_long, airport_b_lat) in airport_to_coords_items])
+    return result
+
+
+def benchmark_distances(size, reference_rows=20):
+    """
+    Time the vectorized distance matrix construction and compare it with geopy.
+    Calling geopy for every pair of 10k airports takes far too long to benchmark,
+    so the geopy time is extrapolated from the time taken for the first reference_rows rows.
+    The pairs in those rows are also used to check that the two implementations agree.
+    """
+    airport_to_coords_items = random_airport_coords(size)
+    start = time.time()
+    dist_mat = compute_airport_distances(airport_to_coords_items)
+    vectorized_seconds = time.time() - start
+    reference_rows = min(reference_rows, size)
+    start = time.time()
+    reference = compute_airport_distances_with_geopy(airport_to_coords_items, reference_rows)
+    # The original implementation only computed the upper triangle of the matrix.
+    geopy_seconds = (time.time() - start) * (size + 1) / 2.0 / reference_rows
+    max_difference = max(
+        abs(dist_mat.item(i, j) - reference[i][j])
+        for i in range(reference_rows)
+        for j in range(size))
+    return {
+        'airports': size,
+        'vectorizedSeconds': vectorized_seconds,
+        'estimatedGeopySeconds': geopy_seconds,
+        'speedup': geopy_seconds / vectorized_seconds,
+        'maxDifferenceKm': max_difference
+    }
+
+
+def generate_network(airports=500, hubs=20, days=7, start_date=datetime.datetime(2017, 2, 1), seed=1):
+    """
+    Generate a synthetic hub-and-spoke flight network. Hubs are connected to each other
+    and to many spokes, while spokes are connected to a few hubs and the odd other spoke,
+    so the airports' degrees are skewed like real networks'. Busier routes have more
+    flights each day.
+
+    :return: The airport documents, the flight documents and the aggregated direct passenger flows
+      in the formats of the airports collection, flights collection and compute_direct_passenger_flows.
+    """
+    rng = random.Random(seed)
+    airport_coords = random_airport_coords(airports, seed)
+    airport_docs = [{
+        '_id': airport,
+        'loc': {'type': 'Point', 'coordinates': coords}
+    } for airport, coords in airport_coords]
+    codes = [airport for airport, coords in airport_coords]
+    hub_codes = codes[:hubs]
+    routes = {}
+    for idx, origin in enumerate(codes):
+        if idx < hubs:
+            destinations = [hub for hub in hub_codes if hub != origin]
+        else:
+            destinations = rng.sample(hub_codes, min(hubs, rng.randint(1, 3)))
+            if rng.random() < 0.3:
+                destinations.append(rng.choice(codes[hubs:]))
+        for destination in destinations:
+            if destination == origin:
+                continue
+            # Flights are generated in both directions so passengers can return.
+            is_trunk = idx < hubs and destination in hub_codes
+            daily_flights = rng.randint(3, 8) if is_trunk else rng.randint(1, 3)
+            routes.setdefault((origin, destination), daily_flights)
+            routes.setdefault((destination, origin), daily_flights)
+    flight_docs = []
+    aggregated_flows = defaultdict(dict)
+    for (origin, destination), daily_flights in sorted(routes.items()):
+        for day in range(days):
+            for flight in range(daily_flights):
+                departure = start_date + datetime.timedelta(days=day, minutes=rng.randint(0, 24 * 60 - 1))
+                total_seats = rng.randint(50, 350)
+                flight_docs.append({
+                    '_id': len(flight_docs),
+                    'departureAirport': origin,
+                    'arrivalAirport': destination,
+                    'departureDateTime': departure,
+                    'arrivalDateTime': departure + datetime.timedelta(minutes=rng.randint(45, 12 * 60)),
+                    'totalSeats': total_seats
+                })
+                aggregated_flows[origin][destination] = (
+                    aggregated_flows[origin].get(destination, 0) +
+                    A_load_ratio * total_seats ** 2 + b_load_ratio * total_seats)
+    return airport_docs, flight_docs, aggregated_flows
+
+
+def matches(value, condition):
+    if isinstance(condition, dict):
+        for operator, operand in condition.items():
+            if operator == '$gt' and not value > operand:
+                return False
+            elif operator == '$gte' and not value >= operand:
+                return False
+            elif operator == '$lt' and not value < operand:
+                return False
+            elif operator == '$lte' and not value <= operand:
+                return False
+        return True
+    return value == condition
+
+
+class InMemoryCursor(list):
+    def batch_size(self, size):
+        return self
+
+
+class InMemoryCollection(object):
+    """
+    Holds documents in memory and answers the queries the calculator makes of the airports
+    and flights collections: equality and range conditions on fields with an optional projection.
+    Documents are indexed by departureAirport, when they have one, like the flights collection is.
+    """
+    def __init__(self, documents):
+        self.documents = documents
+        self.by_departure_airport = defaultdict(list)
+        for document in documents:
+            if 'departureAirport' in document:
+                self.by_departure_airport[document['departureAirport']].append(document)
+
+    def ensure_index(self, *args, **kwargs):
+        pass
+
+    def find(self, query=None, projection=None):
+        query = query or {}
+        documents = self.documents
+        if isinstance(query.get('departureAirport'), basestring):
+            documents = self.by_departure_airport.get(query['departureAirport'], [])
+        result = InMemoryCursor()
+        for document in documents:
+            if all(matches(document.get(field), condition) for field, condition in query.items()):
+                if projection:
+                    document = {
+                        field: value for field, value in document.items()
+                        if projection.get(field, field == '_id' and projection.get('_id', 1))}
+                result.append(document)
+        return result
+
+
+class InMemoryDatabase(object):
+    """
+    An in-memory data source with airports and flights collections that
+    a calculator can be created with in place of a Mongo database.
+    """
+    def __init__(self, airport_docs, flight_docs):
+        self.airports = InMemoryCollection(airport_docs)
+        self.flights = InMemoryCollection(flight_docs)
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return time.time() - start, result
+
+
+def benchmark_network(airports=500, hubs=20, days=7, passengers=2000, origins=5, seed=1):
+    """
+    Time the stages of simulating passengers on a generated network against an in-memory data source.
+    Passengers are simulated from the first origins hubs and the same number of spokes
+    with fixed seeds, so the work done is the same between runs.
+    """
+    start_date = datetime.datetime(2017, 2, 1)
+    end_date = start_date + datetime.timedelta(days=max(days - AirportFlowCalculator.PRELOAD_PADDING_DAYS - 1, 1))
+    generation_seconds, (airport_docs, flight_docs, aggregated_flows) = timed(
+        generate_network, airports, hubs, days, start_date, seed)
+    db = InMemoryDatabase(airport_docs, flight_docs)
+    codes = [airport['_id'] for airport in airport_docs]
+    origin_codes = codes[:origins] + codes[hubs:hubs + origins]
+    result = {
+        'network': {
+            'airports': airports,
+            'hubs': hubs,
+            'days': days,
+            'flights': len(flight_docs),
+            'routes': sum(len(destinations) for destinations in aggregated_flows.values()),
+            'generationSeconds': generation_seconds
+        },
+        'passengers': passengers,
+        'origins': origin_codes
+    }
+    result['calculatorSeconds'], calculator = timed(AirportFlowCalculator, db, aggregated_seats=aggregated_flows)
+    result['computeAirportDistancesSeconds'], noop = timed(
+        compute_airport_distances, calculator.airport_to_coords_items)
+
+    def get_all_flights():
+        for day in range(days):
+            for airport in codes:
+                calculator.get_flights_from_airport(airport, start_date + datetime.timedelta(days=day))
+    calculator.get_flights_from_airport.clear()
+    result['getFlightsFromAirportQueriedSeconds'], noop = timed(get_all_flights)
+    preload_stats = calculator.preload_flights(start_date, end_date)
+    result['preloadFlightsSeconds'] = preload_stats['seconds']
+    # Preloading keeps the flights memoized by the queried pass, which would otherwise be timed instead.
+    calculator.get_flights_from_airport.clear()
+    result['getFlightsFromAirportPreloadedSeconds'], noop = timed(get_all_flights)
+
+    def simulate(calculator):
+        for idx, origin in enumerate(origin_codes):
+            for itinerary in calculator.calculate_itins(
+                    origin, passengers, start_date, end_date, seed=[seed, idx]):
+                pass
+    result['calculateItinsSchedulesSeconds'], noop = timed(simulate, calculator)
+    graph_stats = calculator.build_connection_graph()
+    result['connectionGraph'] = graph_stats
+    result['calculateItinsConnectionGraphSeconds'], noop = timed(simulate, calculator)
+    calculator.connection_graph = None
+    aggregate_calculator = AirportFlowCalculator(
+        db, aggregated_seats=aggregated_flows, use_schedules=False,
+        airport_to_coords_items=calculator.airport_to_coords_items,
+        airport_distance_matrix=calculator.airport_distance_matrix)
+    result['calculateItinsAggregateSeconds'], noop = timed(simulate, aggregate_calculator)
+    result['calculateItinsBatchSeconds'], noop = timed(simulate, AirportFlowCalculator(
+        db, aggregated_seats=aggregated_flows, use_schedules=False, use_batch_simulation=True,
+        airport_to_coords_items=calculator.airport_to_coords_items,
+        airport_distance_matrix=calculator.airport_distance_matrix))
+
+    def solve(calculator):
+        for origin in origin_codes:
+            calculator.solve_aggregate_flows(origin)
+    result['solveAggregateFlowsSeconds'], noop = timed(solve, aggregate_calculator)
+    result['solveAggregateFlowsWithoutLayoverCheckingSeconds'], noop = timed(solve, AirportFlowCalculator(
+        db, aggregated_seats=aggregated_flows, use_schedules=False, use_layover_checking=False))
+
+    def calculate(calculator):
+        for idx, origin in enumerate(origin_codes):
+            calculator.calculate(origin, passengers, start_date, end_date, seed=[seed, idx])
+    result['calculateSchedulesSeconds'], noop = timed(calculate, calculator)
+    result['calculateAggregateSeconds'], noop = timed(calculate, aggregate_calculator)
+    return result
+
+
+def get_revision():
+    """
+    The git commit being benchmarked, so results can be compared between commits.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmark", nargs='?', default='distances', choices=['distances', 'network'],
+        help="The benchmarks to run."
+    )
+    parser.add_argument(
+        "--sizes", default='1000,5000,10000',
+        help="Comma separated numbers of airports to benchmark the distance matrix construction with."
+    )
+    parser.add_argument(
+        "--reference_rows", default=20,
+        help="The number of rows of the matrix to compute with geopy for comparison."
+    )
+    parser.add_argument(
+        "--airports", default=500,
+        help="The number of airports in the generated network."
+    )
+    parser.add_argument(
+        "--hubs", default=20,
+        help="The number of hub airports in the generated network."
+    )
+    parser.add_argument(
+        "--days", default=7,
+        help="The number of days of flights to generate."
+    )
+    parser.add_argument(
+        "--passengers", default=2000,
+        help="The number of passengers to simulate from each origin."
+    )
+    parser.add_argument(
+        "--origins", default=5,
+        help="The number of hubs and of spokes to simulate passengers from."
+    )
+    parser.add_argument(
+        "--seed", default=1,
+        help="The seed for generating the network and simulating passengers."
+    )
+    args = parser.parse_args()
+    if args.benchmark == 'network':
+        result = benchmark_network(
+            int(args.airports), int(args.hubs), int(args.days),
+            int(args.passengers), int(args.origins), int(args.seed))
+        result['revision'] = get_revision()
+        print json.dumps(result, sort_keys=True)
+    else:
+        for size in args.sizes.split(','):
+            print json.dumps(benchmark_distances(int(size), int(args.reference_rows)))
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 if 'MONGO_URI' in os.environ:
         mongo_uri = os.environ['MONGO_URI']
@@ -30,6 +31,98 @@ if 'SMTP_PORT' in os.environ:
 else:
         smtp_port=465
 
+# Whether each calculate_flows_for_airport task preloads all of its period's flights rather than
+# querying them for each airport and day it simulates. It only pays off when workers are dedicated
+# to a period, e.g. with CACHING_QUEUES, since each process keeps one period's flights at a time.
+# The tasks that calculate chunks of origins always preload their period's flights.
+if 'PRELOAD_FLIGHTS' in os.environ:
+        preload_flights = os.environ['PRELOAD_FLIGHTS'].lower() in ['1', 'true', 'yes']
+else:
+        preload_flights = False
+
+# Directory that flights preloaded for simulation periods are saved to and memory-mapped from.
+if 'FLIGHT_STORE_DIR' in os.environ:
+        flight_store_dir = os.environ['FLIGHT_STORE_DIR']
+else:
+        flight_store_dir = None
+
+# Whether to build a graph of the connections between the preloaded flights for each
+# period and simulate passengers on it. It speeds up finding the flights passengers
+# connect to at the cost of memory, which is logged with the graph's build time.
+if 'CONNECTION_GRAPH' in os.environ:
+        connection_graph = os.environ['CONNECTION_GRAPH'].lower() in ['1', 'true', 'yes']
+else:
+        connection_graph = False
+
+# Directory the airport flow calculator's distance matrix and aggregated flows are saved to
+# when a worker starts so its processes can memory-map one shared copy of them.
+if 'CALCULATOR_SNAPSHOT_DIR' in os.environ:
+        calculator_snapshot_dir = os.environ['CALCULATOR_SNAPSHOT_DIR']
+else:
+        calculator_snapshot_dir = os.path.join(tempfile.gettempdir(), 'flirt-calculator-snapshot')
+
+# Snapshots younger than this are reused when a worker restarts instead of being rebuilt.
+if 'CALCULATOR_SNAPSHOT_MAX_AGE_HOURS' in os.environ:
+        calculator_snapshot_max_age_hours = float(os.environ['CALCULATOR_SNAPSHOT_MAX_AGE_HOURS'])
+else:
+        calculator_snapshot_max_age_hours = 24
+
+# Directory the direct passenger flows for simulation periods are cached in
+# and the number of megabytes they may take up before the least recently used are deleted.
+if 'FLOW_CACHE_DIR' in os.environ:
+        flow_cache_dir = os.environ['FLOW_CACHE_DIR']
+else:
+        flow_cache_dir = os.path.join(tempfile.gettempdir(), 'flirt-flow-cache')
+
+if 'FLOW_CACHE_MAX_MB' in os.environ:
+        flow_cache_max_mb = float(os.environ['FLOW_CACHE_MAX_MB'])
+else:
+        flow_cache_max_mb = 512
+
+# The number of simulated itineraries inserted into the database at a time.
+if 'ITINERARY_BATCH_SIZE' in os.environ:
+        itinerary_batch_size = int(os.environ['ITINERARY_BATCH_SIZE'])
+else:
+        itinerary_batch_size = 1000
+
+# When set, the periodic passenger flow caching simulates passengers until the 95% confidence
+# interval of every destination's terminal flow is within this, using between the minimum and
+# maximum numbers of passengers. By default it is 0, which simulates a fixed 10000 passengers per airport.
+if 'FLOW_TARGET_ERROR' in os.environ:
+        flow_target_error = float(os.environ['FLOW_TARGET_ERROR'])
+else:
+        flow_target_error = 0
+
+if 'FLOW_MIN_PASSENGERS' in os.environ:
+        flow_min_passengers = int(os.environ['FLOW_MIN_PASSENGERS'])
+else:
+        flow_min_passengers = 2000
+
+if 'FLOW_MAX_PASSENGERS' in os.environ:
+        flow_max_passengers = int(os.environ['FLOW_MAX_PASSENGERS'])
+else:
+        flow_max_passengers = 100000
+
+# The number of periods whose direct passenger flows each worker process keeps in memory.
+if 'DIRECT_FLOW_WINDOWS' in os.environ:
+        direct_flow_windows = int(os.environ['DIRECT_FLOW_WINDOWS'])
+else:
+        direct_flow_windows = 3
+
+# The number of queues caching tasks are routed to by period, named caching.0, caching.1, etc.
+# With 1 every caching task is sent to the caching queue.
+if 'CACHING_QUEUES' in os.environ:
+        caching_queues = int(os.environ['CACHING_QUEUES'])
+else:
+        caching_queues = 1
+
+# Seconds to wait after publishing a new version of a simGroup's passenger flows
+# before deleting its old versions, so readers using them can finish.
+if 'FLOW_VERSION_CLEANUP_DELAY' in os.environ:
+        flow_version_cleanup_delay = int(os.environ['FLOW_VERSION_CLEANUP_DELAY'])
+else:
+        flow_version_cleanup_delay = 600
+
 # ************ATTENTION*************
 # Make sure to remove the user/password before commit changes to github.  A safer move would be to just set the env variables.
 if 'SMTP_USER' in os.environ:
@@ -0,0 +1,378 @@
+"""
+Maintains the dailyDirectFlows collection, a rollup of the flights collection
+with the number of flights, seats and passengers for each origin, destination
+and day. Summing its rows for the days in a period gives the same direct flows
+as aggregating the period's flights, but it only has one row per route and day.
+
+The rollup stores the sums of the seats and the squared seats on each route,
+so the passengers for any load ratio parameters can be computed from it.
+
+To rebuild or backfill the rollup for a period:
+
+python daily_flows.py rebuild --start_date 2017-01-01 --end_date 2018-01-01
+
+To update the rollup for flights that were added since it was last updated:
+
+python daily_flows.py update
+
+To check the rollup against the flights collection:
+
+python daily_flows.py check --start_date 2017-01-01 --end_date 2017-02-01
+
+Flights are loaded into the flights collection outside of this project, so the
+rollup is not updated when they are. Run the update after loading new flights.
+Until then, periods with flights inserted since their days were aggregated are
+stale and their flows are aggregated from the flights collection instead.
+"""
+import bson
+import datetime
+import pymongo
+from collections import defaultdict
+from AirportFlowCalculator import A_load_ratio, b_load_ratio, compute_direct_passenger_flows, \
+    compute_direct_seat_flows
+
+DAY = datetime.timedelta(1)
+# Flights departing in the days before the end of the rollup are re-aggregated
+# when it is updated so that late changes to them are picked up.
+UPDATE_REFRESH_DAYS = 7
+# The collection the rollup is stored in. Its status is stored in the collection with Status appended.
+ROLLUP_COLLECTION = 'dailyDirectFlows'
+
+
+def floor_day(date):
+    return datetime.datetime(date.year, date.month, date.day)
+
+
+def ceil_day(date):
+    day = floor_day(date)
+    return day if day == date else day + DAY
+
+
+def aggregate_daily_flows(db, start_date, end_date, include_end=False):
+    """
+    Aggregate the flights departing from start_date up to, but not including,
+    end_date into a row for each origin, destination and day.
+    Flights departing at end_date are included when include_end is True.
+    """
+    for row in db.flights.aggregate([
+        {
+            '$match': {
+                'departureDateTime': {
+                    '$gte': start_date,
+                    '$lte' if include_end else '$lt': end_date
+                }
+            }
+        }, {
+            '$group': {
+                '_id': {
+                    'departureAirport': '$departureAirport',
+                    'arrivalAirport': '$arrivalAirport',
+                    'year': {'$year': '$departureDateTime'},
+                    'month': {'$month': '$departureDateTime'},
+                    'day': {'$dayOfMonth': '$departureDateTime'}
+                },
+                'flights': {
+                    '$sum': 1
+                },
+                'totalSeats': {
+                    '$sum': '$totalSeats'
+                },
+                'totalSeatsSquared': {
+                    '$sum': {
+                        '$multiply': ['$totalSeats', '$totalSeats']
+                    }
+                }
+            }
+        }
+    ], allowDiskUse=True):
+        key = row['_id']
+        yield {
+            'departureAirport': key['departureAirport'],
+            'arrivalAirport': key['arrivalAirport'],
+            'date': datetime.datetime(key['year'], key['month'], key['day']),
+            'flights': row['flights'],
+            'totalSeats': row['totalSeats'],
+            'totalSeatsSquared': row['totalSeatsSquared'],
+            'totalPassengers': A_load_ratio * row['totalSeatsSquared'] + b_load_ratio * row['totalSeats']
+        }
+
+
+def add_period(periods, start_date, end_date, updated_at):
+    """
+    Add a [start, end) period of days that were aggregated at updated_at to the
+    periods the rollup covers, replacing the parts of the periods it overlaps.
+    """
+    result = []
+    for period_start, period_end, period_updated_at in periods:
+        if period_start < start_date:
+            result.append([period_start, min(period_end, start_date), period_updated_at])
+        if period_end > end_date:
+            result.append([max(period_start, end_date), period_end, period_updated_at])
+    result.append([start_date, end_date, updated_at])
+    return sorted(result)
+
+
+def get_status(db, collection_name=ROLLUP_COLLECTION):
+    status = db[collection_name + 'Status'].find_one({'_id': collection_name}) or {'periods': []}
+    # Periods recorded before their update times were stored are treated as stale.
+    status['periods'] = sorted(period if len(period) > 2 else period + [None] for period in status['periods'])
+    return status
+
+
+def rebuild_daily_flows(db, start_date, end_date, batch_days=31, collection_name=ROLLUP_COLLECTION):
+    """
+    Re-aggregate the rollup rows for the whole days between start_date and end_date.
+    Rows are upserted in unordered bulk writes a batch of days at a time, then
+    rows for routes that no longer have flights on those days are removed.
+    :return: The number of rows written.
+    """
+    rollup = db[collection_name]
+    rollup.create_index([
+        ('date', pymongo.ASCENDING),
+        ('departureAirport', pymongo.ASCENDING),
+        ('arrivalAirport', pymongo.ASCENDING)
+    ], unique=True)
+    start_date = floor_day(start_date)
+    end_date = ceil_day(end_date)
+    rebuild_start = datetime.datetime.utcnow()
+    rows_written = 0
+    batch_start = start_date
+    while batch_start < end_date:
+        batch_end = min(batch_start + datetime.timedelta(batch_days), end_date)
+        updated_at = datetime.datetime.utcnow()
+        requests = []
+        for row in aggregate_daily_flows(db, batch_start, batch_end):
+            row['updatedAt'] = updated_at
+            requests.append(pymongo.ReplaceOne({
+                'date': row['date'],
+                'departureAirport': row['departureAirport'],
+                'arrivalAirport': row['arrivalAirport']
+            }, row, upsert=True))
+        if len(requests) > 0:
+            rollup.bulk_write(requests, ordered=False)
+        rollup.delete_many({
+            'date': {
+                '$gte': batch_start,
+                '$lt': batch_end
+            },
+            'updatedAt': {
+                '$lt': updated_at
+            }
+        })
+        rows_written += len(requests)
+        batch_start = batch_end
+    # The period is recorded as of when its rebuild started so flights inserted
+    # while it was being aggregated make it stale.
+    status = get_status(db, collection_name)
+    db[collection_name + 'Status'].replace_one({'_id': collection_name}, {
+        'periods': add_period(status['periods'], start_date, end_date, rebuild_start),
+        'updatedAt': datetime.datetime.utcnow()
+    }, upsert=True)
+    return rows_written
+
+
+def update_daily_flows(db, refresh_days=UPDATE_REFRESH_DAYS, collection_name=ROLLUP_COLLECTION):
+    """
+    Extend the rollup to the last day with flights, re-aggregating the last
+    refresh_days days it already covers in case their flights changed.
+    :return: The number of rows written.
+    """
+    latest_flight = db.flights.find_one(sort=[('departureDateTime', pymongo.DESCENDING)])
+    if latest_flight is None:
+        return 0
+    end_date = floor_day(latest_flight['departureDateTime']) + DAY
+    periods = get_status(db, collection_name)['periods']
+    if len(periods) > 0:
+        start_date = max(period_end for period_start, period_end, updated_at in periods) - \
+            datetime.timedelta(refresh_days)
+    else:
+        earliest_flight = db.flights.find_one(sort=[('departureDateTime', pymongo.ASCENDING)])
+        start_date = earliest_flight['departureDateTime']
+    return rebuild_daily_flows(db, start_date, end_date, collection_name=collection_name)
+
+
+def get_rollup_days(start_date, end_date):
+    """
+    The whole days between start_date and end_date that are summed from the rollup
+    as a [start, end) period. The rest of the period is aggregated from the flights.
+    """
+    return ceil_day(start_date), max(ceil_day(start_date), floor_day(end_date))
+
+
+def get_covering_periods(db, start_date, end_date, collection_name=ROLLUP_COLLECTION):
+    """
+    The rollup's periods that cover the whole days between start_date and end_date,
+    or None when some of the days have not been aggregated.
+    """
+    first_day, last_day = get_rollup_days(start_date, end_date)
+    covering_periods = []
+    for period in get_status(db, collection_name)['periods']:
+        if first_day >= last_day:
+            break
+        period_start, period_end, updated_at = period
+        if period_start <= first_day < period_end:
+            covering_periods.append(period)
+            first_day = period_end
+    return covering_periods if first_day >= last_day else None
+
+
+def covers(db, start_date, end_date, collection_name=ROLLUP_COLLECTION):
+    """
+    Whether the rollup has been built for all the whole days between start_date and end_date.
+    """
+    return get_covering_periods(db, start_date, end_date, collection_name) is not None
+
+
+def is_current(db, start_date, end_date, collection_name=ROLLUP_COLLECTION):
+    """
+    Whether the rollup covers the whole days between start_date and end_date and no flights
+    departing on them have been inserted since they were aggregated, going by the creation
+    times of the flights' ObjectIds. Flights modified in place are not detected.
+    """
+    covering_periods = get_covering_periods(db, start_date, end_date, collection_name)
+    if covering_periods is None:
+        return False
+    first_day, last_day = get_rollup_days(start_date, end_date)
+    for period_start, period_end, updated_at in covering_periods:
+        if updated_at is None:
+            return False
+        # ObjectIds only have whole seconds, so flights inserted in the same second count as newer.
+        if db.flights.find_one({
+            '_id': {
+                '$gte': bson.ObjectId.from_datetime(updated_at)
+            },
+            'departureDateTime': {
+                '$gte': max(period_start, first_day),
+                '$lt': min(period_end, last_day)
+            }
+        }, {'_id': 1}) is not None:
+            return False
+    return True
+
+
+def compute_daily_direct_flows(
+    db, start_date, end_date,
+    A_load_ratio_p=A_load_ratio, b_load_ratio_p=b_load_ratio, seats=False,
+    collection_name=ROLLUP_COLLECTION):
+    """
+    Sum the flows for the flights departing from start_date up to and including end_date,
+    the same ones the flows aggregated from the flights collection for a period include,
+    into a dict of dicts like compute_direct_passenger_flows, or compute_direct_seat_flows
+    when seats is True. The whole days are summed from the rollup, and the flights on the
+    partial days before and after them, such as those departing exactly at an end_date at
+    midnight, are aggregated from the flights collection.
+    """
+    first_day, last_day = get_rollup_days(start_date, end_date)
+    route_totals = defaultdict(lambda: [0, 0])
+    if first_day < last_day:
+        edges = [(start_date, first_day, False), (last_day, end_date, True)]
+    else:
+        edges = [(start_date, end_date, True)]
+    for edge_start, edge_end, include_end in edges:
+        if edge_start < edge_end or include_end:
+            for row in aggregate_daily_flows(db, edge_start, edge_end, include_end):
+                totals = route_totals[(row['departureAirport'], row['arrivalAirport'])]
+                totals[0] += row['totalSeats']
+                totals[1] += row['totalSeatsSquared']
+    for pair in db[collection_name].aggregate([
+        {
+            '$match': {
+                'date': {
+                    '$gte': first_day,
+                    '$lt': last_day
+                }
+            }
+        }, {
+            '$group': {
+                '_id': {
+                    'departureAirport': '$departureAirport',
+                    'arrivalAirport': '$arrivalAirport'
+                },
+                'totalSeats': {
+                    '$sum': '$totalSeats'
+                },
+                'totalSeatsSquared': {
+                    '$sum': '$totalSeatsSquared'
+                }
+            }
+        }
+    ]):
+        totals = route_totals[(pair['_id']['departureAirport'], pair['_id']['arrivalAirport'])]
+        totals[0] += pair['totalSeats']
+        totals[1] += pair['totalSeatsSquared']
+    result = defaultdict(dict)
+    for (origin, destination), (total_seats, total_seats_squared) in route_totals.items():
+        if seats:
+            flow = total_seats
+        else:
+            flow = A_load_ratio_p * total_seats_squared + b_load_ratio_p * total_seats
+        if flow > 0:
+            result[origin][destination] = flow
+    return result
+
+
+def check_daily_flows(db, start_date, end_date, relative_tolerance=1e-6, collection_name=ROLLUP_COLLECTION):
+    """
+    Compare the seat and passenger flows summed from the rollup with ones aggregated
+    from the flights collection with the same query the simulation tasks use.
+    :return: A list of the routes where they differ with the raw and rollup flows.
+    """
+    match_query = {
+        'departureDateTime': {
+            '$gte': start_date,
+            '$lte': end_date
+        }
+    }
+    mismatches = []
+    for flow_type, raw_flows, rollup_flows in [
+        ('seats',
+         compute_direct_seat_flows(db, match_query),
+         compute_daily_direct_flows(db, start_date, end_date, seats=True, collection_name=collection_name)),
+        ('passengers',
+         compute_direct_passenger_flows(db, match_query),
+         compute_daily_direct_flows(db, start_date, end_date, collection_name=collection_name))]:
+        for origin in set(raw_flows) | set(rollup_flows):
+            raw_destinations = raw_flows.get(origin, {})
+            rollup_destinations = rollup_flows.get(origin, {})
+            for destination in set(raw_destinations) | set(rollup_destinations):
+                raw_flow = raw_destinations.get(destination, 0)
+                rollup_flow = rollup_destinations.get(destination, 0)
+                if abs(raw_flow - rollup_flow) > relative_tolerance * max(abs(raw_flow), abs(rollup_flow)):
+                    mismatches.append({
+                        'type': flow_type,
+                        'departureAirport': origin,
+                        'arrivalAirport': destination,
+                        'raw': raw_flow,
+                        'rollup': rollup_flow
+                    })
+    return mismatches
+
+
+if __name__ == '__main__':
+    import argparse
+    import config
+    from dateutil import parser as dateparser
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['rebuild', 'update', 'check'])
+    parser.add_argument('--start_date', default=None)
+    parser.add_argument('--end_date', default=None)
+    parser.add_argument(
+        '--refresh_days', default=UPDATE_REFRESH_DAYS,
+        help="The number of days at the end of the rollup to re-aggregate when updating it.")
+    args = parser.parse_args()
+    db = pymongo.MongoClient(config.mongo_uri)[config.mongo_db_name]
+    if args.command == 'update':
+        print "Rows written:", update_daily_flows(db, int(args.refresh_days))
+    else:
+        if args.start_date is None or args.end_date is None:
+            parser.error('--start_date and --end_date are required to ' + args.command)
+        start_date = dateparser.parse(args.start_date)
+        end_date = dateparser.parse(args.end_date)
+        if args.command == 'rebuild':
+            print "Rows written:", rebuild_daily_flows(db, start_date, end_date)
+        else:
+            mismatches = check_daily_flows(db, start_date, end_date)
+            for mismatch in mismatches:
+                print mismatch
+            print "Mismatched routes:", len(mismatches)
@@ -1,13 +1,20 @@
 import celery
 import logging
+import os
 import pymongo
+import pymongo.errors
 import datetime
-from AirportFlowCalculator import AirportFlowCalculator, compute_direct_passenger_flows
+import time
+import zlib
+import multiprocessing
+from celery.signals import worker_init
+from AirportFlowCalculator import AirportFlowCalculator, FlowMatrixCache, compute_direct_passenger_flows
 from dateutil import parser as dateparser
 import config
+import daily_flows
 import smtplib
 from email.mime.text import MIMEText
-from pylru import lrudecorator
+from pylru import lrudecorator, lrucache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -24,100 +31,766 @@ celery_tasks.conf.update(
     }
 )
 
-@lrudecorator(3)
+@lrudecorator(1)
+def get_flow_matrix_cache():
+    return FlowMatrixCache(config.flow_cache_dir, int(config.flow_cache_max_mb * 1024 * 1024))
+
+# The direct passenger flows for the periods most recently simulated by this process
+direct_passenger_flow_windows = lrucache(config.direct_flow_windows)
+
+def get_flights_version(db, start_date, end_date):
+    """
+    Identify the flights departing between the given dates by their number and the id
+    of the last one inserted, which change when flights are loaded for or removed from the period.
+    Flights modified in place are not detected.
+    """
+    for row in db.flights.aggregate([
+        {
+            '$match': {
+                'departureDateTime': {
+                    '$lte': end_date,
+                    '$gte': start_date
+                }
+            }
+        }, {
+            '$group': {
+                '_id': None,
+                'flights': {
+                    '$sum': 1
+                },
+                'lastId': {
+                    '$max': '$_id'
+                }
+            }
+        }
+    ]):
+        return '{0}-{1}'.format(row['flights'], row['lastId'])
+    return 'none'
+
 def get_direct_passenger_flows(start_date, end_date):
-    return compute_direct_passenger_flows(
-        pymongo.MongoClient(config.mongo_uri)[config.mongo_db_name], {
+    """
+    The direct passenger flows between the given dates. The flows for the most recent
+    periods are kept in memory, and they are cached on disk so that they are only
+    aggregated once per period rather than once per period in each process and after
+    every worker restart. The disk cache is keyed by the version of the period's flights,
+    so flows cached before flights were loaded for the period are recomputed.
+    They are summed from the daily flow rollup when it covers the period
+    and no flights have been inserted for it since it was aggregated.
+    """
+    if (start_date, end_date) in direct_passenger_flow_windows:
+        return direct_passenger_flow_windows[(start_date, end_date)]
+    db = get_database()
+    def compute_flows():
+        if daily_flows.is_current(db, start_date, end_date):
+            return daily_flows.compute_daily_direct_flows(db, start_date, end_date)
+        return compute_direct_passenger_flows(db, {
             "departureDateTime": {
                 "$lte": end_date,
                 "$gte": start_date
             }
         })
+    flow_matrix_cache = get_flow_matrix_cache()
+    result = flow_matrix_cache.get(FlowMatrixCache.key(
+        start_date, end_date, version=get_flights_version(db, start_date, end_date)), compute_flows)
+    logger.info("Direct passenger flow cache stats: %s", flow_matrix_cache.stats())
+    direct_passenger_flow_windows[(start_date, end_date)] = result
+    return result
+
+def get_caching_queue(start_date, end_date):
+    """
+    The queue the caching tasks for a period are sent to. Periods are hashed to one of
+    config.caching_queues queues so that all the tasks for a period go to the same workers
+    and several periods can be cached at once without every worker loading all of them.
+    """
+    if config.caching_queues <= 1:
+        return 'caching'
+    return 'caching.{0}'.format(zlib.crc32(start_date + '-' + end_date) % config.caching_queues)
+
+def start_period_caching(db, sim_group, start_date, end_date, queued_tasks, sim_version=None, local=False):
+    """
+    Reset the statistics for caching a period's flows in the cachingStats collection.
+    Periods calculated locally rather than by queued tasks do not have a queue.
+    """
+    db.cachingStats.replace_one({'_id': sim_group}, {
+        'simVersion': sim_version,
+        'startDate': start_date,
+        'endDate': end_date,
+        'queue': None if local else get_caching_queue(start_date, end_date),
+        'queuedTasks': queued_tasks,
+        'completedTasks': 0,
+        'windowCacheHits': 0,
+        'diskCacheHits': 0,
+        'cacheMisses': 0,
+        'queuedTime': datetime.datetime.utcnow()
+    }, upsert=True)
+
+def record_period_task(db, sim_group, cache_result):
+    """
+    Count a completed caching task for the period and whether the period's direct flows
+    were in the worker's memory (windowCacheHits), were loaded from its disk cache
+    (diskCacheHits) or had to be computed (cacheMisses).
+    """
+    db.cachingStats.update_one({'_id': sim_group}, {
+        '$inc': {
+            'completedTasks': 1,
+            cache_result: 1
+        },
+        '$currentDate': {'updatedTime': True}
+    }, upsert=True)
+
+def get_direct_passenger_flows_with_cache_result(start_date, end_date):
+    """
+    Get the direct passenger flows for a period along with which cache they came from
+    for record_period_task.
+    """
+    if (start_date, end_date) in direct_passenger_flow_windows:
+        return get_direct_passenger_flows(start_date, end_date), 'windowCacheHits'
+    disk_cache_hits = get_flow_matrix_cache().hits
+    flows = get_direct_passenger_flows(start_date, end_date)
+    if get_flow_matrix_cache().hits > disk_cache_hits:
+        return flows, 'diskCacheHits'
+    return flows, 'cacheMisses'
 
 @lrudecorator(1)
 def get_database():
     db = pymongo.MongoClient(config.mongo_uri)[config.mongo_db_name]
+    db.flights.ensure_index('departureDateTime')
     db.passengerFlows.ensure_index('simGroup')
+    db.passengerFlows.ensure_index([
+        ('simGroup', pymongo.ASCENDING),
+        ('departureAirport', pymongo.ASCENDING),
+        ('arrivalAirport', pymongo.ASCENDING)
+    ])
+    db.passengerFlows.ensure_index('versionOf', sparse=True)
+    db.aggregated_itineraries.ensure_index([
+        ('simulationId', pymongo.ASCENDING),
+        ('origin', pymongo.ASCENDING),
+        ('destination', pymongo.ASCENDING)
+    ], unique=True)
     return db
 
+def build_calculator_snapshot():
+    """
+    Compute the airport flow calculator's immutable state and save it as a snapshot
+    unless a recent enough one already exists.
+    """
+    path = config.calculator_snapshot_dir
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < config.calculator_snapshot_max_age_hours * 3600:
+        logger.info("Using the existing calculator snapshot in %s", path)
+        return
+    start = time.time()
+    # A separate client is used so the forked worker processes do not inherit a cached one.
+    db = pymongo.MongoClient(config.mongo_uri)[config.mongo_db_name]
+    all_time_direct_passenger_flows = compute_direct_passenger_flows(db, {})
+    AirportFlowCalculator(db, aggregated_seats=all_time_direct_passenger_flows).save_snapshot(path)
+    db.client.close()
+    logger.info("Saved the calculator snapshot to %s in %.1f seconds", path, time.time() - start)
+
+@worker_init.connect
+def on_worker_init(**kwargs):
+    """
+    Build the calculator snapshot once in the parent worker process before it forks
+    the pool processes, so they can all memory-map it rather than each computing
+    the flows and distance matrix themselves.
+    """
+    build_calculator_snapshot()
+
 @lrudecorator(1)
 def get_airport_flow_calculator():
     """
     Initialize global variables that can be reused between tasks and if required.
+    The calculator is loaded from the snapshot built when the worker started when there is one.
     """
     db = get_database()
+    if os.path.exists(config.calculator_snapshot_dir):
+        return AirportFlowCalculator.from_snapshot(db, config.calculator_snapshot_dir)
     all_time_direct_passenger_flows = compute_direct_passenger_flows(db, {})
     return AirportFlowCalculator(db, aggregated_seats=all_time_direct_passenger_flows)
 
+@lrudecorator(1)
+def preload_flights(start_date, end_date):
+    """
+    Preload the flights for the period into the calculator so the tasks
+    for it do not need to query the database for each airport and day.
+    This is memoized so it only happens once per period in each process.
+    """
+    if config.flight_store_dir:
+        path = os.path.join(config.flight_store_dir, 'flights-{0}-{1}'.format(
+            start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d')))
+    else:
+        path = None
+    calculator = get_airport_flow_calculator()
+    stats = calculator.preload_flights(start_date, end_date, path)
+    logger.info("Preloaded %s flights for %s to %s in %.1f seconds", stats['flights'],
+                start_date, end_date, stats['seconds'])
+    if config.connection_graph:
+        graph_stats = calculator.build_connection_graph()
+        logger.info("Built a graph of %s connections using %.1f MB in %.1f seconds",
+                    graph_stats['connections'], graph_stats['bytes'] / 1e6, graph_stats['seconds'])
+        stats['connectionGraph'] = graph_stats
+    return stats
+
 @celery_tasks.task(name='tasks.calculate_flows_for_airport', acks_late=True)
-def calculate_flows_for_airport(origin_airport_id, start_date, end_date, sim_group):
+def calculate_flows_for_airport(origin_airport_id, start_date, end_date, sim_group, sim_version=None):
     """
     Calculate the numbers of passengers that flow from the given origin to every other airport
     over the interval starting at start_date and store them in the passengerFlows collection.
+    When a sim_version is given the flows are written to that version of the simGroup,
+    which becomes visible when it is published with publish_flow_version. Otherwise the
+    origin's flows in the simGroup are replaced directly.
     """
     SIMULATED_PASSENGERS = 10000
     start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
     end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
-    period_days = (end_date - start_date).days
-    direct_passenger_flows = get_direct_passenger_flows(start_date, end_date)
+    direct_passenger_flows, cache_result = get_direct_passenger_flows_with_cache_result(start_date, end_date)
     db = get_database()
     my_airport_flow_calculator = get_airport_flow_calculator()
-    # Drop all results for origin airport
-    db.passengerFlows.delete_many({
-        'departureAirport': origin_airport_id,
-        'simGroup': sim_group
-    })
+    if config.preload_flights:
+        preload_flights(start_date, end_date)
+    if sim_version is None:
+        # Drop all results for origin airport
+        db.passengerFlows.delete_many({
+            'departureAirport': origin_airport_id,
+            'simGroup': sim_group
+        })
     results = my_airport_flow_calculator.calculate(
         origin_airport_id,
         simulated_passengers=SIMULATED_PASSENGERS,
         start_date=start_date,
-        end_date=end_date)
+        end_date=end_date,
+        target_error=config.flow_target_error or None,
+        min_passengers=config.flow_min_passengers,
+        max_passengers=config.flow_max_passengers)
     if len(results) > 0:
-        seats_per_pasenger = sum(legs * value for legs, value in AirportFlowCalculator.LEG_PROBABILITY_DISTRIBUTION.items())
-        total_direct_passengers = sum(direct_passenger_flows[origin_airport_id].values())
-        total_passengers = int(float(total_direct_passengers) / seats_per_pasenger)
-        db.passengerFlows.insert_many({
-            'departureAirport': origin_airport_id,
-            'arrivalAirport': k,
-            'estimatedPassengers': v['terminal_flow'] * total_passengers,
-            'averageDistance': v['average_distance'],
-            'recordDate': datetime.datetime.now(),
-            'startDateTime': start_date,
-            'endDateTime': end_date,
-            'periodDays': period_days,
-            'simGroup': sim_group
-        } for k, v in results.items())
-        return len(results)
+        write_passenger_flows(db, create_passenger_flow_documents(
+            origin_airport_id, results, direct_passenger_flows, start_date, end_date, sim_group), sim_version)
     else:
         print "No flights from: " + origin_airport_id
+    record_period_task(db, sim_group, cache_result)
+    return len(results)
+
+def create_passenger_flow_documents(origin_airport_id, results, direct_passenger_flows, start_date, end_date, sim_group):
+    """
+    Create the passengerFlows documents for the calculator results for an origin by scaling
+    the terminal flows by the number of passengers departing from it.
+    """
+    seats_per_pasenger = sum(legs * value for legs, value in AirportFlowCalculator.LEG_PROBABILITY_DISTRIBUTION.items())
+    total_direct_passengers = sum(direct_passenger_flows[origin_airport_id].values())
+    total_passengers = int(float(total_direct_passengers) / seats_per_pasenger)
+    record_date = datetime.datetime.now()
+    return [{
+        'departureAirport': origin_airport_id,
+        'arrivalAirport': k,
+        'estimatedPassengers': v['terminal_flow'] * total_passengers,
+        'averageDistance': v['average_distance'],
+        'simulatedPassengers': v.get('simulated_passengers'),
+        'terminalFlowError': v.get('terminal_flow_error'),
+        'estimationError': v.get('error'),
+        'recordDate': record_date,
+        'startDateTime': start_date,
+        'endDateTime': end_date,
+        'periodDays': (end_date - start_date).days,
+        'simGroup': sim_group
+    } for k, v in results.items()]
+
+def get_version_sim_group(sim_group, sim_version):
+    """
+    The simGroup a version of a simGroup's flows is written to. Versions are written to their own
+    simGroup so readers of the simGroup do not see them while they are being written.
+    Versions are ObjectId strings, so later versions sort after earlier ones.
+    """
+    if sim_version is None:
+        return sim_group
+    return '{0}@{1}'.format(sim_group, sim_version)
+
+def write_passenger_flows(db, documents, sim_version=None):
+    """
+    Write passengerFlows documents to a version of their simGroup with unordered bulk upserts,
+    so a redelivered task overwrites the flows it already wrote rather than duplicating them.
+    Without a version the documents are inserted into their simGroup.
+    """
+    if sim_version is None:
+        db.passengerFlows.insert_many(documents, ordered=False)
+        return
+    requests = []
+    for document in documents:
+        document['versionOf'] = document['simGroup']
+        document['simGroup'] = get_version_sim_group(document['simGroup'], sim_version)
+        document['simVersion'] = sim_version
+        requests.append(pymongo.ReplaceOne({
+            'simGroup': document['simGroup'],
+            'departureAirport': document['departureAirport'],
+            'arrivalAirport': document['arrivalAirport']
+        }, document, upsert=True))
+    db.passengerFlows.bulk_write(requests, ordered=False)
+
+def get_published_flows_query(db, sim_group):
+    """
+    A query for the passengerFlows documents of the published version of a simGroup.
+    SimGroups that were not written as versions are queried directly.
+    """
+    published = db.passengerFlowVersions.find_one({'_id': sim_group})
+    if published is None:
+        return {'simGroup': sim_group}
+    return {'simGroup': published['simGroup']}
+
+def publish_passenger_flows(db, sim_group, sim_version, schedule_cleanup=True):
+    """
+    Make a fully written version of a simGroup's flows the published one
+    by atomically updating its passengerFlowVersions pointer, then schedule
+    the removal of its older versions once readers have moved on to it.
+    Without schedule_cleanup, e.g. when there are no workers, they are removed immediately.
+    A version is not published over a later one, which makes it one of the older versions.
+    :return: Whether the version was published.
+    """
+    try:
+        db.passengerFlowVersions.update_one({
+            '_id': sim_group,
+            '$or': [
+                {'version': {'$lt': sim_version}},
+                {'version': {'$exists': False}}
+            ]
+        }, {
+            '$set': {
+                'simGroup': get_version_sim_group(sim_group, sim_version),
+                'version': sim_version,
+                'publishedTime': datetime.datetime.utcnow()
+            }
+        }, upsert=True)
+    except pymongo.errors.DuplicateKeyError:
+        # The pointer exists but did not match, so a later version has been published.
+        logger.info("Not publishing version %s of %s over a later version", sim_version, sim_group)
+        published = False
+    else:
+        logger.info("Published version %s of %s", sim_version, sim_group)
+        published = True
+    if schedule_cleanup:
+        cleanup_flow_versions.apply_async((sim_group,), countdown=config.flow_version_cleanup_delay)
+    else:
+        delete_old_flow_versions(db, sim_group)
+    return published
+
+@celery_tasks.task(name='tasks.publish_flow_version')
+def publish_flow_version(results, sim_group, sim_version):
+    """
+    Publish a version of a simGroup's flows. It is the callback of the chord of
+    calculate_flows_for_airport tasks that write the version, so it only runs if all of them succeed.
+    """
+    publish_passenger_flows(get_database(), sim_group, sim_version)
+    return sim_version
+
+def delete_old_flow_versions(db, sim_group, batch_size=10000):
+    """
+    Delete the versions of a simGroup's flows older than its published version, and the flows
+    written to the simGroup itself before it was versioned, in batches so the deletion does not
+    hold up other writes for long. Later versions are left alone since they may still be being written.
+    :return: The number of flows deleted.
+    """
+    published = db.passengerFlowVersions.find_one({'_id': sim_group})
+    if published is None:
         return 0
+    deleted = 0
+    while True:
+        ids = [doc['_id'] for doc in db.passengerFlows.find({
+            '$or': [
+                {'simGroup': sim_group},
+                {'versionOf': sim_group, 'simVersion': {'$lt': published['version']}}
+            ]
+        }, {'_id': 1}).limit(batch_size)]
+        if len(ids) == 0:
+            break
+        deleted += db.passengerFlows.delete_many({'_id': {'$in': ids}}).deleted_count
+    logger.info("Deleted %s old flows of %s", deleted, sim_group)
+    return deleted
+
+@celery_tasks.task(name='tasks.cleanup_flow_versions')
+def cleanup_flow_versions(sim_group, batch_size=10000):
+    """
+    Delete the versions of a simGroup's flows older than its published version.
+    """
+    return delete_old_flow_versions(get_database(), sim_group, batch_size)
+
+def get_period_origins(db):
+    """
+    The origins to calculate a period's flows for. Each origin's position in
+    the list is used to derive the seed it is simulated with.
+    """
+    return sorted(airport['_id'] for airport in db.airports.find({}, {'_id': 1}))
+
+def get_period_seed(sim_group):
+    return zlib.crc32(sim_group) & 0x7fffffff
+
+def calculate_origin_flows(calculator, origin_idx, origin_airport_id, start_date, end_date, seed):
+    """
+    Calculate an origin's flows for a period with a seed derived from the period's seed
+    and the origin's position, so the results are reproducible.
+    """
+    return calculator.calculate(
+        origin_airport_id,
+        simulated_passengers=10000,
+        start_date=start_date,
+        end_date=end_date,
+        seed=[seed, origin_idx],
+        target_error=config.flow_target_error or None,
+        min_passengers=config.flow_min_passengers,
+        max_passengers=config.flow_max_passengers)
+
+@celery_tasks.task(name='tasks.calculate_flows_for_origins', acks_late=True)
+def calculate_flows_for_origins(origins, start_date, end_date, sim_group, sim_version=None):
+    """
+    Calculate the passenger flows for a chunk of a period's origins and store them
+    in the passengerFlows collection. When a sim_version is given the flows are written to
+    that version of the simGroup, otherwise the origins' flows in the simGroup are replaced.
+    :param origins: A list of the origins' positions in the period's origins and their airport ids.
+    :return: The numbers of origins and flows calculated.
+    """
+    start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+    end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+    direct_passenger_flows, cache_result = get_direct_passenger_flows_with_cache_result(start_date, end_date)
+    db = get_database()
+    calculator = get_airport_flow_calculator()
+    preload_flights(start_date, end_date)
+    seed = get_period_seed(sim_group)
+    documents = []
+    for origin_idx, origin_airport_id in origins:
+        results = calculate_origin_flows(calculator, origin_idx, origin_airport_id, start_date, end_date, seed)
+        if len(results) > 0:
+            documents.extend(create_passenger_flow_documents(
+                origin_airport_id, results, direct_passenger_flows, start_date, end_date, sim_group))
+    if sim_version is None:
+        # Drop the flows a previous delivery of this task wrote.
+        db.passengerFlows.delete_many({
+            'departureAirport': {'$in': [origin_airport_id for origin_idx, origin_airport_id in origins]},
+            'simGroup': sim_group
+        })
+    if len(documents) > 0:
+        write_passenger_flows(db, documents, sim_version)
+    record_period_task(db, sim_group, cache_result)
+    return {
+        'origins': len(origins),
+        'flows': len(documents)
+    }
+
+@celery_tasks.task(name='tasks.finish_period_flows')
+def finish_period_flows(results, sim_group, sim_version, queued_time):
+    """
+    Total the results of the calculate_flows_for_origins tasks for a period and publish
+    the version they wrote. It is the callback of their chord, so it only runs if all of them succeed.
+    :return: Statistics including the number of origins calculated per second since the tasks were queued.
+    """
+    if sim_version is not None:
+        publish_passenger_flows(get_database(), sim_group, sim_version)
+    seconds = time.time() - queued_time
+    origins = sum(result['origins'] for result in results)
+    stats = {
+        'simGroup': sim_group,
+        'simVersion': sim_version,
+        'origins': origins,
+        'flows': sum(result['flows'] for result in results),
+        'tasks': len(results),
+        'seconds': seconds,
+        'originsPerSecond': origins / seconds if seconds > 0 else None
+    }
+    logger.info("Calculated flows for %s: %s", sim_group, stats)
+    return stats
+
+def queue_flows_for_period(start_date, end_date, sim_group, origins_per_task=50, sim_version=None):
+    """
+    Queue a chord of calculate_flows_for_origins tasks that each calculate the flows for a chunk of
+    the period's origins, so each worker process only loads the calculator and the period's flights once
+    for many origins. The tasks are sent to the period's caching queue.
+    Without a sim_version the simGroup's previous flows are deleted all at once beforehand.
+    :return: The AsyncResult of the chord's finish_period_flows callback.
+    """
+    db = get_database()
+    origins = list(enumerate(get_period_origins(db)))
+    chunks = [origins[i:i + origins_per_task] for i in range(0, len(origins), origins_per_task)]
+    if sim_version is None:
+        db.passengerFlows.delete_many({'simGroup': sim_group})
+    start_period_caching(db, sim_group, start_date, end_date, len(chunks), sim_version)
+    queue = get_caching_queue(start_date, end_date)
+    return celery.chord(
+        calculate_flows_for_origins.s(chunk, start_date, end_date, sim_group, sim_version).set(queue=queue)
+        for chunk in chunks
+    )(finish_period_flows.s(sim_group, sim_version, time.time()).set(queue=queue))
+
+# The calculator and arguments that the processes calculating flows for a period locally use.
+# They are set before the processes are forked so they inherit them instead of them being pickled.
+_period_flows_args = None
+
+def _connect_period_process():
+    # pymongo clients are not fork safe, so each process connects to the database after it is forked.
+    calculator = _period_flows_args[0]
+    calculator.db = pymongo.MongoClient(config.mongo_uri)[config.mongo_db_name]
+
+def _calculate_origin_flows(origin_idx_and_airport):
+    calculator, start_date, end_date, seed = _period_flows_args
+    origin_idx, origin_airport_id = origin_idx_and_airport
+    return origin_airport_id, calculate_origin_flows(
+        calculator, origin_idx, origin_airport_id, start_date, end_date, seed)
+
+def calculate_flows_for_period(start_date, end_date, sim_group, processes=None, write_batch_size=10000,
+                               sim_version=None):
+    """
+    Calculate the passenger flows from every airport over the interval starting at start_date
+    in this process rather than on the workers and store them in the passengerFlows collection.
+    The calculator and the period's flights are loaded once and then the origins are split
+    between processes forked from this one, which share them. It should not be called from
+    a worker, which cannot fork processes of its own. Use queue_flows_for_period instead.
+    The flows are written in batches of write_batch_size. When a sim_version is given they are
+    written to that version of the simGroup, which is published once every origin has been
+    calculated, otherwise the simGroup's previous flows are deleted all at once beforehand.
+    Origins are simulated with the same seeds as queue_flows_for_period uses.
+    :param processes: The number of processes to use, by default one per core.
+    :return: Statistics including the number of origins calculated per second.
+    """
+    global _period_flows_args
+    start_time = time.time()
+    db = get_database()
+    # The period's statistics are reset so the single task recorded below is counted on its own.
+    start_period_caching(db, sim_group, start_date, end_date, 1, sim_version, local=True)
+    start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+    end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+    processes = processes or multiprocessing.cpu_count()
+    direct_passenger_flows, cache_result = get_direct_passenger_flows_with_cache_result(start_date, end_date)
+    calculator = get_airport_flow_calculator()
+    preload_flights(start_date, end_date)
+    origins = get_period_origins(db)
+    if sim_version is None:
+        db.passengerFlows.delete_many({'simGroup': sim_group})
+    _period_flows_args = (calculator, start_date, end_date, get_period_seed(sim_group))
+    pool = multiprocessing.Pool(processes, initializer=_connect_period_process)
+    calculation_start_time = time.time()
+    origins_calculated = 0
+    flows_written = 0
+    documents = []
+    try:
+        for origin_airport_id, results in pool.imap_unordered(
+                _calculate_origin_flows, list(enumerate(origins)), chunksize=4):
+            origins_calculated += 1
+            if len(results) > 0:
+                documents.extend(create_passenger_flow_documents(
+                    origin_airport_id, results, direct_passenger_flows, start_date, end_date, sim_group))
+            if len(documents) >= write_batch_size:
+                write_passenger_flows(db, documents, sim_version)
+                flows_written += len(documents)
+                documents = []
+            if origins_calculated % 100 == 0:
+                logger.info("Calculated flows for %s of %s origins at %.1f origins per second",
+                            origins_calculated, len(origins),
+                            origins_calculated / (time.time() - calculation_start_time))
+    finally:
+        pool.close()
+        pool.join()
+        _period_flows_args = None
+    if len(documents) > 0:
+        write_passenger_flows(db, documents, sim_version)
+        flows_written += len(documents)
+    if sim_version is not None:
+        # There may not be any workers to clean up the old versions later.
+        publish_passenger_flows(db, sim_group, sim_version, schedule_cleanup=False)
+    calculation_seconds = time.time() - calculation_start_time
+    stats = {
+        'simGroup': sim_group,
+        'simVersion': sim_version,
+        'origins': origins_calculated,
+        'flows': flows_written,
+        'processes': processes,
+        'seconds': time.time() - start_time,
+        'originsPerSecond': origins_calculated / calculation_seconds if calculation_seconds > 0 else None
+    }
+    logger.info("Calculated flows for %s: %s", sim_group, stats)
+    record_period_task(db, sim_group, cache_result)
+    return stats
+
+def write_aggregated_itineraries(db, simulation_id, origin_airport_id, itineraries, calculator):
+    """
+    Add the itineraries' counts and leg and distance sums to the simulation's
+    aggregated_itineraries documents for each destination. The documents are
+    incremented so the results of several tasks for the same origin can be combined.
+    :return: The number of itineraries.
+    """
+    stats = {}
+    for itinerary in itineraries:
+        legs = len(itinerary) - 1
+        distance = calculator.get_itinerary_distance(itinerary)
+        destination_stats = stats.get(itinerary[-1])
+        if destination_stats is None:
+            destination_stats = stats[itinerary[-1]] = {
+                'count': 0,
+                'totalLegs': 0,
+                'totalLegsSquared': 0,
+                'totalDistance': 0.0,
+                'totalDistanceSquared': 0.0,
+                'minLegs': legs,
+                'maxLegs': legs
+            }
+        destination_stats['count'] += 1
+        destination_stats['totalLegs'] += legs
+        destination_stats['totalLegsSquared'] += legs * legs
+        destination_stats['totalDistance'] += distance
+        destination_stats['totalDistanceSquared'] += distance * distance
+        destination_stats['minLegs'] = min(destination_stats['minLegs'], legs)
+        destination_stats['maxLegs'] = max(destination_stats['maxLegs'], legs)
+    requests = [
+        pymongo.UpdateOne({
+            'simulationId': simulation_id,
+            'origin': origin_airport_id,
+            'destination': destination
+        }, {
+            '$inc': {
+                key: destination_stats[key]
+                for key in ['count', 'totalLegs', 'totalLegsSquared', 'totalDistance', 'totalDistanceSquared']
+            },
+            '$min': {'minLegs': destination_stats['minLegs']},
+            '$max': {'maxLegs': destination_stats['maxLegs']}
+        }, upsert=True)
+        for destination, destination_stats in stats.items()]
+    while len(requests) > 0:
+        try:
+            db.aggregated_itineraries.bulk_write(requests, ordered=False)
+            requests = []
+        except pymongo.errors.BulkWriteError as e:
+            # Upserts that race with another task's upsert of the same document fail
+            # with a duplicate key error and can be retried as updates.
+            failed_requests = [requests[error['index']] for error in e.details['writeErrors']
+                               if error['code'] == 11000]
+            if len(failed_requests) < len(e.details['writeErrors']):
+                raise
+            requests = failed_requests
+    return sum(destination_stats['count'] for destination_stats in stats.values())
 
 @celery_tasks.task(name='tasks.simulate_passengers')
-def simulate_passengers(simulation_id, origin_airport_id, number_of_passengers, start_date, end_date):
+def simulate_passengers(simulation_id, origin_airport_id, number_of_passengers, start_date, end_date,
+                        output_mode='itineraries', batch_size=None, seed=None, chunk_size=None):
+    """
+    Simulate the itineraries of passengers departing from the origin airport.
+    A simulation's passengers from an origin may be split into chunks of chunk_size
+    simulated by separate tasks, each with its own seed.
+    In the itineraries output mode a simulated_itineraries document is inserted for
+    every passenger in batches of batch_size. In the aggregated output mode an
+    aggregated_itineraries document is stored for each destination with the number of
+    passengers that ended up there and the sums of their legs and travel distances.
+    """
     db = get_database()
+    try:
+        simulated_passengers = simulate_passengers_for_origin(
+            db, simulation_id, origin_airport_id, number_of_passengers, start_date, end_date,
+            output_mode, batch_size, seed)
+    except:
+        record_simulation_progress(db, simulation_id, failed=True)
+        raise
+    record_simulation_progress(db, simulation_id, simulated_passengers)
+    return {
+        'simulationId': simulation_id,
+        'origin': origin_airport_id,
+        'simulatedPassengers': simulated_passengers,
+        'seed': seed,
+        'chunkSize': chunk_size
+    }
+
+def record_simulation_progress(db, simulation_id, simulated_passengers=0, failed=False):
+    """
+    Count a finished simulate_passengers task and the passengers it simulated
+    in the simulation's simulation_progress document so its progress can be streamed.
+    """
+    db.simulation_progress.update_one({'_id': simulation_id}, {
+        '$inc': {
+            'failedTasks' if failed else 'completedTasks': 1,
+            'simulatedPassengers': simulated_passengers
+        },
+        '$currentDate': {'updatedAt': True}
+    }, upsert=True)
+
+def simulate_passengers_for_origin(db, simulation_id, origin_airport_id, number_of_passengers, start_date, end_date,
+                                   output_mode, batch_size, seed=None):
+    """
+    Simulate and store the itineraries for simulate_passengers.
+    :return: The number of passengers simulated.
+    """
     my_airport_flow_calculator = get_airport_flow_calculator()
+    if batch_size is None:
+        batch_size = config.itinerary_batch_size
     # datetime objects cannot be passed to tasks, so they are passed in as strings.
     start_date = dateparser.parse(start_date)
     end_date = dateparser.parse(end_date)
-    itins_found = False
-    for itinerary in my_airport_flow_calculator.calculate_itins(
+    itineraries = my_airport_flow_calculator.calculate_itins(
         origin_airport_id,
         simulated_passengers=number_of_passengers,
         start_date=start_date,
-        end_date=end_date):
-        itins_found = True
-        itin = {
-            "origin": itinerary[0],
-            "destination": itinerary[-1],
-            "simulationId": simulation_id
-        }
-        db.simulated_itineraries.insert(itin)
-    if not itins_found:
+        end_date=end_date,
+        seed=seed)
+    if output_mode == 'aggregated':
+        simulated_passengers = write_aggregated_itineraries(
+            db, simulation_id, origin_airport_id, itineraries, my_airport_flow_calculator)
+    elif output_mode == 'itineraries':
+        simulated_passengers = 0
+        batch = []
+        for itinerary in itineraries:
+            simulated_passengers += 1
+            batch.append({
+                "origin": itinerary[0],
+                "destination": itinerary[-1],
+                "simulationId": simulation_id
+            })
+            if len(batch) >= batch_size:
+                db.simulated_itineraries.insert_many(batch, ordered=False)
+                batch = []
+        if len(batch) > 0:
+            db.simulated_itineraries.insert_many(batch, ordered=False)
+    else:
+        raise ValueError("Unknown output mode: " + str(output_mode))
+    if simulated_passengers == 0:
         raise Exception("No itineraries could be generated for the given parameters")
-    return simulation_id
+    return simulated_passengers
+
+def store_simulation_results(db, simulation_id, output_mode='itineraries', task_results=None, chunk_size=None):
+    """
+    Count the passengers that ended up at each destination in a finished simulation
+    and store the counts and fractions in the simulation_results collection
+    so they can be served without reading the simulation's itineraries.
+    The results of the simulation's chunks are merged by counting the itineraries they stored.
+    :param task_results: The simulate_passengers results of the simulation's chunks
+    """
+    if output_mode == 'aggregated':
+        collection = db.aggregated_itineraries
+        count = '$count'
+    else:
+        collection = db.simulated_itineraries
+        count = 1
+    counts = {
+        doc['_id']: doc['count']
+        for doc in collection.aggregate([
+            {
+                '$match': {
+                    'simulationId': simulation_id
+                }
+            }, {
+                '$group': {
+                    '_id': '$destination',
+                    'count': {
+                        '$sum': count
+                    }
+                }
+            }
+        ])}
+    total_passengers = sum(counts.values())
+    db.simulation_results.replace_one({'_id': simulation_id}, {
+        'simId': simulation_id,
+        'totalPassengers': total_passengers,
+        'destinations': {
+            destination: {
+                'count': count,
+                'fraction': float(count) / total_passengers
+            } for destination, count in counts.items()},
+        'chunks': len(task_results or []),
+        'chunkSize': chunk_size,
+        'completedTime': datetime.datetime.utcnow()
+    }, upsert=True)
 
 @celery_tasks.task(name='tasks.callback')
-def callback(data, email, simId):
+def callback(data, email, simId, output_mode='itineraries', chunk_size=None):
+    store_simulation_results(get_database(), simId, output_mode, data, chunk_size)
     if not email == None:
         print "Sending notificaiton email to: {0}".format(email)
         print "For simulation https://{0}/simulation/{1}".format(config.flirt_base,simId)
@@ -2,12 +2,17 @@
 import unittest
 from testhelpers import TestHelpers
 from ..AirportFlowCalculator import AirportFlowCalculator, compute_airport_distances, is_logical, \
-    compute_direct_seat_flows
+    compute_direct_seat_flows, FlowMatrixCache, LayoverWeightTable, terminal_flow_confidence_interval, \
+    estimate_terminal_flow_error, FlightArrays, to_epoch_seconds
 from .. import config
+from .. import daily_flows
+from ..benchmarks import generate_network, InMemoryDatabase
 import pymongo
 import math
+import os
 import datetime
 import numpy as np
+from geopy.distance import great_circle
 
 class TestAirportFlowCalculator(unittest.TestCase, TestHelpers):
     SIMULATED_PASSENGERS = 2000
@@ -17,7 +22,7 @@ class TestAirportFlowCalculator(unittest.TestCase, TestHelpers):
         self.db = pymongo.MongoClient(config.mongo_uri)[config.mongo_db_name]
         start = datetime.datetime(2017, 2, 1)
         end = datetime.datetime(2017, 2, 2)
-        direct_seat_flows = compute_direct_seat_flows(self.db, {
+        self.direct_seat_flows = direct_seat_flows = compute_direct_seat_flows(self.db, {
             "departureDateTime": {
                 "$lte": end,
                 "$gte": start
@@ -114,4 +119,491 @@ class TestAirportFlowCalculator(unittest.TestCase, TestHelpers):
                 if is_logical(dist_mat, 0, a, i)
             ]))
         print logical_layover_histogram
-        self.assertTrue(sum(logical_layover_histogram[:5]) < sum(logical_layover_histogram[5:]))
\ No newline at end of file
+        self.assertTrue(sum(logical_layover_histogram[:5]) < sum(logical_layover_histogram[5:]))
+
+    def test_batch_simulation(self):
+        """
+        The batch simulation should produce the same distribution of terminal airports
+        as simulating the passengers on the aggregate flows one at a time.
+        """
+        aggregate_calculator = AirportFlowCalculator(
+            self.db, aggregated_seats=self.direct_seat_flows, use_schedules=False)
+        batch_calculator = AirportFlowCalculator(
+            self.db, aggregated_seats=self.direct_seat_flows, use_schedules=False, use_batch_simulation=True)
+        aggregate_results = aggregate_calculator.calculate("BNA", simulated_passengers=self.SIMULATED_PASSENGERS)
+        batch_results = batch_calculator.calculate("BNA", simulated_passengers=self.SIMULATED_PASSENGERS)
+        self.assertAlmostEqual(sum(v['terminal_flow'] for v in batch_results.values()), 1.0)
+        for airport_id, result in aggregate_results.items():
+            prob = result['terminal_flow']
+            standard_deviation = math.sqrt(2 * self.SIMULATED_PASSENGERS * prob * (1 - prob)) / self.SIMULATED_PASSENGERS
+            batch_prob = batch_results.get(airport_id, {}).get('terminal_flow', 0.0)
+            self.assertTrue(abs(batch_prob - prob) <= 5 * standard_deviation,
+                            airport_id + " has batch probability " + str(batch_prob) +
+                            " which differs from " + str(prob) + " by more than 5 standard deviations")
+
+    def test_aggregate_solver(self):
+        """
+        The solver's expected terminal flows should sum to one and agree with the simulation.
+        """
+        batch_calculator = AirportFlowCalculator(
+            self.db, aggregated_seats=self.direct_seat_flows, use_schedules=False, use_batch_simulation=True)
+        solver_calculator = AirportFlowCalculator(
+            self.db, aggregated_seats=self.direct_seat_flows, use_schedules=False, use_aggregate_solver=True)
+        batch_results = batch_calculator.calculate("BNA", simulated_passengers=self.SIMULATED_PASSENGERS)
+        solver_results = solver_calculator.calculate("BNA")
+        self.assertAlmostEqual(sum(v['terminal_flow'] for v in solver_results.values()), 1.0)
+        self.assertEqual(solver_results.get("BNA", {}).get('terminal_flow', 0), 0)
+        for airport_id, result in solver_results.items():
+            prob = result['terminal_flow']
+            standard_deviation = math.sqrt(self.SIMULATED_PASSENGERS * prob * (1 - prob)) / self.SIMULATED_PASSENGERS
+            simulated_prob = batch_results.get(airport_id, {}).get('terminal_flow', 0.0)
+            self.assertTrue(abs(simulated_prob - prob) <= 5 * standard_deviation + 1e-4,
+                            airport_id + " has simulated probability " + str(simulated_prob) +
+                            " which differs from the expected probability " + str(prob) +
+                            " by more than 5 standard deviations")
+
+    def test_distance_matrix_matches_geopy(self):
+        airport_to_coords_items = sorted(
+            [(airport['_id'], airport['loc']['coordinates']) for airport in self.db.airports.find().limit(300)],
+            key=lambda x: x[0])
+        dist_mat = compute_airport_distances(airport_to_coords_items, block_size=64)
+        self.assertTrue((dist_mat == dist_mat.T).all())
+        for i, (airport_a, (airport_a_long, airport_a_lat)) in enumerate(airport_to_coords_items):
+            for j, (airport_b, (airport_b_long, airport_b_lat)) in enumerate(airport_to_coords_items):
+                self.assertAlmostEqual(dist_mat[i, j], great_circle(
+                    (airport_a_lat, airport_a_long),
+                    (airport_b_lat, airport_b_long)).kilometers, delta=1e-6)
+
+    def test_logical_destination_mask(self):
+        """
+        The logical destination mask should agree with checking each candidate's layovers individually.
+        """
+        for itinerary in self.itineraries[:200]:
+            for end in range(1, len(itinerary) + 1):
+                itin_sofar = itinerary[:end]
+                candidates = self.direct_seat_flows[itin_sofar[-1]].keys()
+                mask = self.calculator.get_logical_destination_mask(
+                    itin_sofar, [self.calculator.airport_to_idx.get(candidate, -1) for candidate in candidates])
+                for candidate, logical in zip(candidates, mask):
+                    self.assertEqual(logical, self.calculator.check_logical_layovers(itin_sofar + [candidate]))
+
+    def test_preload_flights(self):
+        """
+        Preloaded flights should match the flights queried for each airport and day
+        and simulations within the preloaded period should not query the database.
+        """
+        start = datetime.datetime(2017, 2, 1)
+        end = datetime.datetime(2017, 2, 2)
+        calculator = AirportFlowCalculator(self.db, aggregated_seats=self.direct_seat_flows)
+        stats = calculator.preload_flights(start, end)
+        self.assertGreater(stats['flights'], 0)
+        for airport in ['BNA', 'ATL', 'JFK']:
+            preloaded = calculator.get_flights_from_airport(airport, end)
+            queried = self.calculator.get_flights_from_airport(airport, end)
+            self.assertEqual(len(preloaded), len(queried))
+            np.testing.assert_array_equal(preloaded.departure_times, queried.departure_times)
+            self.assertEqual(sorted(preloaded.arrival_airports), sorted(queried.arrival_airports))
+        self.assertEqual(calculator.flight_queries, 0)
+        list(calculator.calculate_itins("BNA", simulated_passengers=200, start_date=start, end_date=end))
+        self.assertEqual(calculator.flight_queries, 0)
+
+    def test_sharded_calculation_is_reproducible(self):
+        """
+        Results should be identical for the same seed and number of shards
+        regardless of how many processes simulate them.
+        """
+        calculator = AirportFlowCalculator(
+            self.db, aggregated_seats=self.direct_seat_flows, use_schedules=False)
+        parallel_results = calculator.calculate("BNA", simulated_passengers=1000, seed=1, shards=4, processes=4)
+        serial_results = calculator.calculate("BNA", simulated_passengers=1000, seed=1, shards=4)
+        self.assertEqual(parallel_results, serial_results)
+        self.assertAlmostEqual(sum(v['terminal_flow'] for v in parallel_results.values()), 1.0)
+        self.assertNotEqual(parallel_results, calculator.calculate(
+            "BNA", simulated_passengers=1000, seed=2, shards=4))
+
+    def test_snapshot_round_trip(self):
+        """
+        A calculator loaded from a snapshot should memory-map the saved state
+        and give the same seeded results as the calculator it was saved from.
+        """
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'snapshot')
+        try:
+            calculator = AirportFlowCalculator(
+                self.db, aggregated_seats=self.direct_seat_flows, use_schedules=False)
+            calculator.save_snapshot(path)
+            loaded = AirportFlowCalculator.from_snapshot(self.db, path, use_schedules=False)
+            self.assertIsInstance(loaded.airport_distance_matrix, np.memmap)
+            self.assertEqual(loaded.airport_to_idx, calculator.airport_to_idx)
+            self.assertEqual(
+                loaded.calculate("BNA", simulated_passengers=500, seed=1),
+                calculator.calculate("BNA", simulated_passengers=500, seed=1))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_flow_matrix_cache(self):
+        """
+        Cached flows should be memory-mapped and match the computed ones, and the cache
+        should delete the least recently used flows to stay within its byte budget.
+        """
+        import tempfile
+        import shutil
+        path = tempfile.mkdtemp()
+        try:
+            cache = FlowMatrixCache(path, 1)
+            flows = cache.get('a', lambda: self.direct_seat_flows)
+            self.assertIsInstance(flows.flows, np.memmap)
+            self.assertEqual(dict(flows['BNA'].items()), self.direct_seat_flows['BNA'])
+            cache.get('a', lambda: self.fail("The cached flows should be used"))
+            cache.get('b', lambda: self.direct_seat_flows)
+            self.assertEqual([key for key, size in cache.entries()], ['b'])
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+        finally:
+            shutil.rmtree(path)
+
+    def test_daily_flows_match_flights(self):
+        """
+        Flows summed from the daily rollup should match the ones aggregated from flights.
+        """
+        start = datetime.datetime(2017, 2, 1)
+        end = datetime.datetime(2017, 2, 2)
+        # The rollup is built in a scratch collection so the live one is left alone.
+        collection_name = 'testDailyDirectFlows'
+        try:
+            self.assertGreater(daily_flows.rebuild_daily_flows(
+                self.db, start, end, collection_name=collection_name), 0)
+            self.assertTrue(daily_flows.is_current(self.db, start, end, collection_name))
+            self.assertEqual(daily_flows.check_daily_flows(
+                self.db, start, end, collection_name=collection_name), [])
+        finally:
+            self.db.drop_collection(collection_name)
+            self.db.drop_collection(collection_name + 'Status')
+
+    def test_adaptive_sample_size(self):
+        """
+        Passengers should be simulated until the terminal flow confidence intervals
+        are within the target error unless the maximum number of passengers is reached.
+        """
+        calculator = AirportFlowCalculator(
+            self.db, aggregated_seats=self.direct_seat_flows, use_schedules=False)
+        results = calculator.calculate("BNA", seed=1, target_error=0.01, min_passengers=500, max_passengers=50000)
+        result = results.values()[0]
+        self.assertLessEqual(result['error'], 0.01)
+        self.assertGreaterEqual(result['simulated_passengers'], 500)
+        self.assertLessEqual(max(v['terminal_flow_error'] for v in results.values()), result['error'])
+        results = calculator.calculate("BNA", seed=1, target_error=1e-6, min_passengers=500, max_passengers=1500)
+        self.assertEqual(results.values()[0]['simulated_passengers'], 1500)
+
+    def test_connection_graph(self):
+        """
+        Simulating passengers on a connection graph should produce
+        the same itineraries as simulating them on the preloaded flights.
+        """
+        start = datetime.datetime(2017, 2, 1)
+        end = datetime.datetime(2017, 2, 2)
+        calculator = AirportFlowCalculator(self.db, aggregated_seats=self.direct_seat_flows)
+        calculator.preload_flights(start, end)
+        itineraries = list(calculator.calculate_itins(
+            "BNA", simulated_passengers=200, start_date=start, end_date=end, seed=1))
+        stats = calculator.build_connection_graph()
+        self.assertGreater(stats['connections'], 0)
+        self.assertGreater(stats['bytes'], 0)
+        self.assertEqual(itineraries, list(calculator.calculate_itins(
+            "BNA", simulated_passengers=200, start_date=start, end_date=end, seed=1)))
+
+
+class TestOnGeneratedNetwork(unittest.TestCase):
+    """
+    Tests that use a generated flight network held in memory, so they do not need the database.
+    """
+    @classmethod
+    def setUpClass(self):
+        self.airport_docs, self.flight_docs, self.aggregated_flows = generate_network(airports=60, hubs=5, days=4)
+        self.db = InMemoryDatabase(self.airport_docs, self.flight_docs)
+
+    def test_aggregate_solver_without_layover_checking(self):
+        """
+        Without layover checking the solver's terminal flows should sum to one
+        and agree with the batch simulation.
+        """
+        calculator = AirportFlowCalculator(
+            self.db, aggregated_seats=self.aggregated_flows, use_schedules=False,
+            use_layover_checking=False, use_aggregate_solver=True)
+        solver_results = calculator.calculate("A00010")
+        self.assertAlmostEqual(sum(v['terminal_flow'] for v in solver_results.values()), 1.0)
+        simulated_passengers = 100000
+        simulated_counts = {}
+        for itinerary, passengers in calculator.simulate_passengers_in_batch(
+                "A00010", simulated_passengers, np.random.RandomState(1)).items():
+            simulated_counts[itinerary[-1]] = simulated_counts.get(itinerary[-1], 0) + passengers
+        for airport_id in set(solver_results) | set(simulated_counts):
+            prob = solver_results.get(airport_id, {}).get('terminal_flow', 0.0)
+            standard_deviation = math.sqrt(simulated_passengers * prob * (1 - prob)) / simulated_passengers
+            simulated_prob = float(simulated_counts.get(airport_id, 0)) / simulated_passengers
+            self.assertLessEqual(abs(simulated_prob - prob), 5 * standard_deviation + 1e-4, airport_id)
+
+    def test_sharded_totals_without_seed(self):
+        """
+        Sharded totals should be calculated with a random seed when none is given.
+        """
+        calculator = AirportFlowCalculator(
+            self.db, aggregated_seats=self.aggregated_flows, use_schedules=False)
+        totals = calculator.calculate_sharded_totals("A00010", simulated_passengers=400, shards=4)
+        self.assertEqual(sum(passengers for passengers, legs, distance in totals.values()), 400)
+
+    def test_snapshot_replacement(self):
+        """
+        Saving a snapshot should replace the previous one and delete it, including
+        a directory saved before snapshots were linked, and leave nothing else behind.
+        """
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'snapshot')
+        try:
+            os.makedirs(path)
+            calculator = AirportFlowCalculator(self.db, aggregated_seats=self.aggregated_flows)
+            calculator.save_snapshot(path)
+            first_snapshot = os.path.realpath(path)
+            calculator.save_snapshot(path)
+            self.assertNotEqual(os.path.realpath(path), first_snapshot)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted(['snapshot', os.path.basename(os.path.realpath(path))]))
+            loaded = AirportFlowCalculator.from_snapshot(self.db, path)
+            self.assertEqual(loaded.airport_to_idx, calculator.airport_to_idx)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_layover_weight_table_matches_poisson(self):
+        """
+        The default layover weights should be exactly the Poisson PMF that was computed
+        for each layover's whole hours before the weights were tabulated.
+        """
+        mean_hours = AirportFlowCalculator.MEAN_LAYOVER_DELAY_HOURS
+        def layover_pmf(hours):
+            p = math.exp(-mean_hours)
+            for i in range(int(hours)):
+                p *= mean_hours
+                p /= i + 1
+            return p
+        layover_hours = np.concatenate([np.arange(-3, 48, 0.25), [100.5, 500, 1000.75]])
+        calculator = AirportFlowCalculator(self.db, aggregated_seats=self.aggregated_flows)
+        np.testing.assert_array_equal(
+            calculator.layover_weighting(layover_hours),
+            [layover_pmf(hours) for hours in layover_hours])
+        self.assertEqual(LayoverWeightTable.poisson(mean_hours).weights[-1], 0)
+
+    def test_aggregate_outcome_cdf_matches_transitions(self):
+        """
+        The per-step outcome distribution the aggregate flow simulation samples from the
+        memoized cumulative probabilities should match get_aggregate_transitions, with the
+        probability above the last cumulative one going to the fallback outcome.
+        """
+        for use_layover_checking in [True, False]:
+            calculator = AirportFlowCalculator(
+                self.db, aggregated_seats=self.aggregated_flows, use_schedules=False,
+                use_layover_checking=use_layover_checking)
+            itineraries = [["A00000"], ["A00010"]]
+            checked = 0
+            while len(itineraries) > 0 and checked < 200:
+                itinerary = itineraries.pop(0)
+                destinations, continue_probs, terminal_probs, fallback_prob = \
+                    calculator.get_aggregate_transitions(itinerary)
+                for memoized in [False, True]:
+                    cdf_destinations, cumulative_probs = calculator.get_aggregate_outcome_cdf(itinerary)
+                    self.assertEqual(list(cdf_destinations), list(destinations))
+                    if len(destinations) == 0:
+                        # The simulation ends the trip without sampling an outcome.
+                        continue
+                    step_probs = np.diff(np.concatenate([[0.0], cumulative_probs, [1.0]]))
+                    np.testing.assert_allclose(
+                        step_probs, np.concatenate([continue_probs, terminal_probs, [fallback_prob]]), atol=1e-12)
+                checked += 1
+                if len(itinerary) - 1 < calculator.max_legs - 1:
+                    itineraries.extend(itinerary + [destination]
+                                       for destination, prob in zip(destinations, continue_probs) if prob > 0)
+            self.assertEqual(checked, 200)
+
+    def test_adaptive_sample_size_on_generated_network(self):
+        """
+        With a target error, calculate should double the passengers simulated until the
+        error is within it, stop at the maximum number of passengers otherwise and give
+        the same results for the same seed.
+        """
+        calculator = AirportFlowCalculator(
+            self.db, aggregated_seats=self.aggregated_flows, use_schedules=False)
+        for error_measure in ['confidence_interval', 'total_variation']:
+            results = calculator.calculate(
+                "A00010", seed=1, target_error=0.02, error_measure=error_measure,
+                min_passengers=500, max_passengers=64000)
+            result = results.values()[0]
+            self.assertLessEqual(result['error'], 0.02)
+            self.assertIn(result['simulated_passengers'], [500 * 2 ** i for i in range(8)])
+            self.assertAlmostEqual(sum(v['terminal_flow'] for v in results.values()), 1.0)
+            self.assertEqual(results, calculator.calculate(
+                "A00010", seed=1, target_error=0.02, error_measure=error_measure,
+                min_passengers=500, max_passengers=64000))
+        capped_results = calculator.calculate(
+            "A00010", seed=1, target_error=1e-6, min_passengers=500, max_passengers=3000)
+        self.assertEqual(capped_results.values()[0]['simulated_passengers'], 3000)
+        self.assertGreater(capped_results.values()[0]['error'], 1e-6)
+
+    def test_flow_matrix_cache_versions(self):
+        """
+        Flows cached for an earlier version of a period's flights should not be used
+        once the flights have changed.
+        """
+        import tempfile
+        import shutil
+        path = tempfile.mkdtemp()
+        start = datetime.datetime(2017, 2, 1)
+        end = datetime.datetime(2017, 3, 1)
+        try:
+            cache = FlowMatrixCache(path, 1e9)
+            first_key = FlowMatrixCache.key(start, end, version='100-a')
+            self.assertNotEqual(first_key, FlowMatrixCache.key(start, end, version='101-b'))
+            cache.get(first_key, lambda: self.aggregated_flows)
+            cache.get(first_key, lambda: self.fail("The cached flows should be used"))
+            updated_flows = {'A00000': {'A00001': 1.0}}
+            flows = cache.get(FlowMatrixCache.key(start, end, version='101-b'), lambda: updated_flows)
+            self.assertEqual(dict(flows['A00000'].items()), updated_flows['A00000'])
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+        finally:
+            shutil.rmtree(path)
+
+    def test_preloaded_flights_do_not_share_the_store(self):
+        """
+        Memoized flights from a preloaded store should be copies, so replacing the store frees it.
+        """
+        start = datetime.datetime(2017, 2, 1)
+        calculator = AirportFlowCalculator(self.db, aggregated_seats=self.aggregated_flows)
+        calculator.preload_flights(start, start + datetime.timedelta(1))
+        flight_store = calculator.flight_store
+        flights = calculator.get_flights_from_airport("A00000", start)
+        self.assertGreater(len(flights), 0)
+        for name in FlightArrays.__slots__:
+            for store_array in [flight_store.departure_times, flight_store.arrival_times, flight_store.passengers]:
+                self.assertFalse(np.may_share_memory(getattr(flights, name), store_array), name)
+
+    def test_preloaded_flights_match_queried_flights(self):
+        """
+        The flights found in a preloaded store for each airport and day should be the same
+        flights in the same order as the ones queried for it, including flights departing
+        exactly at either end of the day and flights without seats, which are left out.
+        """
+        start = datetime.datetime(2017, 2, 1)
+        edge_flights = []
+        for day in range(4):
+            for airport, destination, seats in [("A00000", "A00001", 100), ("A00000", "A00002", 150),
+                                                ("A00010", "A00000", 80), ("A00010", "A00001", 0)]:
+                departure = start + datetime.timedelta(days=day)
+                edge_flights.append({
+                    '_id': len(self.flight_docs) + len(edge_flights),
+                    'departureAirport': airport,
+                    'arrivalAirport': destination,
+                    'departureDateTime': departure,
+                    'arrivalDateTime': departure + datetime.timedelta(hours=2),
+                    'totalSeats': seats
+                })
+        db = InMemoryDatabase(self.airport_docs, self.flight_docs + edge_flights)
+        queried_calculator = AirportFlowCalculator(db, aggregated_seats=self.aggregated_flows)
+        preloaded_calculator = AirportFlowCalculator(db, aggregated_seats=self.aggregated_flows)
+        preloaded_calculator.preload_flights(start, start + datetime.timedelta(1))
+        for day in range(3):
+            date = start + datetime.timedelta(days=day)
+            for airport in [airport['_id'] for airport in self.airport_docs] + ["missing"]:
+                queried = queried_calculator.get_flights_from_airport(airport, date)
+                preloaded = preloaded_calculator.get_flights_from_airport(airport, date)
+                for name in FlightArrays.__slots__:
+                    np.testing.assert_array_equal(getattr(preloaded, name), getattr(queried, name))
+        self.assertEqual(preloaded_calculator.flight_queries, 0)
+        # Flights at midnight are in the windows of both the days they start and end.
+        edge_times = [to_epoch_seconds(start + datetime.timedelta(days=day)) for day in range(2)]
+        departure_times = preloaded_calculator.get_flights_from_airport("A00000", start).departure_times
+        for edge_time in edge_times:
+            self.assertEqual(list(departure_times).count(edge_time), 2)
+
+    def test_chunked_itineraries_do_not_depend_on_chunk_size(self):
+        """
+        Simulating an origin's passengers in seeded chunks the way the server splits them
+        should be reproducible, give every chunk its own random stream, and give the same
+        destination distribution whatever the chunk size.
+        """
+        start = datetime.datetime(2017, 2, 1)
+        calculator = AirportFlowCalculator(self.db, aggregated_seats=self.aggregated_flows)
+        simulated_passengers = 4000
+
+        def simulate_in_chunks(chunk_size):
+            itineraries = []
+            for chunk_idx, chunk_start in enumerate(range(0, simulated_passengers, chunk_size)):
+                itineraries += calculator.calculate_itins(
+                    "A00010",
+                    simulated_passengers=min(chunk_size, simulated_passengers - chunk_start),
+                    start_date=start,
+                    end_date=start + datetime.timedelta(1),
+                    seed=[7, 0, chunk_idx])
+            return itineraries
+
+        def count_destinations(itineraries):
+            counts = {}
+            for itinerary in itineraries:
+                counts[itinerary[-1]] = counts.get(itinerary[-1], 0) + 1
+            return counts
+
+        single_chunk = simulate_in_chunks(simulated_passengers)
+        self.assertEqual(single_chunk, simulate_in_chunks(simulated_passengers))
+        small_chunks = simulate_in_chunks(700)
+        self.assertEqual(small_chunks, simulate_in_chunks(700))
+        self.assertNotEqual(small_chunks[:700], small_chunks[700:1400])
+        self.assertEqual(len(single_chunk), simulated_passengers)
+        self.assertEqual(len(small_chunks), simulated_passengers)
+        single_chunk_counts = count_destinations(single_chunk)
+        small_chunk_counts = count_destinations(small_chunks)
+        for airport_id in set(single_chunk_counts) | set(small_chunk_counts):
+            prob = float(single_chunk_counts.get(airport_id, 0) + small_chunk_counts.get(airport_id, 0)) / (
+                2 * simulated_passengers)
+            standard_deviation = math.sqrt(prob * (1 - prob) * 2 / simulated_passengers)
+            difference = abs(single_chunk_counts.get(airport_id, 0) - small_chunk_counts.get(airport_id, 0))
+            self.assertLessEqual(float(difference) / simulated_passengers, 5 * standard_deviation, airport_id)
+
+
+class TestTerminalFlowError(unittest.TestCase):
+    """
+    Tests of the error estimates adaptive sample sizes are based on.
+    """
+    def test_terminal_flow_confidence_interval(self):
+        """
+        The confidence interval should be the normal approximation's 95% half-width,
+        zero when no or all passengers end at the airport, and cover the true flow
+        about 95% of the time.
+        """
+        self.assertAlmostEqual(terminal_flow_confidence_interval(25, 100), 1.959964 * math.sqrt(0.25 * 0.75 / 100))
+        self.assertEqual(terminal_flow_confidence_interval(0, 100), 0.0)
+        self.assertEqual(terminal_flow_confidence_interval(100, 100), 0.0)
+        random_state = np.random.RandomState(1)
+        simulated_passengers = 1000
+        flow = 0.3
+        trials = 4000
+        covered = 0
+        for passengers in random_state.binomial(simulated_passengers, flow, size=trials):
+            if abs(float(passengers) / simulated_passengers - flow) <= \
+                    terminal_flow_confidence_interval(passengers, simulated_passengers):
+                covered += 1
+        self.assertAlmostEqual(float(covered) / trials, 0.95, delta=0.015)
+
+    def test_estimate_terminal_flow_error(self):
+        """
+        The error should be the largest confidence interval or half the sum of the
+        standard errors, zero without any totals, and unknown measures should be rejected.
+        """
+        totals = {'A': [50, 60, 1000.0], 'B': [30, 30, 500.0], 'C': [20, 40, 800.0]}
+        self.assertAlmostEqual(estimate_terminal_flow_error(totals, 100), 1.959964 * 0.05)
+        self.assertAlmostEqual(
+            estimate_terminal_flow_error(totals, 100, 'total_variation'),
+            0.5 * (math.sqrt(0.25 / 100) + math.sqrt(0.21 / 100) + math.sqrt(0.16 / 100)))
+        self.assertEqual(estimate_terminal_flow_error({}, 100), 0.0)
+        self.assertEqual(estimate_terminal_flow_error({}, 100, 'total_variation'), 0.0)
+        with self.assertRaises(ValueError):
+            estimate_terminal_flow_error(totals, 100, 'relative')
@@ -0,0 +1,204 @@
+import unittest
+import datetime
+import shutil
+import tempfile
+import time
+import bson
+import pymongo
+from .. import config
+from .. import tasks
+from ..AirportFlowCalculator import AirportFlowCalculator
+from ..benchmarks import generate_network, InMemoryDatabase
+
+
+class TestFlowVersions(unittest.TestCase):
+    """
+    Write, publish and clean up versions of a simGroup's flows in a scratch database.
+    """
+    def setUp(self):
+        self.db = pymongo.MongoClient(config.mongo_uri)[config.mongo_db_name + '-test-tasks']
+
+    def tearDown(self):
+        self.db.client.drop_database(self.db.name)
+
+    def write_flows(self, sim_version):
+        tasks.write_passenger_flows(self.db, [{
+            'simGroup': 'test',
+            'departureAirport': origin,
+            'arrivalAirport': 'SEA',
+            'estimatedPassengers': 1.0
+        } for origin in ['BNA', 'LAX']], sim_version)
+
+    def get_sim_groups(self):
+        return sorted(set(flow['simGroup'] for flow in self.db.passengerFlows.find()))
+
+    def test_later_versions_are_kept(self):
+        """
+        Publishing a version should delete the older versions and the unversioned flows,
+        but not a later version that is still being written, and an older version
+        should not be published over a later one.
+        """
+        versions = [str(bson.ObjectId()) for i in range(3)]
+        self.write_flows(None)
+        for version in versions:
+            self.write_flows(version)
+        self.assertTrue(tasks.publish_passenger_flows(self.db, 'test', versions[1], schedule_cleanup=False))
+        self.assertEqual(self.get_sim_groups(), ['test@' + versions[1], 'test@' + versions[2]])
+        self.assertEqual(tasks.get_published_flows_query(self.db, 'test'), {'simGroup': 'test@' + versions[1]})
+        self.assertFalse(tasks.publish_passenger_flows(self.db, 'test', versions[0], schedule_cleanup=False))
+        self.assertEqual(tasks.get_published_flows_query(self.db, 'test'), {'simGroup': 'test@' + versions[1]})
+        self.assertTrue(tasks.publish_passenger_flows(self.db, 'test', versions[2], schedule_cleanup=False))
+        self.assertEqual(self.get_sim_groups(), ['test@' + versions[2]])
+        self.assertEqual(self.db.passengerFlows.count(), 2)
+
+
+class TestAggregatedItineraries(unittest.TestCase):
+    """
+    Aggregate itineraries on a generated network in a scratch database.
+    """
+    def setUp(self):
+        self.db = pymongo.MongoClient(config.mongo_uri)[config.mongo_db_name + '-test-tasks']
+        self.db.aggregated_itineraries.create_index([
+            ('simulationId', pymongo.ASCENDING),
+            ('origin', pymongo.ASCENDING),
+            ('destination', pymongo.ASCENDING)
+        ], unique=True)
+        airport_docs, flight_docs, aggregated_flows = generate_network(airports=8, hubs=2, days=1)
+        self.calculator = AirportFlowCalculator(
+            InMemoryDatabase(airport_docs, flight_docs), aggregated_seats=aggregated_flows)
+        self.airports = [airport['_id'] for airport in airport_docs]
+
+    def tearDown(self):
+        self.db.client.drop_database(self.db.name)
+
+    def test_chunks_are_combined(self):
+        """
+        The aggregates written for several chunks of an origin's passengers should
+        be the same as the aggregates of all of their itineraries.
+        """
+        origin, hub, destination, other = self.airports[:4]
+        chunks = [
+            [[origin, destination], [origin, hub, destination], [origin, hub]],
+            [[origin, hub, other, destination], [origin, hub]]
+        ]
+        for chunk in chunks:
+            self.assertEqual(tasks.write_aggregated_itineraries(
+                self.db, 'sim', origin, chunk, self.calculator), len(chunk))
+        aggregates = {doc['destination']: doc for doc in self.db.aggregated_itineraries.find({'simulationId': 'sim'})}
+        self.assertEqual(sorted(aggregates), sorted([hub, destination]))
+        for aggregate_destination, aggregate in aggregates.items():
+            itineraries = [itinerary for chunk in chunks for itinerary in chunk
+                           if itinerary[-1] == aggregate_destination]
+            legs = [len(itinerary) - 1 for itinerary in itineraries]
+            distances = [self.calculator.get_itinerary_distance(itinerary) for itinerary in itineraries]
+            self.assertEqual(aggregate['origin'], origin)
+            self.assertEqual(aggregate['count'], len(itineraries))
+            self.assertEqual(aggregate['totalLegs'], sum(legs))
+            self.assertEqual(aggregate['totalLegsSquared'], sum(leg * leg for leg in legs))
+            self.assertEqual(aggregate['minLegs'], min(legs))
+            self.assertEqual(aggregate['maxLegs'], max(legs))
+            self.assertAlmostEqual(aggregate['totalDistance'], sum(distances))
+            self.assertAlmostEqual(aggregate['totalDistanceSquared'], sum(distance * distance for distance in distances))
+
+
+class TestCachingQueues(unittest.TestCase):
+    def setUp(self):
+        self.caching_queues = config.caching_queues
+
+    def tearDown(self):
+        config.caching_queues = self.caching_queues
+
+    def test_periods_are_routed_to_queues(self):
+        """
+        With one caching queue every period should be sent to the caching queue, and with
+        several every task for a period should be sent to the same one of them.
+        """
+        periods = [('2017-{0:02d}-01'.format(month), '2017-{0:02d}-01'.format(month + 1)) for month in range(1, 12)]
+        config.caching_queues = 1
+        self.assertEqual(set(tasks.get_caching_queue(start, end) for start, end in periods), set(['caching']))
+        config.caching_queues = 4
+        queues = [tasks.get_caching_queue(start, end) for start, end in periods]
+        self.assertEqual(queues, [tasks.get_caching_queue(start, end) for start, end in periods])
+        self.assertEqual(set(queues), set(['caching.0', 'caching.1', 'caching.2', 'caching.3']))
+
+
+class TestPeriodFlows(unittest.TestCase):
+    """
+    Calculate a period's flows locally from a generated flight network in a scratch database.
+    """
+    def setUp(self):
+        self.config = {
+            'mongo_db_name': config.mongo_db_name,
+            'calculator_snapshot_dir': config.calculator_snapshot_dir,
+            'flow_cache_dir': config.flow_cache_dir
+        }
+        self.temp_dir = tempfile.mkdtemp()
+        config.mongo_db_name = config.mongo_db_name + '-test-tasks'
+        config.calculator_snapshot_dir = self.temp_dir + '/snapshot'
+        config.flow_cache_dir = self.temp_dir + '/flow-cache'
+        self.clear_caches()
+        self.db = pymongo.MongoClient(config.mongo_uri)[config.mongo_db_name]
+        airport_docs, flight_docs, aggregated_flows = generate_network(
+            airports=8, hubs=2, days=2, start_date=datetime.datetime(2017, 2, 1))
+        self.db.airports.insert_many(airport_docs)
+        self.db.flights.insert_many(flight_docs)
+        self.airports = [airport['_id'] for airport in airport_docs]
+
+    def tearDown(self):
+        self.db.client.drop_database(self.db.name)
+        for name, value in self.config.items():
+            setattr(config, name, value)
+        self.clear_caches()
+        shutil.rmtree(self.temp_dir)
+
+    def clear_caches(self):
+        for memoized in [tasks.get_database, tasks.get_airport_flow_calculator,
+                         tasks.preload_flights, tasks.get_flow_matrix_cache]:
+            memoized.clear()
+        tasks.direct_passenger_flow_windows.clear()
+
+    def test_calculate_flows_for_period(self):
+        """
+        Calculating a period locally should write and publish flows for its origins
+        and record it as a single completed task without a queue.
+        """
+        sim_version = str(bson.ObjectId())
+        stats = tasks.calculate_flows_for_period('2017-02-01', '2017-02-02', 'test', processes=2,
+                                                 write_batch_size=50, sim_version=sim_version)
+        self.assertEqual(stats['origins'], len(self.airports))
+        self.assertEqual(self.db.passengerFlows.count({'simGroup': 'test@' + sim_version}), stats['flows'])
+        self.assertEqual(set(self.db.passengerFlows.distinct('departureAirport')), set(self.airports))
+        self.assertEqual(tasks.get_published_flows_query(self.db, 'test'), {'simGroup': 'test@' + sim_version})
+        caching_stats = self.db.cachingStats.find_one({'_id': 'test'})
+        self.assertIsNone(caching_stats['queue'])
+        self.assertEqual(caching_stats['queuedTasks'], 1)
+        self.assertEqual(caching_stats['completedTasks'], 1)
+        self.assertEqual(caching_stats['cacheMisses'], 1)
+
+    def test_finish_period_flows(self):
+        """
+        The chord callback should total its tasks' results and publish their version.
+        """
+        old_version, sim_version = [str(bson.ObjectId()) for i in range(2)]
+        for version in [old_version, sim_version]:
+            tasks.write_passenger_flows(self.db, [{
+                'simGroup': 'test',
+                'departureAirport': self.airports[0],
+                'arrivalAirport': self.airports[1],
+                'estimatedPassengers': 1.0
+            }], version)
+        tasks.publish_passenger_flows(self.db, 'test', old_version, schedule_cleanup=False)
+        # The cleanup the callback schedules runs right away instead of being sent to the workers.
+        always_eager = tasks.celery_tasks.conf.CELERY_ALWAYS_EAGER
+        tasks.celery_tasks.conf.CELERY_ALWAYS_EAGER = True
+        try:
+            stats = tasks.finish_period_flows([{'origins': 12, 'flows': 30}, {'origins': 8, 'flows': 20}],
+                                              'test', sim_version, time.time() - 10)
+        finally:
+            tasks.celery_tasks.conf.CELERY_ALWAYS_EAGER = always_eager
+        self.assertEqual(stats['origins'], 20)
+        self.assertEqual(stats['flows'], 50)
+        self.assertEqual(stats['tasks'], 2)
+        self.assertGreater(stats['originsPerSecond'], 0)
+        self.assertEqual(tasks.get_published_flows_query(self.db, 'test'), {'simGroup': 'test@' + sim_version})
+        self.assertEqual(self.db.passengerFlows.distinct('simGroup'), ['test@' + sim_version])
@@ -0,0 +1,57 @@
+import datetime
+import sys
+import unittest
+from StringIO import StringIO
+import pymongo
+import cache_airport_flows_periodic
+
+
+class TestPrintStatus(unittest.TestCase):
+    """
+    Print the status of periods from a scratch database so the live statistics are left alone.
+    """
+    def setUp(self):
+        self.live_db = cache_airport_flows_periodic.db
+        self.db = cache_airport_flows_periodic.db = pymongo.MongoClient(
+            cache_airport_flows_periodic.mongo_url)[cache_airport_flows_periodic.mongo_db_name + '-test-status']
+
+    def tearDown(self):
+        cache_airport_flows_periodic.db = self.live_db
+        self.db.client.drop_database(self.db.name)
+
+    def print_status(self):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            cache_airport_flows_periodic.print_status()
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_local_and_legacy_periods(self):
+        """
+        Periods calculated locally have no queue and periods recorded by older versions
+        only have their task counts, but the status should still be printed for them.
+        """
+        self.db.cachingStats.insert_many([{
+            '_id': 'local',
+            'startDate': '2017-01-01',
+            'endDate': '2017-02-01',
+            'queue': None,
+            'queuedTasks': 1,
+            'completedTasks': 1,
+            'windowCacheHits': 0,
+            'diskCacheHits': 1,
+            'cacheMisses': 0,
+            'queuedTime': datetime.datetime.utcnow()
+        }, {
+            '_id': 'legacy',
+            'completedTasks': 2,
+            'cacheMisses': 2
+        }])
+        status = self.print_status()
+        self.assertIn("local 2017-01-01 2017-02-01 local", status)
+        self.assertIn("outstanding tasks: 0 of 1", status)
+        self.assertIn("disk cache hit ratio: 1.0", status)
+        self.assertIn("legacy None None unknown queue", status)
+        self.assertIn("memory cache hit ratio: 0.0", status)
@@ -0,0 +1,285 @@
+# coding=utf8
+import datetime
+import json
+import urllib
+import pymongo
+import tornado.concurrent
+import tornado.testing
+from tornado import gen
+from tornado.options import options
+import server
+
+
+class TestApplication(server.Application):
+    """
+    An application with a fixed set of nodes that does not warm up the simulator,
+    so requests can be handled without celery workers.
+    """
+    @gen.coroutine
+    def refresh_nodes(self):
+        self.nodes = self.validator.nodes = frozenset(['LAX', 'SEA'])
+        self.nodes_loaded = True
+
+    @gen.coroutine
+    def warm_up(self):
+        self.warmup_state = 'complete'
+
+
+class TestSimulationHandler(tornado.testing.AsyncHTTPTestCase):
+    PARAMETERS = {
+        'departureNodes': 'SEA,LAX',
+        'numberPassengers': '100',
+        'startDate': '1/1/2016',
+        'endDate': '1/2/2016',
+        'submittedBy': 'test@example.com'
+    }
+
+    def get_app(self):
+        self.db = pymongo.MongoClient(options.mongo_host, options.mongo_port)[options.mongo_database]
+        self.app = TestApplication()
+        return self.app
+
+    def setUp(self):
+        super(TestSimulationHandler, self).setUp()
+        record = server.SimulationRecord(self.app.validator)
+        record.fields = {
+            'departureNodes': ['LAX', 'SEA'],
+            'numberPassengers': 100,
+            'startDate': datetime.datetime(2016, 1, 1),
+            'endDate': datetime.datetime(2016, 2, 1)
+        }
+        self.sim_id = record.gen_key()
+        self.tearDownSimulation()
+
+    def tearDown(self):
+        self.tearDownSimulation()
+        super(TestSimulationHandler, self).tearDown()
+
+    def tearDownSimulation(self):
+        self.db.simulations.delete_many({'simId': self.sim_id})
+        self.db.simulation_progress.delete_many({'_id': self.sim_id})
+        self.db.simulation_results.delete_many({'_id': self.sim_id})
+        self.db.simulated_itineraries.delete_many({'simulationId': self.sim_id})
+
+    def get_progress_events(self):
+        response = self.wait_for(self.http_client.fetch(self.get_url('/simulator/' + self.sim_id + '/progress')))
+        return [event.split('\n')[0] for event in response.body.strip().split('\n\n')]
+
+    def set_no_seats(self):
+        # Without seats no tasks are queued, so celery is not needed.
+        seat_counts = tornado.concurrent.Future()
+        seat_counts.set_result({})
+        self.app.seat_count_cache.get = lambda *args: seat_counts
+
+    def get_results(self, **kwargs):
+        return self.wait_for(self.http_client.fetch(
+            self.get_url('/simulator/' + self.sim_id), raise_error=False, **kwargs))
+
+    def post_simulation(self):
+        return self.http_client.fetch(
+            self.get_url('/simulator'), method='POST', body=urllib.urlencode(self.PARAMETERS))
+
+    def test_simulation_claimed_by_another_process(self):
+        """
+        When another process has already claimed a simulation, identical requests
+        waiting on this process's claim should get its simId rather than hang.
+        """
+        self.db.simulations.insert_one({'simId': self.sim_id, 'status': 'pending'})
+        concurrent_requests = [self.post_simulation(), self.post_simulation()]
+        for request in concurrent_requests:
+            response = self.wait_for(request)
+            self.assertEqual(json.loads(response.body), {'simId': self.sim_id})
+        self.assertEqual(self.app.pending_simulations, {})
+        # A later identical request should not wait on the earlier claim either.
+        response = self.wait_for(self.post_simulation())
+        self.assertEqual(json.loads(response.body), {'simId': self.sim_id})
+
+    def test_expired_claim_is_retaken(self):
+        """
+        A simulation claimed by a process that died before queuing it should be
+        claimed again by a later request, and its progress stream should not wait for it.
+        """
+        claimed_time = datetime.datetime.utcnow() - datetime.timedelta(seconds=options.claim_timeout + 60)
+        self.db.simulations.insert_one({'simId': self.sim_id, 'status': 'pending', 'claimedTime': claimed_time})
+        response = self.wait_for(self.http_client.fetch(self.get_url('/simulator/' + self.sim_id + '/progress')))
+        self.assertTrue(response.body.startswith('event: error\n'))
+        self.set_no_seats()
+        response = self.wait_for(self.post_simulation())
+        self.assertEqual(json.loads(response.body), {'simId': self.sim_id})
+        simulation = self.db.simulations.find_one({'simId': self.sim_id})
+        self.assertNotEqual(simulation['status'], 'pending')
+        self.assertGreater(simulation['claimedTime'], claimed_time)
+
+    def test_progress_of_finished_simulations(self):
+        """
+        The progress stream should end for simulations queued before progress was recorded
+        and for simulations whose results have been stored without every task recording its progress.
+        """
+        self.db.simulations.insert_one({
+            'simId': self.sim_id,
+            'status': 'queued',
+            'taskIds': ['task'],
+            'numberPassengers': 100
+        })
+        self.assertEqual(self.get_progress_events(), ['event: complete'])
+        self.db.simulations.update_one({'simId': self.sim_id}, {'$set': {'chunkSize': 2000}})
+        self.db.simulation_results.insert_one({'_id': self.sim_id, 'simId': self.sim_id, 'destinations': {}})
+        self.assertEqual(self.get_progress_events(), ['event: complete'])
+
+    def test_progress_timeout(self):
+        """
+        The progress stream of a simulation that does not finish should end after the progress timeout.
+        """
+        self.db.simulations.insert_one({
+            'simId': self.sim_id,
+            'status': 'queued',
+            'taskIds': ['task'],
+            'chunkSize': 2000,
+            'numberPassengers': 100
+        })
+        progress_timeout = options.progress_timeout
+        options.progress_timeout = 0
+        try:
+            self.assertEqual(self.get_progress_events(), ['event: progress', 'event: timeout'])
+        finally:
+            options.progress_timeout = progress_timeout
+
+    def test_results_etag(self):
+        """
+        Results should have an ETag, and requests sending it back should get a 304 without a body.
+        """
+        self.db.simulations.insert_one({'simId': self.sim_id, 'status': 'queued', 'taskIds': ['task']})
+        self.db.simulation_results.insert_one({
+            '_id': self.sim_id,
+            'simId': self.sim_id,
+            'totalPassengers': 1,
+            'destinations': {'LAX': {'count': 1, 'fraction': 1.0}},
+            'completedTime': datetime.datetime.utcnow()
+        })
+        response = self.get_results()
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)['destinations'], {'LAX': {'count': 1, 'fraction': 1.0}})
+        etag = response.headers['ETag']
+        response = self.get_results(headers={'If-None-Match': etag})
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, '')
+        response = self.get_results(headers={'If-None-Match': '"stale"'})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_results_of_legacy_simulation(self):
+        """
+        The results of a finished simulation queued before results were stored
+        should be counted from its itineraries and stored.
+        """
+        self.db.simulations.insert_one({
+            'simId': self.sim_id,
+            'status': 'queued',
+            'taskIds': ['task'],
+            'numberPassengers': 4
+        })
+        self.db.simulated_itineraries.insert_many([{
+            'simulationId': self.sim_id,
+            'origin': 'SEA',
+            'destination': destination
+        } for destination in ['LAX', 'LAX', 'LAX', 'JFK']])
+        response = self.get_results()
+        self.assertEqual(response.code, 200)
+        results = json.loads(response.body)
+        self.assertTrue(results['complete'])
+        self.assertEqual(results['totalPassengers'], 4)
+        self.assertEqual(results['destinations']['LAX'], {'count': 3, 'fraction': 0.75})
+        self.assertIsNotNone(self.db.simulation_results.find_one({'_id': self.sim_id}))
+
+    def test_results_without_passengers(self):
+        """
+        A simulation without any passengers to simulate should be complete once it is queued.
+        """
+        self.set_no_seats()
+        self.wait_for(self.post_simulation())
+        self.assertEqual(self.db.simulations.find_one({'simId': self.sim_id})['status'], 'complete')
+        response = self.get_results()
+        self.assertEqual(response.code, 200)
+        results = json.loads(response.body)
+        self.assertTrue(results['complete'])
+        self.assertEqual(results['totalPassengers'], 0)
+        self.assertEqual(results['destinations'], {})
+
+    def test_rejected_until_warmed_up(self):
+        """
+        Simulation requests should be rejected until the simulator has warmed up.
+        """
+        self.app.warmup_state = 'running'
+        response = self.wait_for(self.http_client.fetch(
+            self.get_url('/simulator'), method='POST', body=urllib.urlencode(self.PARAMETERS), raise_error=False))
+        self.assertEqual(response.code, 503)
+        self.assertEqual(json.loads(response.body)['warmup'], 'running')
+        self.assertIsNone(self.db.simulations.find_one({'simId': self.sim_id}))
+
+    def wait_for(self, future):
+        self.io_loop.add_future(future, self.stop)
+        return self.wait(timeout=10).result()
+
+
+class TestSeatCountCache(tornado.testing.AsyncTestCase):
+    """
+    Look up seat counts with the aggregation replaced by one that records the airports
+    it was called with and waits for the test to give it the counts.
+    """
+    START_DATE = datetime.datetime(2016, 1, 1)
+    END_DATE = datetime.datetime(2016, 2, 1)
+
+    def setUp(self):
+        super(TestSeatCountCache, self).setUp()
+        self.aggregations = []
+        self.counts = tornado.concurrent.Future()
+        self.aggregate_outgoing_seat_counts = server.aggregate_outgoing_seat_counts
+        server.aggregate_outgoing_seat_counts = self.aggregate
+
+    def tearDown(self):
+        server.aggregate_outgoing_seat_counts = self.aggregate_outgoing_seat_counts
+        super(TestSeatCountCache, self).tearDown()
+
+    @gen.coroutine
+    def aggregate(self, db, airports, start_date, end_date):
+        self.aggregations.append(sorted(airports))
+        counts = yield self.counts
+        raise gen.Return(counts)
+
+    @tornado.testing.gen_test
+    def test_concurrent_lookups_share_aggregations(self):
+        """
+        Concurrent lookups should only aggregate the airports that are not being
+        aggregated already, and later lookups should use the cached counts.
+        """
+        cache = server.SeatCountCache(10, 60)
+        first_lookup = cache.get(None, ['LAX', 'SEA'], self.START_DATE, self.END_DATE)
+        second_lookup = cache.get(None, ['SEA', 'JFK'], self.START_DATE, self.END_DATE)
+        self.assertEqual(self.aggregations, [['LAX', 'SEA'], ['JFK']])
+        self.counts.set_result({'LAX': 10, 'SEA': 20, 'JFK': 5})
+        self.assertEqual((yield first_lookup), {'LAX': 10, 'SEA': 20})
+        self.assertEqual((yield second_lookup), {'SEA': 20, 'JFK': 5})
+        self.assertEqual((yield cache.get(None, ['JFK', 'LAX'], self.START_DATE, self.END_DATE)), {'LAX': 10, 'JFK': 5})
+        self.assertEqual(len(self.aggregations), 2)
+        # Airports without seats are cached with a count of zero.
+        self.assertEqual((yield cache.get(None, ['BNA'], self.START_DATE, self.END_DATE)), {'BNA': 0})
+        self.assertEqual((yield cache.get(None, ['BNA'], self.START_DATE, self.END_DATE)), {'BNA': 0})
+        self.assertEqual(self.aggregations, [['LAX', 'SEA'], ['JFK'], ['BNA']])
+
+    @tornado.testing.gen_test
+    def test_failed_aggregation(self):
+        """
+        A failed aggregation should fail the lookups waiting for it without caching anything.
+        """
+        cache = server.SeatCountCache(10, 60)
+        first_lookup = cache.get(None, ['LAX'], self.START_DATE, self.END_DATE)
+        second_lookup = cache.get(None, ['LAX'], self.START_DATE, self.END_DATE)
+        self.counts.set_exception(pymongo.errors.OperationFailure('failed'))
+        with self.assertRaises(pymongo.errors.OperationFailure):
+            yield first_lookup
+        with self.assertRaises(pymongo.errors.OperationFailure):
+            yield second_lookup
+        self.counts = tornado.concurrent.Future()
+        self.counts.set_result({'LAX': 10})
+        self.assertEqual((yield cache.get(None, ['LAX'], self.START_DATE, self.END_DATE)), {'LAX': 10})
+        self.assertEqual(self.aggregations, [['LAX'], ['LAX']])